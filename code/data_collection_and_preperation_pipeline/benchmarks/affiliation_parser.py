@@ -0,0 +1,207 @@
+import os
+import sys
+import inspect
+import re
+import json
+import time
+import argparse
+
+import numpy as np
+
+"""
+Checks parse_affil() against the previous implementation, which checked every keyword of keywords.py with "keyword in text"
+    (see the reference_* functions below), then benchmarks both in affiliations per second.
+
+Commands:
+    fixtures: Save affiliation strings from the affiliations table to the fixture file (one per line).
+    run: Parse the fixtures with both implementations, and print the results as JSON.
+        Fails if any parsed affiliation differs.
+
+Usage:
+    python3 benchmarks/affiliation_parser.py fixtures [--number 100000]
+    python3 benchmarks/affiliation_parser.py run [--repeat 3]
+"""
+
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir  = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+
+from utils.affiliationParser import parse
+from utils.affiliationParser.keywords import *
+
+fixture_file = os.path.join(currentdir, 'fixtures', 'affiliations.txt')
+
+
+def reference_replace_institution_abbr(affil_text):
+    for university_list in UNIVERSITY_ABBR:
+        for university in university_list:
+            if university in affil_text:
+                affil_text = re.sub(university, university_list[0], affil_text)
+                return affil_text
+    return affil_text
+
+
+def reference_find_country(location):
+    location_lower = location.lower()
+    for country in COUNTRY:
+        for c in country:
+            if c in location_lower:
+                return country[0]
+    return ""
+
+
+def reference_check_country(affil_text):
+    for country in ["UK"]:
+        if country in affil_text:
+            return "united kingdom"
+    for state in STATES:
+        if state in affil_text:
+            return "united states of america"
+    return ""
+
+
+def reference_parse_affil(affil_text):
+    """ The previous parse_affil() """
+    affil_text = parse.unidecode(affil_text)
+    affil_text = parse.clean_text(affil_text)
+    email      = parse.parse_email(affil_text)
+    affil_text = re.sub(email, "", affil_text)
+
+    affil_list  = affil_text.split(", ")
+    affil       = list()
+    location    = list()
+    departments = list()
+
+    for i, a in enumerate(affil_list):
+        for ins in INSTITUTE:
+            if ins in a.lower() and (not a in affil):
+                affil.append(a)
+                location = affil_list[i + 1 : :]
+
+    pop_index = list()
+    for i, a in enumerate(affil):
+        for rm in REMOVE_INSTITUE:
+            if rm in a.lower() and (not "university" in a.lower()):
+                pop_index.append(i)
+    affil = np.delete(affil, list(set(pop_index))).tolist()
+
+    pop_index = list()
+    for i, l in enumerate(location):
+        for rm in DEPARMENT:
+            if rm in l.lower():
+                pop_index.append(i)
+    location = np.delete(location, list(set(pop_index))).tolist()
+
+    affil = ", ".join(affil)
+    location = ", ".join(location)
+    if location == "":
+        location = affil_text.split(", ")[-1]
+    location = re.sub(r"\([^)]*\)", "", location).strip()
+
+    for i, a in enumerate(affil_list):
+        for dep in DEPARMENT:
+            if dep in a.lower() and (not a in departments):
+                departments.append(affil_list[i])
+    department = ", ".join(departments)
+
+    location = re.sub(r"\.", "", location).strip()
+    dict_location = {"location": location.strip(), "country": reference_find_country(location).strip()}
+    affil = parse.append_institution_city(affil, dict_location["location"])
+
+    dict_out = {
+        "full_text": affil_text.strip(),
+        "department": department.strip(),
+        "institution": affil.strip(),
+        "email": email
+    }
+    dict_out.update(dict_location)
+    if dict_out["country"] == "":
+        dict_out["country"] = reference_check_country(affil_text)
+    return dict_out
+
+
+def load_fixtures(path):
+    """ List of affiliation strings in the fixture file """
+    with open(path) as file:
+        return [line.rstrip('\n') for line in file if line.strip()]
+
+
+def save_fixtures(args):
+    """ Save the affiliation strings of the most recent papers, including repeats, as they are parsed during ingest """
+    from utils.database.database import MySQLDatabase
+    rows = MySQLDatabase().query("""
+        SELECT affiliation
+        FROM affiliations
+        WHERE affiliation IS NOT NULL
+        ORDER BY affiliation_num DESC
+        LIMIT %s
+    """, [args.number])
+    if rows is None:
+        sys.exit("No affiliations found. Database error?")
+
+    os.makedirs(os.path.dirname(args.fixtures), exist_ok=True)
+    with open(args.fixtures, 'w') as file:
+        for row in rows:
+            file.write(' '.join(row['affiliation'].split()) + '\n')  # one affiliation per line
+    print(f"Saved {len(rows):,} affiliations to {args.fixtures}")
+
+
+def time_it(func, affiliations, repeat):
+    """ Parse all affiliations <repeat> times. Returns (results of the last run, best seconds of a run) """
+    best = None
+    for _ in range(repeat):
+        t0 = time.time()
+        results = [func(affiliation) for affiliation in affiliations]
+        seconds = time.time() - t0
+        best = seconds if best is None else min(best, seconds)
+    return results, best
+
+
+def run(args):
+    affiliations = load_fixtures(args.fixtures)
+
+    # the module level abbreviation and country functions are used by clean_text() and parse_location(), so the
+    # reference swaps them in while it runs
+    compiled = parse.replace_institution_abbr
+    parse.replace_institution_abbr = reference_replace_institution_abbr
+    try:
+        expected, reference_time = time_it(reference_parse_affil, affiliations, args.repeat)
+    finally:
+        parse.replace_institution_abbr = compiled
+    results, compiled_time = time_it(parse.parse_affil, affiliations, args.repeat)
+
+    mismatches = [(affiliation, e, r) for affiliation, e, r in zip(affiliations, expected, results) if e != r]
+    for affiliation, e, r in mismatches[:10]:
+        print(json.dumps({'affiliation': affiliation, 'expected': e, 'result': r}, indent=4))
+
+    return {
+        'affiliations': len(affiliations),
+        'distinct_affiliations': len(set(affiliations)),
+        'repeat': args.repeat,
+        'mismatches': len(mismatches),
+        'reference_seconds': round(reference_time, 3),
+        'compiled_seconds': round(compiled_time, 3),
+        'reference_per_second': round(len(affiliations) / reference_time, 1),
+        'compiled_per_second': round(len(affiliations) / compiled_time, 1),
+        'speedup': round(reference_time / compiled_time, 2),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the affiliation parser on a fixed set of affiliation strings.')
+    parser.add_argument('--fixtures', default=fixture_file, help='Fixture file of affiliation strings, one per line.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    fixtures = commands.add_parser('fixtures', help='Save affiliation strings from the affiliations table.')
+    fixtures.add_argument('--number', type=int, default=100000, help='Number of affiliations to save.')
+
+    run_parser = commands.add_parser('run', help='Check and time parse_affil() against the previous implementation.')
+    run_parser.add_argument('--repeat', type=int, default=3, help='Runs of each implementation. The fastest is reported.')
+
+    args = parser.parse_args()
+    if args.command == 'fixtures':
+        save_fixtures(args)
+    else:
+        results = run(args)
+        print(json.dumps(results, indent=4))
+        assert not results['mismatches'], "parse_affil() output differs from the reference implementation"
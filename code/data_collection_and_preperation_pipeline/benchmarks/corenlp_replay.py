@@ -0,0 +1,157 @@
+import os
+import time
+import json
+import hashlib
+from threading import Thread
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+"""
+Local stand-in for the CoreNLP Java server, which serves recorded annotations instead of running the annotators.
+
+Annotations are recorded from a real CoreNLP server with record(), and stored in a directory as one serialized protobuf
+    Document per text, named by the SHA-1 of the text. The seconds the real server took to annotate each text are
+    stored in manifest.json so the replay server can optionally sleep for the same amount of time.
+
+The Stanza CoreNLPClient talks to the replay server exactly as it would to the real one (see ReplayServer.client()),
+    so the client request, response transfer and protobuf parsing are all still part of the measured annotation time.
+"""
+
+
+def text_key(data):
+    """ Key for the recording of the given text (str or utf-8 bytes) """
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return hashlib.sha1(data).hexdigest()
+
+
+def load_manifest(directory):
+    """ Dictionary of recorded text keys -> seconds taken by the real server """
+    path = os.path.join(directory, 'manifest.json')
+    if not os.path.exists(path):
+        return {}
+    with open(path) as file:
+        return json.load(file)
+
+
+def record(extractor, papers, directory, window=None):
+    """
+    Annotate the given papers with the real CoreNLP server and save the responses in <directory>.
+    <extractor> NLPExtractor used to annotate the papers (its CoreNLP client is started if it isn't already).
+    <papers> list of papers with the keys "pmid", "pub_date", and "content".
+    <window> number of annotation requests in flight at once. Defaults to the extractor's threads.
+    Papers too long to annotate at once are recorded as the parts the extractor sends (see NLPExtractor.split_content()).
+    Texts already recorded are skipped. Returns the number of new recordings.
+    """
+    from stanza.protobuf import writeToDelimitedString
+
+    os.makedirs(directory, exist_ok=True)
+    manifest = load_manifest(directory)
+    papers = [dict(paper, content=text) for paper in papers if paper['content']
+              for offset, text in extractor.split_content(paper['content'], extractor.max_chars)]
+    papers = [paper for paper in papers if text_key(paper['content']) not in manifest]
+    if not papers: return 0
+
+    extractor.check_client()
+    recorded = 0
+    for _, paper in extractor.annotate_stream(((paper['pmid'], paper) for paper in papers), window or extractor.threads):
+        if paper['document'] is None:  # failed to annotate - the replay server will return an error for it as well
+            continue
+        key = text_key(paper['content'])
+        path = os.path.join(directory, f"{key}.pb")
+        with open(path + '.tmp', 'wb') as file:
+            file.write(writeToDelimitedString(paper['document']).getvalue())
+        os.replace(path + '.tmp', path)
+        manifest[key] = paper['time']
+        recorded += 1
+
+    with open(os.path.join(directory, 'manifest.json.tmp'), 'w') as file:
+        json.dump(manifest, file)
+    os.replace(os.path.join(directory, 'manifest.json.tmp'), os.path.join(directory, 'manifest.json'))
+    return recorded
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    """ Handles the two CoreNLP server endpoints used by the Stanza client """
+    def do_GET(self):
+        if self.path.startswith('/ping'):  # health check done by the client before each request
+            self.respond(200, b'pong')
+        else:
+            self.respond(404, b'Not found')
+
+    def do_POST(self):
+        """ Annotation request. The body is the text to annotate. """
+        text = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        key = text_key(text)
+        if key not in self.server.manifest:  # the client raises an AnnotationException on a 500
+            self.respond(500, f"No recorded annotation for text {key}".encode('utf-8'))
+            return
+
+        with open(os.path.join(self.server.directory, f"{key}.pb"), 'rb') as file:
+            data = file.read()
+        if self.server.latency:
+            time.sleep(self.server.manifest[key] * self.server.latency)
+        self.respond(200, data, 'application/x-protobuf')
+
+    def respond(self, status, data, content_type='text/plain'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass  # don't print every request
+
+
+class ReplayServer:
+    """
+    HTTP server which stands in for a CoreNLP server by serving the annotations recorded in <directory>.
+    <latency> scales the recorded annotation time slept before each response. 0 responds immediately,
+        1 responds as slowly as the real server did when recording.
+    """
+    def __init__(self, directory, port=9010, latency=0):
+        self.server = ThreadingHTTPServer(('localhost', port), ReplayHandler)
+        self.server.daemon_threads = True
+        self.server.directory = directory
+        self.server.manifest = load_manifest(directory)
+        self.server.latency = latency
+        self.thread = None
+
+    @property
+    def endpoint(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def __len__(self):
+        """ Number of recorded annotations """
+        return len(self.server.manifest)
+
+    def start(self):
+        """ Serve requests in a background thread """
+        self.thread = Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self.thread:
+            self.thread.join()
+
+    def client(self, threads, properties=None):
+        """ Stanza CoreNLPClient connected to this server, which never starts a CoreNLP server of its own """
+        from stanza.server import CoreNLPClient, StartServer
+        return CoreNLPClient(
+            start_server=StartServer.DONT_START,
+            endpoint=self.endpoint,
+            timeout=60000,
+            threads=threads,
+            properties=properties,
+            be_quiet=True,
+        )
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
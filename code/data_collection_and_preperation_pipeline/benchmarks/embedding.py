@@ -0,0 +1,106 @@
+import os
+import sys
+import inspect
+import time
+import random
+import json
+
+import torch
+
+"""
+Checks EmbeddingModel.embed() against the previous implementation, which called get_vectors() once for each of the
+    2D, 3D and 5D embeddings, looked words up in a reduced copy of the embedding matrix, and pooled each word in a python loop.
+Then benchmarks both in words per second.
+
+Random concept-like strings of 1-4 words from the model's vocabulary are used as fixtures.
+Both implementations use the same PCA projections, so their coordinates must match.
+
+Usage: python3 benchmarks/embedding.py [model] [words] [batch size]
+"""
+
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir  = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+
+from utils.database.database import Database
+from utils.extraction.embedding import EmbeddingModel
+
+
+def reduced_embedding(model, n):
+    """ The previous EmbeddingModel.reduce(), which made a reduced copy of the embedding matrix (using the model's projection) """
+    reduced = torch.matmul(model.embedding.weight, model.projection(n))
+    module = model.embedding.__class__(num_embeddings=model.embedding.num_embeddings, embedding_dim=n)
+    module.load_state_dict({'weight': reduced})
+    return module
+
+
+def reference_get_vectors(model, embedding, words):
+    """ The previous EmbeddingModel.get_vectors() and map_words_to_vectors() """
+    vectors = []
+    for i in range(0, len(words), model.max):
+        batch = words[i:i+model.max]
+        encoded = model.tokenizer(batch, is_split_into_words=True, return_tensors="pt", add_special_tokens=False)
+        matrix = embedding(encoded.input_ids).squeeze(0)
+
+        last_word_id = None
+        for word_id in encoded.word_ids():
+            if word_id is None or last_word_id == word_id: continue
+            last_word_id = word_id
+            start, end = encoded.word_to_tokens(word_id)
+            word = model.tokenizer.decode(list(encoded['input_ids'][0][start:end]))
+            tensor = torch.stack([matrix[j] for j in range(start, end)]).mean(dim=0)
+            vectors.append((word, tensor.tolist() if tensor.size() else [tensor.tolist()]))
+    return vectors
+
+
+def reference_embed(model, embeddings, words):
+    """ Rows of 2D, 3D and 5D coordinates as previously built by populate_database() """
+    with torch.no_grad():
+        v2d, v3d, v5d = [reference_get_vectors(model, embeddings[n], words) for n in (2, 3, 5)]
+    return [v2d[j][1] + v3d[j][1] + v5d[j][1] for j in range(len(v2d))]
+
+
+def random_words(model, num):
+    """ Random strings of 1-4 alphabetic words from the model's vocabulary """
+    vocab = [word for word in model.tokenizer.get_vocab() if word.isalpha()]
+    return [' '.join(random.choice(vocab) for _ in range(random.randint(1, 4))) for _ in range(num)]
+
+
+def time_it(func, words, batch_size):
+    """ Run func on each batch of words. Returns (rows, seconds) """
+    t0 = time.time()
+    rows = []
+    for i in range(0, len(words), batch_size):
+        rows += func(words[i:i+batch_size])
+    return rows, time.time() - t0
+
+
+if __name__ == '__main__':
+    model_name = sys.argv[1] if len(sys.argv) > 1 else "allenai/scibert_scivocab_uncased"
+    num_words = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+    batch_size = int(sys.argv[3]) if len(sys.argv) > 3 else 10000
+
+    model = EmbeddingModel(model_name, db=Database())  # no database connection needed
+    random.seed(0)
+    words = random_words(model, num_words)
+    embeddings = {n: reduced_embedding(model, n) for n in (2, 3, 5)}
+
+    expected, reference_time = time_it(lambda batch: reference_embed(model, embeddings, batch), words, batch_size)
+
+    def embed(batch):
+        vectors, found = model.embed(batch, [2, 3, 5])
+        return vectors[found].tolist()
+    results, vectorized_time = time_it(embed, words, batch_size)
+
+    mismatches = len(results) != len(expected) or not torch.allclose(torch.tensor(results), torch.tensor(expected), atol=1e-5)
+    print(json.dumps({
+        'model': model_name,
+        'words': num_words,
+        'batch_size': batch_size,
+        'mismatches': int(mismatches),
+        'reference_seconds': round(reference_time, 3),
+        'vectorized_seconds': round(vectorized_time, 3),
+        'reference_words_per_second': round(num_words / reference_time, 1),
+        'vectorized_words_per_second': round(num_words / vectorized_time, 1),
+    }, indent=4))
+    assert not mismatches, "EmbeddingModel.embed() output differs from the reference implementation"
@@ -0,0 +1,185 @@
+import os
+import sys
+import inspect
+import json
+import time
+import resource
+import argparse
+from multiprocessing.pool import ThreadPool
+
+"""
+Benchmarks NLPExtractor.extract_information() on a fixed set of abstracts on a single machine.
+
+Commands:
+    fixtures: Save a fixed set of abstracts from the documents table to the fixture file.
+    record: Annotate the fixtures with the real CoreNLP server and save the responses for the replay backend.
+    run: Run extract_information() on the fixtures and print the results as JSON.
+
+Annotation backends for the run command:
+    corenlp: The real CoreNLPClient, as configured in the config (a server is started if one isn't already running).
+    replay: A local stand-in server which serves the recorded annotations (see benchmarks/corenlp_replay.py).
+
+The run command takes papers from the fixture file instead of the documents table, and inserts only build their
+    queries without sending them, unless --database is given.
+The results include the summed seconds spent in each stage, papers per second, and the peak RSS of this process and of
+    any child processes (the CoreNLP server, when it was started by the corenlp backend).
+
+Usage:
+    python3 benchmarks/extraction.py fixtures [--number 500] [--start-pmid 30000000]
+    python3 benchmarks/extraction.py record
+    python3 benchmarks/extraction.py [--threads 8] run [--backend replay] [--latency 1] [--batch-size 100] [--out results.json]
+"""
+
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir  = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+
+from configuration.config import Config
+from utils.database.database import Database, MySQLDatabase
+from utils.extraction.extraction import NLPExtractor
+from utils.extraction.corenlp_pool import CoreNLPPool
+from corenlp_replay import ReplayServer, record
+
+fixture_file = os.path.join(currentdir, 'fixtures', 'abstracts.jsonl')
+recording_directory = os.path.join(currentdir, 'fixtures', 'corenlp')
+
+
+class FixtureDatabase(Database):
+    """ Stands in for MySQLDatabase without a connection. Queries return nothing, and inserts only build their query. """
+    insert_row = MySQLDatabase.insert_row
+
+    def __init__(self, *args, threads=4, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.thread_pool = ThreadPool(threads)
+
+    def query(self, query, parameters=None, format='cols', threaded=False):
+        if threaded:
+            return self.thread_pool.apply_async(self.query, [query, parameters])
+        return None
+
+
+class FixtureExtractor(NLPExtractor):
+    """ NLPExtractor which takes papers from the fixtures instead of querying the documents table """
+    def __init__(self, fixtures, *args, **kwargs):
+        self.fixtures = {str(paper['pmid']): paper for paper in fixtures}
+        super().__init__(*args, **kwargs)
+
+    def get_papers_from_pmids(self, pmids):
+        return [self.fixtures[str(pmid)] for pmid in pmids if str(pmid) in self.fixtures]
+
+
+def load_fixtures(path):
+    """ List of papers in the fixture file """
+    with open(path) as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def save_fixtures(args):
+    """ Save a fixed set of abstracts from the documents table, ordered by PMID """
+    db = MySQLDatabase()
+    rows = db.query(f"""
+        SELECT pmid, MAX(pub_date) as pub_date, content
+        FROM documents
+        WHERE content_type = "abstract"
+        AND pmid >= %s
+        GROUP BY pmid
+        ORDER BY pmid
+        LIMIT %s
+    """, [args.start_pmid, args.number])
+    if rows is None:
+        sys.exit("No papers found. Database error?")
+
+    os.makedirs(os.path.dirname(args.fixtures), exist_ok=True)
+    with open(args.fixtures, 'w') as file:
+        for row in rows:
+            file.write(json.dumps({'pmid': row['pmid'], 'pub_date': str(row['pub_date']), 'content': row['content']}) + '\n')
+    print(f"Saved {len(rows):,} abstracts to {args.fixtures}")
+
+
+def record_annotations(args):
+    """ Annotate the fixtures with the real CoreNLP server and save the responses """
+    fixtures = load_fixtures(args.fixtures)
+    extractor = FixtureExtractor(fixtures, db=FixtureDatabase())
+    if args.threads: extractor.threads = args.threads
+    try:
+        recorded = record(extractor, fixtures, args.recordings)
+    finally:
+        if extractor.client: extractor.client.stop()
+    print(f"Recorded {recorded:,} new annotations to {args.recordings}")
+
+
+def run(args):
+    """ Run extract_information() on the fixtures with the chosen backend. Returns the results. """
+    fixtures = load_fixtures(args.fixtures)
+    db = MySQLDatabase() if args.database else FixtureDatabase()
+    extractor = NLPExtractor(db=db) if args.database else FixtureExtractor(fixtures, db=db)
+    if args.threads: extractor.threads = args.threads
+
+    server = None
+    if args.backend == 'replay':
+        server = ReplayServer(args.recordings, port=args.port, latency=args.latency)
+        if not len(server):
+            sys.exit(f"No recorded annotations in {args.recordings}. Use the record command first.")
+        server.start()
+        extractor.client = CoreNLPPool(clients=[server.client(extractor.threads, Config.CoreNLP_properties)])
+
+    try:
+        pmids = [paper['pmid'] for paper in fixtures]
+        stats = extractor.extract_information(pmids=pmids, db_insert=True, batch_size=args.batch_size, show_progress=True)
+    finally:
+        if extractor.client: extractor.client.stop()
+        if server: server.stop()
+
+    stats.update({
+        'backend': args.backend,
+        'latency': args.latency if args.backend == 'replay' else None,
+        'database': args.database,
+        'threads': extractor.threads,
+        'batch_size': args.batch_size,
+        'papers_per_second': round(stats['papers'] / stats['seconds'], 3) if stats['seconds'] else None,
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),  # ru_maxrss is in KB on Linux
+        'peak_children_rss_mb': round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+        'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+    })
+    stats['seconds'] = round(stats['seconds'], 3)
+    stats['stage_seconds'] = {stage: round(seconds, 3) for stage, seconds in stats['stage_seconds'].items()}
+    return stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark NLPExtractor.extract_information() on a fixed set of abstracts")
+    parser.add_argument('--fixtures', default=fixture_file, help="JSON lines file of papers with pmid, pub_date and content")
+    parser.add_argument('--recordings', default=recording_directory, help="Directory of recorded CoreNLP annotations")
+    parser.add_argument('--threads', type=int, default=None, help="Annotation threads (defaults to the number of CPUs)")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    fixtures = commands.add_parser('fixtures', help="Save a fixed set of abstracts from the documents table")
+    fixtures.add_argument('--number', type=int, default=500, help="Number of abstracts")
+    fixtures.add_argument('--start-pmid', type=int, default=30000000, help="Lowest PMID to include")
+
+    commands.add_parser('record', help="Record annotations of the fixtures from the real CoreNLP server")
+
+    benchmark = commands.add_parser('run', help="Run the benchmark and print the results as JSON")
+    benchmark.add_argument('--backend', choices=['corenlp', 'replay'], default='replay', help="Annotation backend")
+    benchmark.add_argument('--latency', type=float, default=0, help="Replay backend: scale of the recorded annotation time to wait before each response")
+    benchmark.add_argument('--port', type=int, default=9010, help="Replay backend: port of the stand-in server")
+    benchmark.add_argument('--batch-size', type=int, default=100, help="Papers queried and inserted at a time")
+    benchmark.add_argument('--database', action='store_true', help="Query papers and insert triples/concepts with the configured MySQL database")
+    benchmark.add_argument('--out', default=None, help="Also write the results to this JSON file")
+
+    args = parser.parse_args()
+    args.fixtures = os.path.abspath(args.fixtures)
+    args.recordings = os.path.abspath(args.recordings)
+    os.chdir(parentdir)  # the extractor uses paths relative to the pipeline directory
+
+    if args.command == 'fixtures':
+        save_fixtures(args)
+    elif args.command == 'record':
+        record_annotations(args)
+    elif args.command == 'run':
+        results = run(args)
+        output = json.dumps(results, indent=4)
+        print(output)
+        if args.out:
+            with open(args.out, 'w') as file:
+                file.write(output + '\n')
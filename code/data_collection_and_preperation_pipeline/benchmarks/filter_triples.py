@@ -0,0 +1,119 @@
+import os
+import sys
+import inspect
+import time
+import random
+import json
+
+"""
+Checks NLPExtractor.filter_triples() against the previous set-based implementation, then benchmarks both.
+
+Randomly generated papers are used as fixtures. Each sentence has many OpenIE-style triples drawn from a small pool
+    of entities, like the long sentences that OpenIE produces hundreds of triples for.
+The outputs of the two implementations must be identical for every fixture.
+
+Usage: python3 benchmarks/filter_triples.py [papers] [triples per sentence]
+"""
+
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir  = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+
+from utils.extraction.extraction import NLPExtractor
+
+
+def reference_filter_triples(triples):
+    """ The previous NLPExtractor.filter_triples(), which compared python sets against every kept triple """
+    triples = [t for t in triples if t.get('subject_entities') and t.get('object_entities')]
+
+    def sort_by(triple):
+        return (
+            triple['sentence_number'],
+            -(len(triple['subject_entities']) + len(triple['object_entities'])),
+            -(len(triple['subject']) + len(triple['object'])),
+            -len(triple['relation_entities']),
+            -len(triple['relation'])
+        )
+
+    triples = sorted(triples, key=sort_by)
+
+    sentence_num = -1
+    keep_triples = []
+    completed = []
+    for triple in triples:
+        if sentence_num != triple['sentence_number']:
+            sentence_num = triple['sentence_number']
+            completed = []
+
+        subjects = set([entity['id'] for _, _, entity in triple['subject_entities']])
+        objects = set([entity['id'] for _, _, entity in triple['object_entities']])
+
+        keep = True
+        for pair in completed:
+            if subjects.issubset(pair['subjects']) and objects.issubset(pair['objects']):
+                keep = False
+                break
+            all = subjects.union(objects)
+            if all.issubset(pair['subjects']) or all.issubset(pair['objects']):
+                keep = False
+                break
+
+        if keep:
+            completed.append({'subjects': subjects, 'objects': objects})
+            keep_triples.append(triple)
+
+    return keep_triples
+
+
+def random_tokens(entities, max_tokens):
+    """ Random list of entity tokens, as given by NLPExtractor.tokens_to_entities() """
+    return [(i, 0, {'id': random.choice(entities)}) for i in range(random.randint(0, max_tokens))]
+
+
+def random_paper(sentences, triples_per_sentence, entities_per_sentence=12, max_tokens=4):
+    """ Random list of triples for a paper """
+    triples = []
+    for i in range(sentences):
+        entities = [f"C{random.randint(0, 9999999):07}" for _ in range(entities_per_sentence)]
+        for _ in range(random.randint(1, triples_per_sentence)):
+            triples.append({
+                'subject': 'x' * random.randint(1, 60),
+                'relation': 'x' * random.randint(1, 20),
+                'object': 'x' * random.randint(1, 60),
+                'sentence_number': i,
+                'subject_entities': random_tokens(entities, max_tokens),
+                'relation_entities': random_tokens(entities, 1),
+                'object_entities': random_tokens(entities, max_tokens),
+            })
+    random.shuffle(triples)
+    return triples
+
+
+def time_it(func, papers):
+    """ Run func on each paper. Returns (results, seconds) """
+    t0 = time.time()
+    results = [func(triples) for triples in papers]
+    return results, time.time() - t0
+
+
+if __name__ == '__main__':
+    num_papers = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    triples_per_sentence = int(sys.argv[2]) if len(sys.argv) > 2 else 300
+
+    random.seed(0)
+    papers = [random_paper(random.randint(1, 10), triples_per_sentence) for _ in range(num_papers)]
+
+    extractor = NLPExtractor.__new__(NLPExtractor)  # filter_triples() doesn't need the models or database
+    expected, reference_time = time_it(reference_filter_triples, papers)
+    results, bitset_time = time_it(extractor.filter_triples, papers)
+
+    mismatches = sum(r != e for r, e in zip(results, expected))
+    print(json.dumps({
+        'papers': num_papers,
+        'triples': sum(len(p) for p in papers),
+        'kept': sum(len(r) for r in results),
+        'mismatches': mismatches,
+        'reference_seconds': round(reference_time, 4),
+        'bitset_seconds': round(bitset_time, 4),
+    }, indent=4))
+    assert not mismatches, "filter_triples() output differs from the reference implementation"
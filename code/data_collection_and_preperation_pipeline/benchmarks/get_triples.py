@@ -0,0 +1,154 @@
+import os
+import sys
+import inspect
+import time
+import random
+import json
+import tracemalloc
+from types import SimpleNamespace
+
+"""
+Checks NLPExtractor.get_triples() and construct_rows() against the previous implementation, which built a token
+    dictionary for every entity token of every triple fragment, then benchmarks both.
+
+Randomly generated CoreNLP-like documents are used as fixtures, with long sentences and many OpenIE triples each.
+The rows given by construct_rows() must be identical for every fixture.
+filter_triples() is skipped for both, since it is checked separately by benchmarks/filter_triples.py.
+
+Usage: python3 benchmarks/get_triples.py [papers] [triples per sentence]
+"""
+
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir  = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+
+from utils.extraction.extraction import NLPExtractor
+
+
+def reference_tokens_to_entities(triple_tokens, sentence, entities):
+    """ The previous NLPExtractor.tokens_to_entities() """
+    tokens = []
+    pos = 0
+    for token in triple_tokens:
+        t = sentence.token[token.tokenIndex]
+        if entities.get(t.beginChar):
+            tokens.append({
+                'start_char': t.beginChar - sentence.characterOffsetBegin,
+                'end_char': t.endChar - sentence.characterOffsetBegin,
+                'frag_start_char': pos,
+                'frag_end_char': pos + len(t.originalText),
+                'text': t.originalText,
+                'word': t.word,
+                'value': t.value,
+                'entity': entities.get(t.beginChar, '')
+            })
+        pos += len(t.originalText) + 1
+    return tokens
+
+
+def reference_get_triples(document, entities):
+    """ The previous NLPExtractor.get_triples(), without filtering """
+    triples = []
+    for i, sentence in enumerate(document.sentence):
+        for triple in sentence.openieTriple:
+            triples.append({
+                'subject': triple.subject,
+                'relation': triple.relation,
+                'object': triple.object,
+                'confidence': triple.confidence,
+                'sentence_number': i,
+                'start_char': sentence.characterOffsetBegin,
+                'end_char': sentence.characterOffsetEnd,
+                'subject_entities': reference_tokens_to_entities(triple.subjectTokens, sentence, entities),
+                'relation_entities': reference_tokens_to_entities(triple.relationTokens, sentence, entities),
+                'object_entities': reference_tokens_to_entities(triple.objectTokens, sentence, entities),
+            })
+    return triples
+
+
+def reference_construct_rows(triples, pmid, pub_date):
+    """ The previous NLPExtractor.construct_rows() """
+    triple_params = []
+    concept_params = []
+    for triple_ID, triple in enumerate(triples):
+        confidence = int(100 * triple['confidence']) if triple.get('confidence') else None
+        triple_params.append(
+            [pmid, triple_ID, pub_date, triple['subject'], triple['relation'], triple['object'], confidence,
+             triple['sentence_number'], triple['start_char'], triple['end_char']])
+        for fragment in ('object', 'subject', 'relation'):
+            for token in triple[f'{fragment}_entities']:
+                e = token['entity']
+                concept_params.append(
+                    [pmid, triple_ID, fragment, e['id'], e['name'], len(triple[f'{fragment}_entities']),
+                     token['start_char'], token['end_char'], token['frag_start_char'], token['frag_end_char']])
+    return triple_params, concept_params
+
+
+def random_document(sentences, triples_per_sentence, tokens_per_sentence=60, entity_rate=0.3):
+    """ Random CoreNLP-like document with OpenIE triples, and the entities found in it indexed by start_char """
+    document = SimpleNamespace(sentence=[])
+    entities = {}
+    pos = 0
+    for _ in range(sentences):
+        sentence = SimpleNamespace(token=[], openieTriple=[], characterOffsetBegin=pos)
+        for _ in range(tokens_per_sentence):
+            text = 'x' * random.randint(1, 12)
+            sentence.token.append(SimpleNamespace(beginChar=pos, endChar=pos + len(text), originalText=text, word=text, value=text))
+            if random.random() < entity_rate:
+                entities[pos] = {'id': f"C{random.randint(0, 9999999):07}", 'name': text, 'start_char': pos, 'end_char': pos + len(text)}
+            pos += len(text) + 1
+        sentence.characterOffsetEnd = pos
+
+        def fragment():
+            start = random.randrange(tokens_per_sentence)
+            indexes = range(start, min(tokens_per_sentence, start + random.randint(1, 15)))
+            return ' '.join(sentence.token[i].originalText for i in indexes), [SimpleNamespace(tokenIndex=i) for i in indexes]
+
+        for _ in range(random.randint(1, triples_per_sentence)):
+            subject, subject_tokens = fragment()
+            relation, relation_tokens = fragment()
+            object, object_tokens = fragment()
+            sentence.openieTriple.append(SimpleNamespace(
+                subject=subject, relation=relation, object=object, confidence=random.random(),
+                subjectTokens=subject_tokens, relationTokens=relation_tokens, objectTokens=object_tokens))
+        document.sentence.append(sentence)
+    return document, entities
+
+
+def time_it(get_triples, construct_rows, papers):
+    """ Extract triples from each paper, keeping them all in memory, then construct rows. Returns (rows, seconds, peak MB) """
+    tracemalloc.start()
+    t0 = time.time()
+    triples = [get_triples(document, entities) for document, entities in papers]
+    rows = [construct_rows(t, pmid, '2020-01-01') for pmid, t in enumerate(triples)]
+    seconds = time.time() - t0
+    peak = tracemalloc.get_traced_memory()[1] / 2**20
+    tracemalloc.stop()
+    return rows, seconds, peak
+
+
+if __name__ == '__main__':
+    num_papers = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    triples_per_sentence = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+
+    random.seed(0)
+    papers = [random_document(random.randint(5, 15), triples_per_sentence) for _ in range(num_papers)]
+
+    extractor = NLPExtractor.__new__(NLPExtractor)  # get_triples() doesn't need the models or database
+    extractor.filter_triples = lambda triples: triples  # skip filtering, so every triple is compared
+
+    expected, reference_time, reference_peak = time_it(reference_get_triples, reference_construct_rows, papers)
+    results, index_time, index_peak = time_it(extractor.get_triples, extractor.construct_rows, papers)
+
+    mismatches = sum(r != e for r, e in zip(results, expected))
+    print(json.dumps({
+        'papers': num_papers,
+        'triples': sum(len(r[0]) for r in results),
+        'concepts': sum(len(r[1]) for r in results),
+        'mismatches': mismatches,
+        'reference_seconds': round(reference_time, 4),
+        'index_seconds': round(index_time, 4),
+        'reference_peak_mb': round(reference_peak, 1),
+        'index_peak_mb': round(index_peak, 1),
+    }, indent=4))
+    assert not mismatches, "construct_rows() output differs from the reference implementation"
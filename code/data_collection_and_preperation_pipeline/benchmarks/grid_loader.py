@@ -0,0 +1,264 @@
+import os
+import sys
+import inspect
+import re
+import csv
+import json
+import time
+import shutil
+import tempfile
+import argparse
+
+"""
+Checks the GRID import (grid.load_table()) against an in-memory stand-in for MySQL, then times it in rows per second.
+
+The stand-in (StandInDatabase below) keeps each table as a list of rows. It reads the files given to load_data() as
+    MySQL reads the default LOAD DATA format, and converts values to the column types as MySQL does, so the rows it holds
+    are the rows the real server would hold. It can refuse LOAD DATA (as a server with local_infile disabled does) and fail
+    INSERTs, to check the insert_row() fallback and that a failed import leaves the previous table as it was.
+
+A GRID-like CSV file of each table is generated in a temporary directory, with the values the import has to handle:
+    numbers, values which aren't numbers, empty values, and text with tabs, newlines, carriage returns, backslashes,
+    quotes and a literal "\\N". The imported rows must equal the rows of the CSV file, read with the csv module.
+
+Commands:
+    run: Import the generated tables with LOAD DATA and with the insert_row() fallback, and print the results as JSON.
+        Fails if any imported row differs from the CSV file, or if a failed import changed the table.
+
+Usage:
+    python3 benchmarks/grid_loader.py run [--rows 20000] [--chunk-size 5000]
+"""
+
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir  = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+
+from configuration.config import Config
+import utils.documentCollector.grid as grid_module
+
+# MySQL types of the typed GRID columns (see grid.generateTables())
+column_types = {'lat': float, 'lng': float, 'geonames_city_id': int}
+
+# Text values which must be imported unchanged
+tricky_text = ['tab\there', 'new\nline', 'carriage\r\nreturn', 'back\\slash', '\\N', 'ends with a backslash \\',
+               'quote " and comma,', 'Zürich 東京', '  padded  ']
+
+
+class StandInDatabase:
+    """
+    In-memory stand-in for MySQLDatabase, with the queries used by grid.load_table().
+    <local_infile> if False, load_data() fails as it does when local_infile is disabled on the server.
+    <fail_insert_after> number of insert_row() calls which succeed before the others fail. None to never fail.
+    """
+    def __init__(self, local_infile=True, fail_insert_after=None):
+        self.local_infile = local_infile
+        self.fail_insert_after = fail_insert_after
+        self.tables = {}  # table name -> list of rows (dictionaries of column values)
+        self.calls = {'load_data': 0, 'insert_row': 0}
+
+    @staticmethod
+    def name(table):
+        return table.replace('`', '')
+
+    def query(self, query, parameters=None, format='cols', threaded=False):
+        query = ' '.join(query.split())
+        if match := re.fullmatch(r"DROP TABLE (IF EXISTS )?(\S+)", query):
+            if self.name(match.group(2)) not in self.tables:
+                return None if not match.group(1) else []
+            del self.tables[self.name(match.group(2))]
+            return []
+        if match := re.fullmatch(r"CREATE TABLE (\S+) LIKE (\S+)", query):
+            new, like = self.name(match.group(1)), self.name(match.group(2))
+            if like not in self.tables or new in self.tables:
+                return None
+            self.tables[new] = []
+            return []
+        if match := re.fullmatch(r"RENAME TABLE (.+)", query):
+            renames = [[self.name(name) for name in pair.split(' TO ')] for pair in match.group(1).split(', ')]
+            tables = dict(self.tables)
+            for old, new in renames:  # renamed in order, and all or none of them
+                if old not in tables or new in tables:
+                    return None
+                tables[new] = tables.pop(old)
+            self.tables = tables
+            return []
+        raise NotImplementedError(f"Query not supported by the stand-in: {query}")
+
+    def convert(self, column, value):
+        """ Value stored in a column, as MySQL converts it (sql_mode is cleared, so bad values are stored as 0) """
+        if value is None or column not in column_types:
+            return value
+        try:
+            return column_types[column](value)
+        except ValueError:
+            return column_types[column](0)
+
+    def load_data(self, table, columns, path, threaded=False):
+        """ LOAD DATA LOCAL INFILE in the default format (see MySQLDatabase.load_data()) """
+        self.calls['load_data'] += 1
+        table = self.name(table)
+        if not self.local_infile or table not in self.tables:
+            return None
+        escapes = {'t': '\t', 'n': '\n', 'r': '\r', '0': '\0', 'b': '\b', 'Z': '\x1a'}
+
+        def unescape(field):
+            if field == '\\N':
+                return None
+            return re.sub(r"\\(.)", lambda match: escapes.get(match.group(1), match.group(1)), field, flags=re.S)
+
+        with open(path, encoding='utf-8', newline='') as f:
+            lines = f.read().split('\n')
+        assert lines[-1] == '', "The last line of a LOAD DATA file must end with a newline"
+        for line in lines[:-1]:
+            # fields are separated by tabs which aren't escaped. Escaped tabs never appear as a raw tab.
+            fields = [unescape(field) for field in line.split('\t')]
+            assert len(fields) == len(columns), f"{len(fields)} fields for {len(columns)} columns: {line!r}"
+            self.tables[table].append({column: self.convert(column, value) for column, value in zip(columns, fields)})
+        return []
+
+    def insert_row(self, table, columns, parameters, threaded=False, db_insert=True, update=False):
+        self.calls['insert_row'] += 1
+        table = self.name(table)
+        if table not in self.tables:
+            return None
+        if self.fail_insert_after is not None and self.calls['insert_row'] > self.fail_insert_after:
+            return None
+        for values in parameters:
+            self.tables[table].append({column: self.convert(column, value) for column, value in zip(columns, values)})
+        return []
+
+
+def generate_csv(path, columns, rows):
+    """ Write a GRID-like CSV file of <rows> rows. Returns the number of values which aren't numbers in typed columns. """
+    bad = 0
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f, quoting=csv.QUOTE_MINIMAL)
+        writer.writerow(columns)
+        for i in range(rows):
+            values = []
+            for j, column in enumerate(columns):
+                case = (i + j) % 13
+                if column == 'grid_id':
+                    values.append(f"grid.{i}.{j}")
+                elif case == 0:
+                    values.append('')  # NULL
+                elif column in column_types and case == 1:
+                    values.append('n/a')  # not a number
+                    bad += 1
+                elif column in ('lat', 'lng'):
+                    values.append(repr(round((i % 180) - 90 + j / 7, 6)))
+                elif column == 'geonames_city_id':
+                    values.append(str(1000000 + i))
+                else:
+                    values.append(tricky_text[(i + j) % len(tricky_text)] if case % 2 else f"{column} {i}")
+            writer.writerow(values)
+    return bad
+
+
+def expected_rows(path, columns):
+    """ Rows that must be imported from a CSV file: empty values and values which can't be converted are NULL """
+    rows = []
+    with open(path, encoding='utf-8', newline='') as f:
+        for row in csv.DictReader(f, skipinitialspace=True):
+            values = {}
+            for column in columns:
+                value = row[column] or None
+                if value is not None and column in column_types:
+                    try:
+                        value = column_types[column](value)
+                    except ValueError:
+                        value = None
+                values[column] = value
+            rows.append(values)
+    return rows
+
+
+def make_loader(directory, db):
+    """ grid loader which reads the CSV files from <directory> and imports them into the stand-in <db> """
+    config = type('GridCheckConfig', (Config,), {'data_directory': directory})
+    original = grid_module.MySQLDatabase
+    grid_module.MySQLDatabase = lambda: db  # grid() connects to the database it creates
+    try:
+        return grid_module.grid(config=config)
+    finally:
+        grid_module.MySQLDatabase = original
+
+
+def import_tables(loader, db, expected, chunk_size):
+    """ Import every table with grid.load_table(). Returns the rows imported, rows per second and mismatched rows. """
+    previous = {'grid_id': 'previous import'}
+    rows, mismatches, t0 = 0, 0, time.time()
+    loader.db = db
+    for table, info in loader.tables.items():
+        db.tables[f"grid.{table}"] = [{**dict.fromkeys(info['columns']), **previous}]
+        rows += loader.load_table(table, info, chunk_size)
+        imported = db.tables[f"grid.{table}"]
+        mismatches += sum(a != b for a, b in zip(imported, expected[table])) + abs(len(imported) - len(expected[table]))
+    seconds = time.time() - t0
+
+    leftover = [table for table in db.tables if table.endswith(('_load', '_old'))]
+    leftover += [file for file in os.listdir(f"{loader.config.data_directory}/GRID/unzipped/full_tables") if file.endswith('.load')]
+    return {'rows': rows, 'seconds': round(seconds, 3), 'rows_per_second': round(rows / seconds, 1),
+            'mismatches': mismatches, 'leftover': leftover, 'calls': db.calls}
+
+
+def run(args):
+    directory = tempfile.mkdtemp(prefix='grid_loader_')
+    try:
+        loader = make_loader(directory, StandInDatabase())
+        csv_directory = f"{directory}/GRID/unzipped/full_tables"
+        os.makedirs(csv_directory)
+
+        # typed conversion: the values convert_rows() can't convert are the values which aren't numbers
+        expected, bad, conversion_errors = {}, 0, 0
+        for table, info in loader.tables.items():
+            path = f"{csv_directory}/{table}.csv"
+            bad += generate_csv(path, info['columns'], args.rows)
+            expected[table] = expected_rows(path, info['columns'])
+            with open(path, encoding='utf-8', newline='') as f:
+                _, errors = loader.convert_rows(list(csv.DictReader(f, skipinitialspace=True)), info['columns'], info.get('types', {}))
+            conversion_errors += errors
+
+        results = {'rows_per_table': args.rows, 'chunk_size': args.chunk_size,
+                   'values_not_numbers': bad, 'conversion_errors': conversion_errors}
+
+        # bulk loaded, then inserted when LOAD DATA fails
+        results['load_data'] = import_tables(loader, StandInDatabase(), expected, args.chunk_size)
+        results['insert_row'] = import_tables(loader, StandInDatabase(local_infile=False), expected, args.chunk_size)
+
+        # an import which fails part way (the second of two chunks) leaves the previous table as it was
+        db = StandInDatabase(local_infile=False, fail_insert_after=1)
+        db.tables['grid.addresses'] = previous = [{'grid_id': 'previous import'}]
+        loader.db = db
+        try:
+            loader.load_table('addresses', loader.tables['addresses'], max(1, args.rows // 2))
+            failed = False
+        except Exception:
+            failed = True
+        results['failed_import'] = {'raised': failed, 'table_unchanged': db.tables.get('grid.addresses') == previous,
+                                    'leftover': [table for table in db.tables if table != 'grid.addresses']}
+        return results
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check and time the GRID import against an in-memory MySQL stand-in.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='Import generated GRID tables and compare them with the CSV files.')
+    run_parser.add_argument('--rows', type=int, default=20000, help='Rows of each generated table.')
+    run_parser.add_argument('--chunk-size', type=int, default=5000, help='Rows read and loaded at a time.')
+
+    args = parser.parse_args()
+    results = run(args)
+    print(json.dumps(results, indent=4))
+    assert results['conversion_errors'] == results['values_not_numbers'], "convert_rows() didn't count every value it couldn't convert"
+    for method in ('load_data', 'insert_row'):
+        assert not results[method]['mismatches'], f"Rows imported with {method} differ from the CSV files"
+        assert not results[method]['leftover'], f"Tables or load files left after importing with {method}"
+    assert not results['load_data']['calls']['insert_row'], "Rows were inserted although LOAD DATA succeeded"
+    assert results['insert_row']['calls']['insert_row'], "The insert_row() fallback wasn't used when LOAD DATA failed"
+    assert results['failed_import']['raised'], "A failed import didn't raise"
+    assert results['failed_import']['table_unchanged'], "A failed import changed the table"
+    assert not results['failed_import']['leftover'], "A failed import left its load table"
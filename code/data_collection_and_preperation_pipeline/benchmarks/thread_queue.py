@@ -0,0 +1,89 @@
+import os
+import sys
+import inspect
+import time
+import random
+import json
+from multiprocessing.pool import ThreadPool
+
+"""
+Micro-benchmark of utils.base.ThreadQueue against the previous polling implementation.
+
+Submits a number of short tasks and measures how long each result waits between its function finishing
+    and being handed back by next(), as well as the total time to drain the queue.
+
+Usage: python3 benchmarks/thread_queue.py [tasks] [threads]
+"""
+
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir  = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+
+from utils.base import ThreadQueue
+
+
+class PollingThreadQueue:
+    """ The previous ThreadQueue, which polled every pending result and slept when none were ready """
+    def __init__(self, threads=3):
+        self.thread_pool = ThreadPool(threads)
+        self.results = {}
+        self.ID = 0
+
+    def submit(self, func, args):
+        self.results[self.ID] = self.thread_pool.apply_async(func, args)
+        self.ID += 1
+
+    def next(self, wait=0.1):
+        while len(self.results):
+            for ID, result in self.results.items():
+                if result.ready():
+                    del self.results[ID]
+                    return result.get()
+            time.sleep(wait)
+        return None
+
+
+def task(duration):
+    """ Sleep for the given duration, then return the time it finished """
+    time.sleep(duration)
+    return time.time()
+
+
+def run(queue, durations):
+    """ Submit all durations to the queue and drain it. Returns stats about result latency. """
+    t0 = time.time()
+    for duration in durations:
+        queue.submit(task, [duration])
+
+    latencies = []  # seconds between each task finishing and its result being retrieved
+    finished = queue.next()
+    while finished is not None:
+        latencies.append(time.time() - finished)
+        finished = queue.next()
+    total = time.time() - t0
+
+    latencies.sort()
+    return {
+        'total_seconds': round(total, 4),
+        'mean_latency_ms': round(1000 * sum(latencies) / len(latencies), 3),
+        'p95_latency_ms': round(1000 * latencies[int(0.95 * (len(latencies) - 1))], 3),
+        'max_latency_ms': round(1000 * latencies[-1], 3),
+    }
+
+
+if __name__ == '__main__':
+    tasks = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+
+    random.seed(0)
+    durations = [random.uniform(0, 0.005) for _ in range(tasks)]  # 0-5ms tasks
+    ideal = sum(durations) / threads  # time to drain with no overhead at all
+
+    results = {
+        'tasks': tasks,
+        'threads': threads,
+        'ideal_seconds': round(ideal, 4),
+        'polling': run(PollingThreadQueue(threads), durations),
+        'completion': run(ThreadQueue(threads), durations),
+    }
+    print(json.dumps(results, indent=4))
@@ -5,13 +5,23 @@
 # When run on an Unbuntu 20.04 portal machine, this
 # script will configure the machine with all requirements
 # needed to run the NLP pipeline of BRAINWORKS
+#
+# Usage: bash setup.sh [BUNDLE]
+# BUNDLE is the directory of the environment bundle on
+# the shared volume (see Cluster.setup_environ()): the
+# wheels of every Python package, Java and CoreNLP.
+# It is built the first time, then reused, so later
+# deployments don't download or build anything.
+# Without a BUNDLE, everything is downloaded directly.
 #####################################################
+set -e
+BUNDLE=$1
 
 ######################################################
 # 1. Update the Machine and install Python dependencies
 ######################################################
 sudo apt-get update -y
-sudo apt-get net-tools
+sudo apt-get install net-tools -y
 sudo apt-get install python3.8-venv -y
 sudo apt install libcairo2-dev pkg-config python3-dev -y
 
@@ -19,31 +29,79 @@ sudo apt install libcairo2-dev pkg-config python3-dev -y
 ######################################################
 # 2. Create output directory structure
 ######################################################
-mkdir output; mkdir output/out; mkdir output/err
-mkdir module_src; mkdir module_src/java
+mkdir -p output/out output/err
+mkdir -p module_src/java
+cp -r privatemodules ~/  # copy privatemodules to the home directory
+
+# Python packages, installed in this order
+install_steps=(
+    "--upgrade pip"
+    "setuptools==44.0.0"
+    "fsspec==2021.9.0"
+    "datasets==1.12.1"
+    "wheel==0.34.2"
+    "allennlp==2.7.0"
+    "allennlp-models==2.7.0"
+    "-r ../requirements/cluster_requirements.txt"
+)
+
+######################################################
+# 3. Build the environment bundle if it doesn't exist
+######################################################
+if [ -n "$BUNDLE" ] && [ ! -f "$BUNDLE/COMPLETE" ]; then
+    echo "Building environment bundle $BUNDLE"
+    build="$BUNDLE.partial.$$"
+    rm -rf "$build"; mkdir -p "$build/wheelhouse" "$build/models"
+
+    # Install the packages as usual in a temporary virtual environment, then save a wheel of every installed package
+    python3 -m venv "$build/venv"
+    source "$build/venv/bin/activate"
+    for step in "${install_steps[@]}"; do pip install $step; done
+    pip freeze --all --exclude-editable | grep -v "^pkg[-_]resources" > "$build/requirements.lock"
+    pip wheel --no-deps --wheel-dir "$build/wheelhouse" -r "$build/requirements.lock"
+
+    # Pack Java and CoreNLP
+    wget -q -O "$build/models/jdk-17.0.1_linux-x64_bin.tar.gz" https://download.oracle.com/java/17/archive/jdk-17.0.1_linux-x64_bin.tar.gz
+    python3 -c "import stanza; stanza.install_corenlp(dir='$build/corenlp')"
+    tar -cf "$build/models/corenlp.tar" -C "$build" corenlp
+    deactivate
+    rm -rf "$build/venv" "$build/corenlp"
+
+    # Checksums of the bundle, verified before each use. The bundle is complete once moved into place.
+    (cd "$build" && find wheelhouse models requirements.lock -type f -print0 | xargs -0 sha256sum > SHA256SUMS)
+    touch "$build/COMPLETE"
+    mv -T "$build" "$BUNDLE" || rm -rf "$build"  # another machine finished building it first
+fi
 
 ######################################################
-# 3. Install Java Dependencies
+# 4. Install Java Dependencies
 ######################################################
-cd module_src/java
-wget https://download.oracle.com/java/17/archive/jdk-17.0.1_linux-x64_bin.tar.gz
-tar zxvf jdk-17.0.1_linux-x64_bin.tar.gz
-rm *.tar.gz
-cd ../../  # back out to cluster/
-cp -r privatemodules ~/privatemodules  # copy privatemodules to the home directory
+if [ -n "$BUNDLE" ]; then
+    (cd "$BUNDLE" && sha256sum --quiet -c SHA256SUMS)  # the bundle is intact
+    tar zxf "$BUNDLE/models/jdk-17.0.1_linux-x64_bin.tar.gz" -C module_src/java
+    tar xf "$BUNDLE/models/corenlp.tar" -C ~ --transform 's,^corenlp,stanza_corenlp,'
+else
+    cd module_src/java
+    wget https://download.oracle.com/java/17/archive/jdk-17.0.1_linux-x64_bin.tar.gz
+    tar zxvf jdk-17.0.1_linux-x64_bin.tar.gz
+    rm *.tar.gz
+    cd ../../  # back out to cluster/
+fi
 
 ######################################################
-# 3. Create and bind to python virtual environemnt
+# 5. Create and bind to python virtual environemnt
 ######################################################
+if [ -n "$BUNDLE" ] && [ "$(cat venv/.bundle 2>/dev/null)" == "$BUNDLE" ]; then
+    echo "Virtual environment is already installed from $BUNDLE"
+    exit 0
+fi
+rm -rf venv
 python3 -m venv venv
 source venv/bin/activate
-pip install --upgrade pip
-pip install setuptools==44.0.0
-pip install fsspec==2021.9.0
-pip install datasets==1.12.1
-pip install wheel==0.34.2
-pip install allennlp==2.7.0
-pip install allennlp-models==2.7.0
-pip install -r ../requirements/cluster_requirements.txt
-python3 -c "import stanza; stanza.install_corenlp()"
-
+if [ -n "$BUNDLE" ]; then
+    pip install --no-index --no-deps "$BUNDLE"/wheelhouse/*.whl
+    echo "$BUNDLE" > venv/.bundle
+else
+    for step in "${install_steps[@]}"; do pip install $step; done
+    python3 -c "import stanza; stanza.install_corenlp()"
+fi
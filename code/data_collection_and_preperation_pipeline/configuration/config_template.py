@@ -40,6 +40,7 @@ class Cluster:
     name = "slurm-cluster"
     storage_size = 100  # GiB
     storage_path = "/shared"
+    volume_id = ""  # existing EBS volume to mount at storage_path, which keeps cached environment bundles between clusters. A new volume if empty.
 
     os = "ubuntu2004"
     head_instance = "t2.2xlarge"  # EC2 instnace type for the head node
@@ -89,8 +90,11 @@ class Config:
     ner_models = ["en_core_sci_scibert"]  # list of SciSpacy NER models
 
     # CoreNLP Server
-    CoreNLP_memory = "8G"
-    CoreNLP_endpoint = 'http://localhost:9000'
+    CoreNLP_servers = 1  # number of CoreNLP servers per node, each in its own JVM
+    CoreNLP_memory = "8G"  # heap of each server
+    CoreNLP_recycle_memory = 1.5  # restart a server when its RSS exceeds this multiple of its heap
+    CoreNLP_endpoint = 'http://localhost:9000'  # endpoint of the first server. Each other server uses the next port.
+    CoreNLP_max_chars = 4000  # longer documents are split into groups of sentences, annotated separately
     CoreNLP_properties = {  # CoreNLP Server properties
         "annotators": "tokenize,ssplit,pos,lemma,depparse,openie",  # OpenIE Configuration
         "openie.max_entailments_per_clause": "1",
@@ -1,3 +1,4 @@
 from .utils import download_grid_data
 from .parse import parse_affil
-from .matcher import match_affil
+from .cache import ParseCache
+from .matcher import match_affil, GridMatcher
@@ -0,0 +1,157 @@
+import os
+import json
+import sqlite3
+import hashlib
+from threading import Lock
+from collections import OrderedDict
+
+from .parse import parse_affil
+
+
+def parser_version():
+    """
+    Checksum of the keyword lists and the parser code. Cached results are only valid for the version they were parsed with.
+    """
+    checksum = hashlib.sha1()
+    directory = os.path.dirname(os.path.abspath(__file__))
+    for name in ("keywords.py", "parse.py"):
+        with open(os.path.join(directory, name), "rb") as f:
+            checksum.update(f.read())
+    return checksum.hexdigest()
+
+
+class ParseCache:
+    """
+    Memoizes parse_affil(), keyed by the SHA-1 of the affiliation string.
+    Results are kept in an in-process LRU of <size> entries, backed by an SQLite file at <path> which is shared by
+        every run and process using the same path. Without a path only the in-process LRU is used.
+    The SQLite file is cleared when it was filled by a different version of the parser (see parser_version()).
+    New results are written to the file in batches of <flush_size>, or when flush() is called.
+    """
+
+    def __init__(self, path=None, size=100000, flush_size=1000):
+        self.path = path
+        self.size = size
+        self.flush_size = flush_size
+        self.version = parser_version()
+
+        self.memory = OrderedDict()  # key -> parsed affiliation, least recently used first
+        self.pending = dict()  # results not yet written to the file
+        self.lock = Lock()
+        self.connection = None
+        self.pid = None  # process which opened the connection. SQLite connections can't be used across a fork.
+
+        # counts of lookups since the last call to stats(reset=True)
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def connect(self):
+        """ The SQLite connection of this process, opened (and cleared if of another version) on first use """
+        if self.pid == os.getpid():
+            return self.connection
+        self.pid = os.getpid()
+        self.pending = dict()  # pending results belong to the process which parsed them
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        connection = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")  # readers in other processes don't block on writers
+        connection.execute("PRAGMA synchronous=NORMAL")
+        with connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+            connection.execute("CREATE TABLE IF NOT EXISTS parsed (key TEXT PRIMARY KEY, value TEXT) WITHOUT ROWID")
+            row = connection.execute("SELECT value FROM meta WHERE name = 'version'").fetchone()
+            if row is None or row[0] != self.version:
+                connection.execute("DELETE FROM parsed")
+                connection.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)", [self.version])
+        self.connection = connection
+        return connection
+
+    def remember(self, key, parsed):
+        """ Add a result to the in-process LRU """
+        self.memory[key] = parsed
+        if len(self.memory) > self.size:
+            self.memory.popitem(last=False)
+
+    def get(self, key):
+        """ The cached result of the given key, or None """
+        with self.lock:
+            parsed = self.memory.get(key)
+            if parsed is not None:
+                self.memory.move_to_end(key)
+                self.memory_hits += 1
+                return parsed
+
+            if self.path:
+                parsed = self.pending.get(key)
+                if parsed is None:
+                    row = self.connect().execute("SELECT value FROM parsed WHERE key = ?", [key]).fetchone()
+                    parsed = json.loads(row[0]) if row is not None else None
+                if parsed is not None:
+                    self.remember(key, parsed)
+                    self.disk_hits += 1
+                    return parsed
+
+            self.misses += 1
+            return None
+
+    def put(self, key, parsed):
+        """ Cache a new result """
+        with self.lock:
+            self.remember(key, parsed)
+            if self.path:
+                self.pending[key] = parsed
+        if self.path and len(self.pending) >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        """ Write pending results to the SQLite file """
+        with self.lock:
+            if not self.path or not self.pending:
+                return
+            connection = self.connect()
+            with connection:
+                connection.executemany("INSERT OR IGNORE INTO parsed VALUES (?, ?)",
+                                       [(key, json.dumps(parsed)) for key, parsed in self.pending.items()])
+            self.pending = dict()
+
+    def parse(self, affil_text: str):
+        """ parse_affil() of the given affiliation string, from the cache if it was parsed before """
+        key = hashlib.sha1(affil_text.encode("utf-8")).hexdigest()
+        parsed = self.get(key)
+        if parsed is None:
+            parsed = parse_affil(affil_text)
+            self.put(key, parsed)
+        return dict(parsed)  # a copy, so callers can change it without changing the cache
+
+    def stats(self, reset=False):
+        """ Counts of lookups found in memory, found on disk and parsed, and the percentage found in either """
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        stats = {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": round(100 * (self.memory_hits + self.disk_hits) / lookups, 1) if lookups else 0.0,
+        }
+        if reset:
+            self.memory_hits = self.disk_hits = self.misses = 0
+        return stats
+
+    def __getstate__(self):
+        """ Only the settings are copied to other processes, which open their own connection """
+        state = self.__dict__.copy()
+        state.update(memory=OrderedDict(), pending=dict(), lock=None, connection=None, pid=None,
+                     memory_hits=0, disk_hits=0, misses=0)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = Lock()
+
+    def close(self):
+        """ Write pending results and close the SQLite connection """
+        self.flush()
+        if self.connection is not None and self.pid == os.getpid():
+            self.connection.close()
+        self.connection = None
+        self.pid = None
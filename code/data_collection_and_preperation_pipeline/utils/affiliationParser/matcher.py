@@ -4,44 +4,161 @@ import csv
 from pathlib import Path
 import subprocess
 import recordlinkage
-from recordlinkage.index import Full
 
 import numpy as np
 import pandas as pd
+from scipy import sparse
 from nltk.tokenize import WhitespaceTokenizer
 
 from .utils import download_grid_data
 from .parse import parse_affil, preprocess
 
+# GRID country names of the countries which parse_affil() names differently
+COUNTRY_ALIASES = {
+    "united states of america": "united states",
+    "korea": "south korea",
+    "czech republic": "czechia",
+}
 
-def match_affil(affiliation: str, k: int = 1):
+
+class GridMatcher:
     """
-    Match affliation to GRID dataset.
-    Return a da
+    Matches parsed affiliations to GRID institutions.
+    The GRID dataset is loaded once into a token index: each institution name is a row of a sparse matrix of its name
+        tokens, weighted by inverse document frequency and normalized, so the dot product of two rows is their cosine similarity.
+    Candidates of an affiliation are the institutions which share its rarest name tokens (the blocks), in the same
+        country when the country is known. Only the candidates are scored:
+        0.6 * name similarity + 0.2 * location similarity (Jaro-Winkler) + 0.2 * country similarity (Jaro-Winkler)
+    <csv_path> GRID CSV (downloaded with download_grid_data() by default).
+    <max_df> tokens in more than this share of all institution names ("university", "of", ...) are too common to block on.
+    <max_candidates> most candidates of an affiliation which are scored, those sharing the most rare tokens first.
     """
-    csv_path = download_grid_data()
-    grid_df = pd.read_csv(csv_path, header=0, names=["grid_id", "institution", "city", "state", "country"])
-    grid_df["location"] = grid_df.city + " " + grid_df.state
 
-    parsed_affil = parse_affil(affiliation)
-    print(parsed_affil)
-    df = pd.DataFrame([parsed_affil])
+    def __init__(self, csv_path=None, max_df=0.01, max_candidates=50):
+        self.max_candidates = max_candidates
+
+        csv_path = csv_path or download_grid_data()
+        grid_df = pd.read_csv(csv_path, header=0, names=["grid_id", "institution", "city", "state", "country"],
+                              dtype=str, keep_default_na=False)
+        grid_df["location"] = (grid_df.city + " " + grid_df.state).str.strip()
+        grid_df["country"] = grid_df.country.str.lower()
+        self.grid_df = grid_df
+
+        # token index
+        self.vocabulary = dict()
+        rows, cols = [], []
+        for i, name in enumerate(grid_df.institution):
+            for token in set(preprocess(name).split()):
+                rows.append(i)
+                cols.append(self.vocabulary.setdefault(token, len(self.vocabulary)))
+        shape = (len(grid_df), len(self.vocabulary))
+        postings = sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=shape)
+
+        self.df = np.asarray(postings.sum(axis=0)).ravel()  # number of institutions with each token
+        self.idf = np.log(len(grid_df) / np.maximum(self.df, 1))
+        self.max_df = max(1, int(max_df * len(grid_df)))
+        self.names = self.normalize(postings.multiply(self.idf).tocsr())  # institution x token name vectors
+        self.postings = postings.tocsc()  # institutions of each token
+
+        # country blocks
+        countries = grid_df.country.unique()
+        self.country_ids = {country: i for i, country in enumerate(countries)}
+        self.country_of = grid_df.country.map(self.country_ids).to_numpy()
+
+        self.compare = recordlinkage.Compare()
+        self.compare.string("location", "location", method="jarowinkler", label="location")
+        self.compare.string("country", "country", method="jarowinkler", label="country")
+
+    @staticmethod
+    def normalize(matrix):
+        """ Scale each row of a sparse matrix to unit length """
+        norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+        return sparse.diags(1 / np.maximum(norms, 1e-12)).dot(matrix).tocsr()
+
+    def vectorize(self, names):
+        """ Normalized token vectors of the given institution names, with tokens unknown to GRID left out """
+        rows, cols = [], []
+        for i, name in enumerate(names):
+            tokens = {self.vocabulary.get(token) for token in preprocess(name).split()}
+            tokens.discard(None)
+            rows += [i] * len(tokens)
+            cols += tokens
+        vectors = sparse.csr_matrix((self.idf[cols], (rows, cols)), shape=(len(names), len(self.vocabulary)))
+        return self.normalize(vectors)
+
+    def candidates(self, vector, country):
+        """ Indexes of the GRID institutions sharing the rarest tokens of a name vector, in the given country if any """
+        tokens = vector.indices
+        if not len(tokens):
+            return np.array([], dtype=int)
+        rare = tokens[self.df[tokens] <= self.max_df]
+        if not len(rare):  # only common tokens - block on the least common of them
+            rare = tokens[[np.argmin(self.df[tokens])]]
 
-    indexer = recordlinkage.Index()
-    indexer.add(Full())
-    candidate_links = indexer.index(df, grid_df)
+        institutions = np.concatenate([self.postings.indices[self.postings.indptr[t]:self.postings.indptr[t + 1]] for t in rare])
+        weights = np.repeat(self.idf[rare], [self.postings.indptr[t + 1] - self.postings.indptr[t] for t in rare])
+        institutions, inverse = np.unique(institutions, return_inverse=True)
+        shared = np.bincount(inverse, weights=weights)  # summed weight of the rare tokens each institution shares
 
-    # recordlinkage comparer
-    compare = recordlinkage.Compare()
-    compare.exact("institution", "institution")
-    compare.string("location", "location", method="jarowinkler")
-    compare.string("country", "country", method="jarowinkler")
+        country_id = self.country_ids.get(country)
+        if country_id is not None:
+            in_country = self.country_of[institutions] == country_id
+            if in_country.any():  # otherwise the country could be wrong, so keep all
+                institutions, shared = institutions[in_country], shared[in_country]
 
-    features_df = compare.compute(candidate_links, df, grid_df)
-    features_df["score"] = np.average(features_df, axis=1, weights=[0.6, 0.2, 0.2])
+        if len(institutions) > self.max_candidates:
+            top = np.argpartition(-shared, self.max_candidates - 1)[:self.max_candidates]
+            institutions = institutions[top]
+        return institutions
 
-    topk_df = features_df[["score"]].reset_index().sort_values("score", ascending=False).head(k)
-    topk_df = topk_df.merge(grid_df.reset_index(), left_on="level_1", right_on="index").\
-        drop(labels=["level_0", "level_1", "location"], axis=1)
+    def match(self, affiliations, k=1, min_score=0):
+        """
+        Match many affiliations at once. <affiliations> are affiliation strings or dicts returned by parse_affil().
+        Returns a list of the <k> best GRID matches of each affiliation scoring at least <min_score>, as dicts of
+            "grid_id", "institution", "city", "state", "country" and "score". Empty if there are no candidates.
+        """
+        parsed = [parse_affil(a) if isinstance(a, str) else a for a in affiliations]
+        queries = pd.DataFrame({
+            "institution": [p.get("institution") or p.get("full_text") or "" for p in parsed],
+            "location": [p.get("location") or "" for p in parsed],
+            "country": [(p.get("country") or "").lower() for p in parsed],
+        })
+        vectors = self.vectorize(queries.institution.tolist())
 
-    return topk_df.to_dict(orient="records")
+        # candidate pairs of all affiliations
+        pairs = [(i, c) for i in range(len(queries))
+                 for c in self.candidates(vectors[i], COUNTRY_ALIASES.get(queries.country[i], queries.country[i]))]
+        results = [[] for _ in range(len(queries))]
+        if not pairs:
+            return results
+        query_ids, grid_ids = map(np.array, zip(*pairs))
+
+        # score the pairs
+        features = self.compare.compute(pd.MultiIndex.from_arrays([query_ids, grid_ids]), queries, self.grid_df)
+        name_score = np.asarray(vectors[query_ids].multiply(self.names[grid_ids]).sum(axis=1)).ravel()
+        scores = 0.6 * name_score + 0.2 * features["location"].to_numpy() + 0.2 * features["country"].to_numpy()
+
+        # k best of each affiliation
+        order = np.lexsort((-scores, query_ids))  # by affiliation, then best score first
+        columns = ["grid_id", "institution", "city", "state", "country"]
+        for j in order:
+            i = query_ids[j]
+            if len(results[i]) < k and scores[j] >= min_score:
+                match = self.grid_df.iloc[grid_ids[j]][columns].to_dict()
+                match["score"] = round(float(scores[j]), 4)
+                results[i].append(match)
+        return results
+
+
+grid_matcher = None  # loaded by the first match_affil() call
+
+
+def match_affil(affiliation: str, k: int = 1):
+    """
+    Match affliation to GRID dataset.
+    Return a list of the k best matches (see GridMatcher.match())
+    """
+    global grid_matcher
+    if grid_matcher is None:
+        grid_matcher = GridMatcher()
+    return grid_matcher.match([affiliation], k)[0]
@@ -1,7 +1,6 @@
 import re
 import string
 from unidecode import unidecode
-import numpy as np
 from .keywords import *
 from nltk.tokenize import WhitespaceTokenizer
 
@@ -9,6 +8,65 @@ w_tokenizer = WhitespaceTokenizer()
 punct_re = re.compile("[{}]".format(re.escape(string.punctuation)))
 
 
+class KeywordMatcher:
+    """
+    Finds keywords of <groups> (a sequence of keyword sequences) in a text with a single compiled regex, instead of
+        checking each keyword with "keyword in text". Matching is by substring and case sensitive, exactly like "in".
+    The regex is built from a trie of all keywords, so at each position of the text only the keywords which share
+        the characters read so far are followed, and it always matches the longest keyword starting there.
+    """
+
+    def __init__(self, groups):
+        self.groups = [tuple(group) for group in groups]
+        group_of = dict()  # keyword -> index of the first group that has it
+        for i, group in enumerate(self.groups):
+            for keyword in group:
+                group_of.setdefault(keyword, i)
+
+        # a keyword matched at a position means all keywords which are its prefixes match there as well
+        self.first_group = {keyword: min(group_of[keyword[:j]] for j in range(1, len(keyword) + 1) if keyword[:j] in group_of)
+                            for keyword in group_of}
+
+        trie = dict()
+        for keyword in group_of:
+            node = trie
+            for char in keyword:
+                node = node.setdefault(char, dict())
+            node[""] = True  # end of a keyword
+
+        pattern = self.trie_pattern(trie)
+        self.regex = re.compile(pattern)
+        self.all_regex = re.compile(f"(?=({pattern}))")  # zero width, to find the longest keyword at every position
+
+    @classmethod
+    def trie_pattern(cls, node):
+        """ Regex pattern which matches every keyword in the trie <node> """
+        branches = [re.escape(char) + cls.trie_pattern(child) for char, child in sorted(node.items()) if char != ""]
+        if not branches:
+            return ""
+        if len(branches) == 1 and "" not in node:
+            return branches[0]
+        return "(?:" + "|".join(branches) + ")" + ("?" if "" in node else "")
+
+    def search(self, text: str):
+        """ True if any keyword is in the text """
+        return self.regex.search(text) is not None
+
+    def first(self, text: str):
+        """ Index of the first group with a keyword in the text, or None """
+        groups = [self.first_group[match.group(1)] for match in self.all_regex.finditer(text)]
+        return min(groups) if groups else None
+
+
+# keyword lists compiled once
+department_matcher  = KeywordMatcher([DEPARMENT])
+institute_matcher   = KeywordMatcher([INSTITUTE])
+remove_matcher      = KeywordMatcher([REMOVE_INSTITUE])
+states_matcher      = KeywordMatcher([STATES])
+country_matcher     = KeywordMatcher(COUNTRY)
+university_matcher  = KeywordMatcher(UNIVERSITY_ABBR)
+
+
 def preprocess(text: str):
     """
     Function to perform word tokenization
@@ -26,12 +84,13 @@ def replace_institution_abbr(affil_text: str):
     """
     Replace abbreviation with full institution string
     """
-    for university_list in UNIVERSITY_ABBR:
-        for university in university_list:
-            if university in affil_text:
-                affil_text = re.sub(university, university_list[0], affil_text)
-                return affil_text
-    return affil_text
+    i = university_matcher.first(affil_text)
+    if i is None:
+        return affil_text
+    university_list = UNIVERSITY_ABBR[i]
+    for university in university_list:
+        if university in affil_text:
+            return re.sub(university, university_list[0], affil_text)
 
 
 def append_institution_city(affil: str, location: str):
@@ -71,24 +130,18 @@ def find_country(location: str):
     """
     Find country from string
     """
-    location_lower = location.lower()
-    for country in COUNTRY:
-        for c in country:
-            if c in location_lower:
-                return country[0]
-    return ""
+    i = country_matcher.first(location.lower())
+    return COUNTRY[i][0] if i is not None else ""
 
 
 def check_country(affil_text: str):
     """
     Check if any states string from USA or UK
     """
-    for country in ["UK"]:
-        if country in affil_text:
-            return "united kingdom"
-    for state in STATES:
-        if state in affil_text:
-            return "united states of america"
+    if "UK" in affil_text:
+        return "united kingdom"
+    if states_matcher.search(affil_text):
+        return "united states of america"
     return ""
 
 
@@ -127,26 +180,16 @@ def parse_affil(affil_text):
     location    = list()
     departments = list()
 
+    affil_lower = [a.lower() for a in affil_list]
+
     for i, a in enumerate(affil_list):
-        for ins in INSTITUTE:
-            if ins in a.lower() and (not a in affil):
-                affil.append(a)
-                location = affil_list[i + 1 : :]
+        if institute_matcher.search(affil_lower[i]) and (not a in affil):
+            affil.append(a)
+            location = affil_list[i + 1 : :]
 
     # remove unwanted from affliation list and location list
-    pop_index = list()
-    for i, a in enumerate(affil):
-        for rm in REMOVE_INSTITUE:
-            if rm in a.lower() and (not "university" in a.lower()):
-                pop_index.append(i)
-    affil = np.delete(affil, list(set(pop_index))).tolist()
-
-    pop_index = list()
-    for i, l in enumerate(location):
-        for rm in DEPARMENT:
-            if rm in l.lower():
-                pop_index.append(i)
-    location = np.delete(location, list(set(pop_index))).tolist()
+    affil = [a for a in affil if not (remove_matcher.search(a.lower()) and (not "university" in a.lower()))]
+    location = [l for l in location if not department_matcher.search(l.lower())]
 
     affil = ", ".join(affil)
     location = ", ".join(location)
@@ -155,9 +198,8 @@ def parse_affil(affil_text):
     location = re.sub(r"\([^)]*\)", "", location).strip()
 
     for i, a in enumerate(affil_list):
-        for dep in DEPARMENT:
-            if dep in a.lower() and (not a in departments):
-                departments.append(affil_list[i])
+        if department_matcher.search(affil_lower[i]) and (not a in departments):
+            departments.append(a)
     department = ", ".join(departments)
 
     dict_location = parse_location(location)
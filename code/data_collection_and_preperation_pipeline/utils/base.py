@@ -9,8 +9,10 @@ from collections import UserList, UserDict
 import atexit, signal
 
 from multiprocessing import Lock, parent_process, set_start_method, cpu_count
-from multiprocessing.pool import Pool, ThreadPool
-from threading import Thread, Condition
+from multiprocessing.pool import Pool
+from threading import Thread, Semaphore
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
 import pickle
 
 from configuration.config import Config
@@ -255,35 +257,137 @@ class Base:
             return pool.map(func, args, chunks)  # chunks args for each func call
 
 
+class QueueTask:
+    """
+    A single function call submitted to a ThreadQueue.
+    Records when it was submitted, started, and finished (as time.time() timestamps).
+    """
+    def __init__(self, key=None):
+        self.key = key  # optional identifier given to submit()
+        self.future = None  # the Future running this task
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+
+    def run(self, func, args):
+        """ Run the function, recording when it starts and finishes """
+        self.started = time.time()
+        try:
+            return func(*args)
+        finally:
+            self.finished = time.time()
+
+    def result(self):
+        """ Return the value returned by the function. If the function raised an exception, it is raised here. """
+        return self.future.result()
+
+    def cancel(self):
+        """ Cancel this task if it hasn't started running. Returns whether it was cancelled. """
+        return self.future.cancel()
+
+    @property
+    def cancelled(self):
+        return self.future.cancelled()
+
+    @property
+    def wait_time(self):
+        """ Seconds spent waiting for a thread before running """
+        if self.started is None: return None
+        return self.started - self.submitted
+
+    @property
+    def run_time(self):
+        """ Seconds spent running """
+        if self.finished is None: return None
+        return self.finished - self.started
+
+
 class ThreadQueue:
     """
     Unordered queue of function return values from a thread pool.
     Freely submit any number of function calls with submit().
     Retrieve the next available result with next() (blocking). If None is returned, the queue is empty.
     Retrieved results will be returned in order of completion.
+
+    Each task is put on a completion queue by the thread that ran it, so next() wakes up as soon as any result is ready.
+    If <max_pending> is given, submit() blocks while that many tasks have been submitted but not yet retrieved.
+        A thread that both submits and retrieves must retrieve results before the queue fills up (see len()).
     """
-    def __init__(self, threads=3):
+    def __init__(self, threads=3, max_pending=None):
         self.threads = threads
-        self.thread_pool = ThreadPool(threads)
-        self.results = {}  # available items returned, indexed with a unique identifier.
-        self.ID = 0  # incrementing ID for self.results
-        self.condition = Condition()
-
-    def submit(self, func, args):
-        """ submit a function to the queue """
-        self.results[self.ID] = self.thread_pool.apply_async(func, args)  # store async result
-        self.ID += 1
-
-    def next(self, wait=0.1):
-        """ Return the next available result from the queue """
-        while len(self.results):  # while there are items in the queue
-            for ID, result in self.results.items():
-                if result.ready():  # if result completed
-                    del self.results[ID]  # remove from results
-                    return result.get()  # return it
-            time.sleep(wait)
+        self.executor = ThreadPoolExecutor(threads)
+        self.completed = Queue()  # finished tasks, in order of completion
+        self.pending = set()  # tasks submitted but not yet retrieved
+        self.slots = Semaphore(max_pending) if max_pending else None  # bounds the number of pending tasks
+
+    def submit(self, func, args=(), key=None, block=True, timeout=None):
+        """
+        Submit a function to the queue. Returns the QueueTask.
+        <key> optional identifier to attach to the task.
+        When the queue is full, waits for a free slot unless <block> is False.
+            Returns None if no slot was freed (not blocking, or <timeout> seconds passed).
+        """
+        if self.slots is not None:
+            acquired = self.slots.acquire(timeout=timeout) if block else self.slots.acquire(blocking=False)
+            if not acquired: return None
+
+        task = QueueTask(key)
+        self.pending.add(task)
+        task.future = self.executor.submit(task.run, func, args)
+        task.future.add_done_callback(lambda future: self.completed.put(task))  # also called when cancelled
+        return task
+
+    def next_task(self, timeout=None):
+        """
+        Return the next completed QueueTask (blocking). If None is returned, the queue is empty.
+        Cancelled tasks are skipped.
+        If <timeout> is given and no task completes in that many seconds, raises queue.Empty.
+        """
+        while self.pending:
+            task = self.completed.get(timeout=timeout)  # wait for the next task to finish
+            self.pending.discard(task)
+            if self.slots is not None:
+                self.slots.release()
+            if task.cancelled: continue
+            return task
         return None  # queue empty
 
+    def next(self, timeout=None):
+        """
+        Return the next available result from the queue.
+        If the function raised an exception, it is raised here.
+        """
+        task = self.next_task(timeout)
+        if task is None:
+            return None  # queue empty
+        return task.result()
+
+    def as_completed(self, timeout=None):
+        """ Yield every pending QueueTask in order of completion until the queue is empty """
+        task = self.next_task(timeout)
+        while task is not None:
+            yield task
+            task = self.next_task(timeout)
+
+    def cancel(self):
+        """ Cancel all pending tasks that haven't started running. Returns the number of tasks cancelled. """
+        return sum(task.cancel() for task in list(self.pending))
+
+    def close(self, cancel=False):
+        """ Shut down the thread pool once running tasks are finished. Optionally cancel tasks that haven't started. """
+        if cancel: self.cancel()
+        self.executor.shutdown(wait=False)
+
+    def __len__(self):
+        """ Number of tasks submitted but not yet retrieved """
+        return len(self.pending)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close(cancel=True)
+
 
 class StoredObject(Base):
     def __init__(self, name, path="./", populate=None):
@@ -105,11 +105,13 @@ def check_config(email, debug):
 @cli.command()
 @email
 @debug
-def get_doc_field_stats(email, debug):
+@click.option('--sample', type=int, default=None, help="Estimate the statistics from this many randomly chosen papers instead of all of them")
+@click.option('--processes', type=int, default=None, help="Number of processes reading papers (defaults to the number of CPUs)")
+def get_doc_field_stats(sample, processes, email, debug):
     """ Generate JSON of all field statistics in collected publocations """
     t0 = time()
     pm = PubmedCollector(config)  # collector
-    pm.get_document_field_stats()
+    pm.get_document_field_stats(sample=sample, processes=processes)
     elapsed = pm.format_seconds(time()-t0)
     if email: mail.send(subject='Completed Field Stats', body=f"BRAINWORKS has finished analysing field stats of the stored documents.\nElapsed Time: {elapsed}")
 
@@ -135,7 +137,8 @@ def clear_stored_pub_index(debug):
 @click.option('--start', default="1980/01/01", help="The start date for pulling publications. Format: YYYY/MM/DD")
 @click.option('--end', help="The end date for pulling publications. Format: YYYY/MM/DD")
 @click.option('--replace', is_flag=True, default=False, help="Wipe and repopulate the citation table. This ensures all citation stats are up-to-date")
-def collect(start, end, replace, email, test, debug):
+@click.option('--grid', is_flag=True, default=False, help="Link the affiliations of inserted papers to GRID institutions")
+def collect(start, end, replace, grid, email, test, debug):
     """ Activate document collection pipeline """
     t0 = time()
     pm = PubmedCollector(config)  # collector
@@ -147,7 +150,7 @@ def collect(start, end, replace, email, test, debug):
         pm.log("Database connection successful.")
         pm.generateTables()  # create tables if they don't already exist
         pm.bulk_collect(start_date=start, end_date=end, replace=replace, reverse=True)
-        pm.insert_papers(replace=replace, reverse=True, batch_size=1000, limit=50)
+        pm.insert_papers(replace=replace, reverse=True, batch_size=1000, limit=50, match_grid=grid)
         if email: mail.send(subject='Document Collection Test Run Complete', body=f"BRAINWORKS has finished a test run of document collection")
         return
 
@@ -156,7 +159,7 @@ def collect(start, end, replace, email, test, debug):
     end = base.validate_date(end, format="%Y/%m/%d", throw=True) if end else None
     pm.generateTables()  # create tables if they don't already exist
     pm.bulk_collect(start, end_date=end, replace=replace, reverse=True)
-    pm.insert_papers(replace=replace, reverse=True, batch_size=20000)
+    pm.insert_papers(replace=replace, reverse=True, batch_size=20000, match_grid=grid)
 
     if email:
         mail.send(subject='Document Collection Complete',
@@ -167,8 +170,9 @@ def collect(start, end, replace, email, test, debug):
 @email
 @debug
 @click.option('--test', "-t", is_flag=True, default=False, help="Runs on a very small dataset. Useful to check for problems before running with full data.")
-@click.option('--replace', is_flag=True, default=False, help="Wipe and repopulate the citation table. This ensures all citation stats are up-to-date")
-def icite(replace, test, email, debug):
+@click.option('--replace', is_flag=True, default=False, help="Request stats for every paper again. This ensures all citation stats are up-to-date")
+@click.option('--refresh', is_flag=True, default=False, help="Also update the stats of papers that were recently published or cited, and a rotating share of older papers")
+def icite(replace, refresh, test, email, debug):
     """ Collect citation statistics from iCite. Document collection must be run beforehand. """
     t0 = time()
     icite = iCite(config)
@@ -176,17 +180,34 @@ def icite(replace, test, email, debug):
     if test:  # collect papers from a single day
         icite.db.query("SELECT now()")
         icite.log("Database connection successful.")
-        icite.run(replace=replace, test=True)
+        icite.run(replace=replace, refresh=refresh, test=True)
         if email: mail.send(subject='Citation Stat Collection Test Run Complete', body=f"BRAINWORKS has finished a test run of the citation statistics collection")
         return
 
     # normal run
-    icite.run(replace=replace)
+    icite.run(replace=replace, refresh=refresh)
     if email:
         mail.send(subject='Citation Stat Collection Complete',
                   body=f"BRAINWORKS has finished running citation statistics collection.\nTotal Time Taken: {mail.format_seconds(time()-t0)}"
         )
 
+@cli.command()
+@email
+@debug
+@click.option('--processes', type=int, default=None, help="Number of processes matching affiliations (defaults to the number of CPUs)")
+@click.option('--chunk-size', default=1000, help="Number of distinct affiliations matched by a process at a time")
+@click.option('--restart', is_flag=True, default=False, help="Ignore the checkpoint of the last run and check all affiliations again")
+def link_grid(processes, chunk_size, restart, email, debug):
+    """ Link the affiliations already in the database to GRID institutions. Document collection must be run beforehand. """
+    from utils.documentCollector.grid_linker import GridLinker
+    t0 = time()
+    linker = GridLinker(config)
+    linker.run(chunk_size=chunk_size, processes=processes, restart=restart)
+    if email:
+        mail.send(subject='GRID Linking Complete',
+                  body=f"BRAINWORKS has finished linking affiliations to GRID institutions.\nTotal Time Taken: {mail.format_seconds(time()-t0)}"
+        )
+
 @cli.command()
 @email
 @debug
@@ -296,6 +317,26 @@ def full_redshift_dump(email, debug):
                   body=f"BRAINWORKS has finished dumping all RedShift tables to the S3 bucket.\nTotal Time Taken: {rdb.format_seconds(time()-t0)}"
         )
 
+@cli.command()
+@email
+@debug
+@click.option('--model', default="allenai/scibert_scivocab_uncased", help="Name of the transformer model used to embed the concepts")
+@click.option('--dim', type=int, default=None, help="Reduce the concept vectors to this many dimensions before indexing (defaults to the full model dimensions)")
+@click.option('--batch-size', default=10000, help="Number of concepts embedded at a time")
+def concept_index(model, dim, batch_size, email, debug):
+    """ Build the nearest neighbour index over the embeddings of all concepts, used for similar concept queries in the web application """
+    from utils.extraction.embedding import EmbeddingModel  # imported here so torch is only loaded for this command
+    from utils.extraction.concept_index import ConceptIndex
+    t0 = time()
+
+    index = ConceptIndex(EmbeddingModel(model), dim=dim)
+    index.build(batch_size=batch_size)
+
+    if email:
+        mail.send(subject='Concept Index Complete',
+                  body=f"BRAINWORKS has finished building the concept index.\nIndex: {index.path('.hnsw')}\nTotal Time Taken: {mail.format_seconds(time()-t0)}"
+        )
+
 @cli.command()
 @email
 @debug
@@ -414,7 +455,7 @@ def run_month(email, debug):
     pm.bulk_collect(start, end_date=end, replace=False, reverse=True)
     pm.insert_papers(replace=False, reverse=True, batch_size=20000)
 
-    icite.run(replace=True)  # run iCite
+    icite.run(refresh=True)  # run iCite on new papers and those whose stats are likely to have changed
     ex.run(replace=False)  # run exporter data
 
     cluster.deploy(cluster.max_nodes)  # deploy cluster with 100 nodes
@@ -1,7 +1,15 @@
-from configuration.config import config
+from utils.base import Base
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config as BotoConfig
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from pprint import pprint
+import tempfile
+import tarfile
+import hashlib
+import sqlite3
 import boto3
-import re
-import glob
+import time
+import os
 
 ################################################################################################
 # To use this library, we assume that:
@@ -9,33 +17,29 @@ import glob
 # 0. You have an IAM account
 # 1. You created an S3 bucket and S3 Access point
 # 2. You have properly configured permissions on the bucket and the access points; The bucket access point has your IAM as a permitted user.
-# 2. You have attached a permissions policy to the IAM that enables access to S3 and/or the bucket 
+# 2. You have attached a permissions policy to the IAM that enables access to S3 and/or the bucket
+# 3. Your AWS credentials are available to boto3 (environment variables, ~/.aws/credentials or an instance role)
+
+class storage(Base):
+    """
+    Access to the S3 bucket used for intermediate data storage.
+    <bucket_name> defaults to the configured s3_bucket.
+    <endpoint_url> of an S3 compatible server to use instead of AWS (e.g. a local stand-in).
+    <manifest_path> SQLite file recording the files backed up by backup(). Defaults to the data directory.
+    """
+    def __init__(self, bucket_name=None, endpoint_url=None, manifest_path=None, config=None):
+        super().__init__(config)
 
-class storage:
-    def __init__(self, bucket_name=config['AWS']['S3']['bucket_name']):
-        
         # Connect to the resource
-        self.bucket_name = bucket_name        
-        self.s3 = boto3.resource(
-                  's3',
-                  aws_access_key_id=config['AWS']['IAM']['access_key_id'],
-                  aws_secret_access_key=config['AWS']['IAM']['secret_access_key'])
-        self.bucket = self.s3.Bucket(bucket_name)
-
-        
-    ################################################################################################
-    # This Function returns a list of all ExPORTER files that have already been downloaded.
-    #-----------------------------------------------------------------------------------------------
-    # INPUTS 
-    # data_path         <String> - The base directory where the ExPORTER data is stored.
-    #-----------------------------------------------------------------------------------------------
-    # OUTPUTS
-    # data_group        <List>   - A list of all files in the the ExPORTER directory
-    ################################################################################################        
-     
+        self.bucket_name = bucket_name or self.config.s3_bucket
+        self.endpoint_url = endpoint_url
+        self.manifest_path = manifest_path or f"{self.config.data_directory}/s3_backup_manifest.sqlite"
+        self.s3 = boto3.resource('s3', endpoint_url=endpoint_url,
+                                 config=BotoConfig(retries={'max_attempts': 10, 'mode': 'adaptive'}, max_pool_connections=50))
+        self.bucket = self.s3.Bucket(self.bucket_name)
+
     # Lists the contents of the S3 Bucket
     def contents(self):
-        
         files = {}
         for obj in self.bucket.objects.all():
             location = obj.key
@@ -46,40 +50,173 @@ class storage:
             else:
                 files[location]['is_directory']   = False
         return files
-    
+
     # uploads file to the S3 Bucket
-    def upload(self,local_file, remote_file):
-        # Upload file to cloud storage
-        self.s3.meta.client.upload_file(local_file, self.bucket_name, remote_file)
+    def upload(self, local_file, remote_file, transfer_config=None):
+        # Upload file to cloud storage. Large files are uploaded in parts, in parallel.
+        self.s3.meta.client.upload_file(local_file, self.bucket_name, remote_file, Config=transfer_config)
 
     # Downloads file from S3 bucket to local disk
     def download(self, remote_file, local_file):
         self.s3.meta.client.download_file(self.bucket_name, remote_file, local_file)
-        
+
     # Delete file from S3 Bucket
     def delete(self, remote_file):
         # Delete from cloud storage
-        self.s3.Object(config['AWS']['S3']['bucket_name'], remote_file).delete()
-    
-    #Backs up entire directory
-    def backup(self, files = [], replace_existing = False):
-        file_upload_errors = []
-        file_subset = files
-        if replace_existing == False:
-            file_subset = list(set(files) - set(self.contents()))
-        print('Uploading', len(file_subset), 'files')    
-            
-        for file in file_subset:
-            try:
-                self.upload(file, file)
-            except:
+        self.s3.Object(self.bucket_name, remote_file).delete()
+
+    def connect_manifest(self):
+        """ SQLite connection to the backup manifest: the size, modification time and SHA-256 of each file backed up, and its S3 key """
+        self.ensure_path(self.manifest_path)
+        connection = sqlite3.connect(self.manifest_path)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("""
+            CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, sha256 TEXT, key TEXT)
+            WITHOUT ROWID
+        """)
+        return connection
+
+    @staticmethod
+    def checksum(path):
+        """ SHA-256 of a file """
+        checksum = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024*1024), b''):
+                checksum.update(chunk)
+        return checksum.hexdigest()
+
+    def backup(self, files=[], replace_existing=False, workers=16, small_file_size=1024*1024, archive_size=64*1024*1024,
+               archive_prefix='archives/'):
+        """
+        Back up local files to the bucket, each under its own path as the key. Returns the list of files which failed.
+        Unchanged files are skipped using the local manifest (see connect_manifest()), without listing the bucket:
+            a file is unchanged if its size and modification time are the same as when it was backed up, or else if its
+            SHA-256 is the same. All files are uploaded when <replace_existing> is True.
+        Files are uploaded by a pool of <workers> threads. Files of <small_file_size> bytes or more are uploaded on their own,
+            in parts in parallel if they're large. Smaller files are batched into tar archives of up to <archive_size> bytes,
+            uploaded to <archive_prefix><SHA-256 of the archive's files>.tar. The manifest records the archive of each file.
+        """
+        self.log(f"Backing up {len(files):,} files to {self.bucket_name}")
+        self.mark_time('backup')
+        manifest = self.connect_manifest()
+        transfer_config = TransferConfig(multipart_threshold=16*1024*1024, multipart_chunksize=16*1024*1024, max_concurrency=4)
+        errors = []
+
+        # find the files which changed since they were backed up
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            changed = []  # (path, size, mtime, sha256) of the files to upload
+            candidates = []  # (path, size, mtime, previous sha256) of the files which may have changed
+            for path in files:
                 try:
-                    self.__init__()
-                    self.upload(file, file)
-                except:
-                    file_upload_errors += file
-        return file_upload_errors
-    
+                    stat = os.stat(path)
+                except OSError as e:
+                    self.err(f"Can't back up {path}: {e}")
+                    errors.append(path)
+                    continue
+                row = manifest.execute("SELECT size, mtime, sha256 FROM files WHERE path = ?", [path]).fetchone()
+                if replace_existing or row is None or row[:2] != (stat.st_size, stat.st_mtime_ns):
+                    candidates.append((path, stat.st_size, stat.st_mtime_ns, row[2] if row else None))
+
+            # files whose size or modification time changed are hashed to see whether their contents did too
+            unchanged = 0
+            for (path, size, mtime, previous), sha256 in zip(candidates, executor.map(lambda c: self.checksum(c[0]), candidates)):
+                if sha256 == previous and not replace_existing:
+                    manifest.execute("UPDATE files SET size = ?, mtime = ? WHERE path = ?", [size, mtime, path])
+                    unchanged += 1
+                else:
+                    changed.append((path, size, mtime, sha256))
+            manifest.commit()
+            self.log(f"Uploading {len(changed):,} files. {len(files) - len(changed) - len(errors):,} unchanged ({unchanged:,} touched)")
+
+            # batch the small files into archives
+            tasks, batch, batch_size = [], [], 0
+            for file in sorted(changed):
+                if file[1] >= small_file_size:
+                    tasks.append([file])
+                    continue
+                batch.append(file)
+                batch_size += file[1]
+                if batch_size >= archive_size:
+                    tasks.append(batch)
+                    batch, batch_size = [], 0
+            if batch: tasks.append(batch)
+
+            # upload, keeping at most a few tasks per worker in flight
+            pending, uploaded, t0 = set(), 0, time.time()
+            tasks = iter(tasks)
+            while True:
+                for task in tasks:
+                    pending.add(executor.submit(self.upload_task, task, archive_prefix, transfer_config))
+                    if len(pending) >= 4 * workers: break
+                if not pending: break
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    task, key, error = future.result()
+                    if error:
+                        self.err(f"Failed to upload {key}: {error}")
+                        errors += [path for path, *_ in task]
+                        continue
+                    manifest.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+                                         [(path, size, mtime, sha256, key) for path, size, mtime, sha256 in task])
+                    manifest.commit()
+                    uploaded += len(task)
+                    progress = self.progress(uploaded - 1, len(changed))
+                    if progress:
+                        self.log(f"{progress} | {self.get_time_total('backup')} | {uploaded:,} files | {uploaded / (time.time() - t0):,.0f} files/s")
+
+        manifest.close()
+        self.add_time('backup')
+        self.log(f"Backup complete ({self.get_time_total('backup')}). Errors: {len(errors):,}")
+        return errors
+
+    def upload_task(self, task, archive_prefix, transfer_config):
+        """
+        Upload a single file, or a batch of files as a tar archive. Runs in a worker thread of backup().
+        Returns the task, the key uploaded to and the error if it failed.
+        """
+        key = task[0][0] if len(task) == 1 else None
+        try:
+            if key is not None:
+                self.upload(key, key, transfer_config)
+                return task, key, None
+
+            # the archive is named by its contents, so uploading the same files again overwrites the same key
+            checksum = hashlib.sha256()
+            for path, _, _, sha256 in task:
+                checksum.update(f"{path}\0{sha256}\0".encode())
+            key = f"{archive_prefix}{checksum.hexdigest()}.tar"
+            with tempfile.NamedTemporaryFile(suffix='.tar') as archive:
+                with tarfile.open(fileobj=archive, mode='w') as tar:
+                    for path, *_ in task:
+                        tar.add(path)
+                archive.flush()
+                self.upload(archive.name, key, transfer_config)
+            return task, key, None
+        except Exception as e:
+            return task, key, f"{e.__class__.__name__}: {e}"
+
+    def restore(self, paths, directory='.'):
+        """ Download backed up files to <directory>, extracting those in archives. Returns the list of files not found. """
+        manifest = self.connect_manifest()
+        keys, missing = {}, []
+        for path in paths:
+            row = manifest.execute("SELECT key FROM files WHERE path = ?", [path]).fetchone()
+            if row is None: missing.append(path)
+            else: keys.setdefault(row[0], []).append(path)
+        manifest.close()
+
+        for key, members in keys.items():
+            if key in members:  # uploaded on its own
+                local_file = os.path.join(directory, key.lstrip('/'))
+                self.ensure_path(local_file)
+                self.download(key, local_file)
+                continue
+            with tempfile.NamedTemporaryFile(suffix='.tar') as archive:
+                self.download(key, archive.name)
+                with tarfile.open(archive.name) as tar:
+                    tar.extractall(directory, members=[tar.getmember(path.lstrip('/')) for path in members])
+        return missing
+
 ###############################################################################
 # Example Usage:
 ###############################################################################
@@ -99,14 +236,11 @@ if __name__ == '__main__':
     cstore.upload(local_file, remote_file)
     x = cstore.contents()
     pprint(x)
-    
+
     #download the file
     cstore.download(remote_file, '_' + local_file)
-    
+
     #delete the file
     cstore.delete(remote_file)
     x = cstore.contents()
     pprint(x)
-
-    
-    
\ No newline at end of file
@@ -1,4 +1,4 @@
-import os, subprocess, inspect
+import os, re, subprocess, inspect, hashlib
 from time import time, sleep
 from datetime import datetime
 
@@ -28,6 +28,7 @@ class Cluster(Base):
         self.max_nodes = self.config.cluster.max_nodes
         self.storage_size = self.config.cluster.storage_size  # GiB
         self.storage_path = self.config.cluster.storage_path
+        self.volume_id = getattr(self.config.cluster, 'volume_id', '')  # existing EBS volume to mount at storage_path
         self.ssh_key = self.config.cluster.ssh_key
 
         # paths to exclude from file transfers
@@ -110,23 +111,75 @@ class Cluster(Base):
             return "Not all configuration options have been provided."
         return  # all good
 
-    def copy_to_cluster(self):
-        """ Copy the repository to the cluster """
+    def copy_to_cluster(self, retries=3):
+        """
+        Copy the repository to the cluster. Only files which changed since the last copy are transferred.
+        Once rsync has finished, a dry run comparing checksums checks that nothing differs. If something does, the copy is
+            repeated, up to <retries> times.
+        """
         self.log("Copying repo to cluster...")
-        exclude = ' '.join(f'--exclude "{path}"' for path in self.exclude_paths)
+        self.mark_time('sync')
 
-        # -a: archive mode. Copy everything recursively
+        # -a: archive mode. Copy everything recursively, keeping modification times so unchanged files are skipped next time
+        # -z: compress
         # -e: use ssh
         # -oStrictHostKeyChecking=no: don't ask for user input to verify the ssh key
-        os.popen(f"""
-            rsync -a -e "ssh -i ./configuration/ssh/{self.ssh_key} -oStrictHostKeyChecking=no" {exclude} ../{self.repo_dir} ubuntu@{self.ip}:~/
-        """)
-        self.log("Transfer Complete.")
+        # --itemize-changes: list each change made, as e.g. ">f.st...... path" for a file sent
+        command = ["rsync", "-az", "--partial", "--itemize-changes", "--stats",
+                   "-e", f"ssh -i ./configuration/ssh/{self.ssh_key} -oStrictHostKeyChecking=no"]
+        command += [f"--exclude={path}" for path in self.exclude_paths]
+        command += [f"../{self.repo_dir}", f"ubuntu@{self.ip}:~/"]
+
+        for attempt in range(retries):
+            try:
+                result = subprocess.run(command, check=True, capture_output=True, text=True)
+                stats = dict(re.findall(r"^(Number of regular files transferred|Total transferred file size): ([\d,]+)", result.stdout, re.M))
+                self.log(f"Transferred {stats.get('Number of regular files transferred', '0')} files "
+                         f"({stats.get('Total transferred file size', '0')} bytes)")
+
+                # check that no file differs, comparing contents rather than sizes and modification times
+                check = subprocess.run(command[:1] + ["--dry-run", "--checksum"] + command[1:], check=True, capture_output=True, text=True)
+                differ = [line for line in check.stdout.splitlines() if re.match(r"[<>ch*][fdLDS]", line)]
+            except subprocess.CalledProcessError as e:
+                self.log(f"rsync failed with exit code {e.returncode}: {e.stderr.strip()}")
+                continue
+
+            if not differ:
+                self.add_time('sync')
+                self.log(f"Transfer Complete ({self.get_time_total('sync')}).")
+                return
+            self.log(f"{len(differ)} files differ after the transfer:", *differ[:10], sep='\n')
+        self.throw(f"Failed to copy the repo to the cluster after {retries} attempts")
+
+    def environment_hash(self):
+        """ Hash of what the cluster environment is built from: the cluster requirements and the setup script """
+        checksum = hashlib.sha256()
+        for path in ["requirements/cluster_requirements.txt", "cluster/setup.sh"]:
+            with open(path, "rb") as file:
+                checksum.update(file.read())
+        return checksum.hexdigest()[:16]
 
     def setup_environ(self):
-        """ Set up the environment on the cluster """
-        self.log("Building environment on cluster... (this will several minutes)")
-        self.run_on_cluster(f"cd {self.repo_dir}/cluster; bash setup.sh;")
+        """
+        Set up the environment on the cluster.
+        Python packages, Java and CoreNLP are installed from an environment bundle on the shared volume, named by
+            environment_hash(). A bundle is only built (by setup.sh) when there isn't one for the current requirements.
+            Set cluster.volume_id in the config to keep the volume, and so the bundles, from one cluster to the next.
+        """
+        directory = f"{self.storage_path}/environments"
+        bundle = f"{directory}/{self.environment_hash()}"
+        cached = self.run_on_cluster(f"test -f {bundle}/COMPLETE && echo cached", capture=True)
+        if cached and "cached" in cached:
+            self.log(f"Installing environment from the cached bundle {bundle}...")
+        else:
+            self.log(f"Building environment bundle {bundle} on cluster... (this will take several minutes)")
+
+        self.run_on_cluster(f"sudo mkdir -p {directory}; sudo chown ubuntu {directory}; cd {self.repo_dir}/cluster; bash setup.sh {bundle};")
+
+        # setup.sh marks the virtual environment with the bundle once it's installed
+        installed = self.run_on_cluster(f"cat {self.repo_dir}/cluster/venv/.bundle", capture=True)
+        if not installed or bundle not in installed:
+            self.throw("Failed to set up the cluster environment. See the output of setup.sh above.")
         self.log("Cluster environment complete.")
 
     def deploy(self, n=None):
@@ -181,6 +234,8 @@ SharedStorage:
     EbsSettings:
       VolumeType: gp3
       Size: {self.storage_size}"""
+        if self.volume_id:  # mount the existing volume instead of creating a new one
+            yaml = yaml[:yaml.rindex("VolumeType:")] + f"VolumeId: {self.volume_id}"
 
         #with open(self.template_file, "w") as file: file.write(yaml)
         #self.debug(f"Constructed CloudFormation template at: {self.template_file}")
@@ -47,7 +47,8 @@ class MySQLDatabase(Database):
             user=self.user,
             password=self.password,
             port=self.port,
-            database=self.database
+            database=self.database,
+            allow_local_infile=True  # for load_data()
         )
 
     def get_connection(self):
@@ -98,7 +99,7 @@ class MySQLDatabase(Database):
             except Exception as e:
                 self.log("Failed to close connection after exception handled.")
 
-    def insert_row(self, table, columns, parameters, threaded=False, db_insert=True):
+    def insert_row(self, table, columns, parameters, threaded=False, db_insert=True, update=False):
         """
         Insert data into the database.
         <table> table name
@@ -106,6 +107,7 @@ class MySQLDatabase(Database):
         <parameters> list of values, or a list of lists of values for each row inserted.
         <threaded> if True, runs in a separate thread and returns an AsyncResult. Call result.get() to block and get the result.
         <db_insert> is whether to actually insert the data. Useful for debugging.
+        <update> if True, rows with an existing primary/unique key are updated with the new values instead of ignored.
         """
         if not len(columns):
             self.debug("No rows inserted - no columns provided")
@@ -120,7 +122,7 @@ class MySQLDatabase(Database):
         # Construct the query we will execute to insert the row(s)
         keys       = ','.join(columns)
         values     = ','.join(['%s' for x in columns])
-        query = f"""INSERT IGNORE INTO {table} ({keys}) VALUES """
+        query = f"""INSERT {'' if update else 'IGNORE '}INTO {table} ({keys}) VALUES """
         if has_multiple_rows:
             for _ in parameters:
                 query += f"""({values}),"""
@@ -128,6 +130,8 @@ class MySQLDatabase(Database):
             parameters = list(itertools.chain(*parameters))
         else:
             query += f"""({values}) """
+        if update:
+            query += f""" ON DUPLICATE KEY UPDATE {', '.join(f'{col}=VALUES({col})' for col in columns)}"""
 
         # Indicates if we should skip the insert - this is useful for testing things.
         if db_insert == False:
@@ -138,6 +142,23 @@ class MySQLDatabase(Database):
 
         return self.query(query, parameters, threaded=threaded)
 
+    def load_data(self, table, columns, path, threaded=False):
+        """
+        Bulk load a file into the database with LOAD DATA LOCAL INFILE. Rows with an existing primary/unique key are ignored.
+        <table> table name, optionally qualified by its database ("database.table")
+        <columns> column names, in the order of the fields in the file
+        <path> file in the default LOAD DATA format: tab separated fields and newline terminated lines,
+            with tabs, newlines and backslashes in values escaped by a backslash, and \\N for NULL.
+        <threaded> if True, runs in a separate thread and returns an AsyncResult. Call result.get() to block and get the result.
+        Returns None if the load failed, e.g. when local_infile is disabled on the server.
+        """
+        query = f"""
+            LOAD DATA LOCAL INFILE %s IGNORE INTO TABLE {'.'.join(f'`{name}`' for name in table.split('.'))}
+            CHARACTER SET utf8mb4
+            ({', '.join(f'`{col}`' for col in columns)})
+        """
+        return self.query(query, [os.path.abspath(path)], threaded=threaded)
+
     def getTableInfo(self, table_name=None):
         """ Given a table name, return certain information about each column (data type, key, etc.) """
         table_info = {}
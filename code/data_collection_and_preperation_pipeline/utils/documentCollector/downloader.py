@@ -0,0 +1,195 @@
+from utils.base import Base
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from threading import Lock, local
+from urllib.parse import urlparse, unquote
+import requests
+import hashlib
+import json
+import time
+import re
+import os
+
+
+class Downloader(Base):
+    """
+    Downloads files concurrently, skipping files which haven't changed since they were last downloaded.
+    Each URL is downloaded to its own temporary file in <directory>/.partial, which is moved into place once complete.
+        A temporary file left by a failed download is resumed with an HTTP range request if the server supports it,
+        and only if the file on the server is still the same (If-Range).
+    What is known about each URL (its file path, ETag, Last-Modified and SHA-256) is kept in <directory>/downloads.json:
+        - a URL whose file still exists is requested with If-None-Match / If-Modified-Since, so the server can answer
+          304 Not Modified without sending the file again.
+        - a file with the same SHA-256 as the existing one is not moved into place.
+    <workers> files downloaded at the same time.
+    <retries> times a failed download is resumed before giving up.
+    """
+    def __init__(self, *args, directory, workers=4, retries=3, timeout=60, chunk_size=64*1024, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.directory = directory
+        self.workers = workers
+        self.retries = retries
+        self.timeout = timeout  # seconds without data before a request fails
+        self.chunk_size = chunk_size
+        self.partial_directory = f"{directory}/.partial"
+        self.manifest_path = f"{directory}/downloads.json"
+
+        self.manifest = self.load_manifest()  # url -> what is known about its file
+        self.manifest_lock = Lock()
+        self.local = local()  # requests session of each thread
+
+    def load_manifest(self):
+        if not os.path.exists(self.manifest_path):
+            return {}
+        with open(self.manifest_path) as f:
+            return json.load(f)
+
+    def update_manifest(self, url, entry):
+        """ Save what is known about a URL, or forget it if <entry> is None """
+        with self.manifest_lock:
+            if entry is None:
+                self.manifest.pop(url, None)
+            else:
+                self.manifest[url] = entry
+            self.ensure_path(self.manifest_path)
+            with open(self.manifest_path + '.tmp', 'w') as f:
+                json.dump(self.manifest, f, indent=4)
+            os.replace(self.manifest_path + '.tmp', self.manifest_path)
+
+    def session(self):
+        """ The requests session of the current thread """
+        if not hasattr(self.local, 'session'):
+            self.local.session = requests.Session()
+        return self.local.session
+
+    def download(self, files):
+        """
+        Download files concurrently.
+        <files> list of (url, destination) where destination is a function given the filename sent by the server (or
+            the last part of the URL) which returns the path to save the file to, or None to discard it.
+        Returns a result dictionary of each file, in order of completion, with:
+            url, filename, path, status ('downloaded', 'unchanged', 'discarded' or 'failed'), replaced (whether a
+            different file was replaced), size in bytes, seconds taken, and the error if it failed.
+        """
+        results = []
+        self.mark_time('download')
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [executor.submit(self.fetch, url, destination) for url, destination in files]
+            for i, future in enumerate(as_completed(futures)):
+                result = future.result()
+                results.append(result)
+                message = f"[{i+1}/{len(files)}] {result['filename'] or result['url']} {result['status']}"
+                if result['status'] == 'downloaded':
+                    message += f" {self.format_bytes(result['size'])} ({self.format_seconds(result['seconds'])})"
+                if result['status'] == 'failed':
+                    self.err(f"{message}: {result['error']}")
+                else:
+                    self.log(message)
+        self.add_time('download')
+        return results
+
+    def fetch(self, url, destination):
+        """ Download a single file, resuming after errors up to <retries> times. Returns its result (see download()) """
+        t0 = time.time()
+        result = {'url': url, 'filename': None, 'path': None, 'status': 'failed', 'replaced': False, 'size': 0, 'seconds': 0, 'error': None}
+        for attempt in range(self.retries + 1):
+            try:
+                result.update(self.request(url, destination))
+                result['error'] = None
+                break
+            except Exception as e:
+                result['error'] = f"{e.__class__.__name__}: {e}"
+                if attempt < self.retries:
+                    self.debug(f"Retrying {url} after {result['error']}")
+                    time.sleep(2 ** attempt)
+        result['seconds'] = time.time() - t0
+        return result
+
+    def request(self, url, destination):
+        """ Request a file, and download it if it changed. Raises an exception if the download failed. """
+        entry = self.manifest.get(url, {})
+        partial_path = f"{self.partial_directory}/{hashlib.sha1(url.encode()).hexdigest()}.part"
+        self.ensure_path(partial_path)
+
+        headers = {}
+        if entry.get('path') and os.path.exists(entry['path']):  # ask the server whether the file changed
+            if entry.get('etag'): headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'): headers['If-Modified-Since'] = entry['last_modified']
+
+        # resume a partial download of the same version of the file
+        partial = entry.get('partial', {})
+        offset = os.path.getsize(partial_path) if os.path.exists(partial_path) else 0
+        validator = partial.get('etag') or partial.get('last_modified')
+        if offset and validator:
+            headers['Range'] = f"bytes={offset}-"
+            headers['If-Range'] = validator
+
+        with self.session().get(url, headers=headers, stream=True, timeout=(10, self.timeout)) as response:
+            if response.status_code == 304:
+                if os.path.exists(partial_path): os.remove(partial_path)
+                return {'filename': entry.get('filename'), 'path': entry['path'], 'status': 'unchanged', 'size': 0}
+            if response.status_code == 416:  # the partial file is no longer valid. Start over on the next attempt.
+                os.remove(partial_path)
+                self.update_manifest(url, {**entry, 'partial': {}})
+            response.raise_for_status()
+
+            etag = response.headers.get('ETag')
+            last_modified = response.headers.get('Last-Modified')
+            resumed = response.status_code == 206 and re.match(rf"bytes {offset}-", response.headers.get('Content-Range', ''))
+            if response.status_code == 206 and not resumed:  # a range we didn't ask for. Start over on the next attempt.
+                os.remove(partial_path)
+                raise IOError(f"Unexpected range: {response.headers.get('Content-Range')}")
+            if not resumed:  # the full file was sent
+                offset = 0
+                self.update_manifest(url, {**entry, 'partial': {'etag': etag, 'last_modified': last_modified}})
+
+            # write the file and hash it, including what was downloaded before
+            checksum = hashlib.sha256()
+            if offset:
+                with open(partial_path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(self.chunk_size), b''):
+                        checksum.update(chunk)
+            with open(partial_path, 'ab' if offset else 'wb') as f:
+                for chunk in response.iter_content(self.chunk_size):
+                    f.write(chunk)
+                    checksum.update(chunk)
+            size = os.path.getsize(partial_path)
+            expected = response.headers.get('Content-Length')
+            if expected is not None and 'Content-Encoding' not in response.headers and size != offset + int(expected):
+                raise IOError(f"Incomplete download: {size - offset:,} of {int(expected):,} bytes")
+
+            filename = self.get_filename(url, response.headers)
+
+        sha256 = checksum.hexdigest()
+        path = destination(filename)
+        entry = {'filename': filename, 'path': path, 'etag': etag, 'last_modified': last_modified, 'sha256': sha256, 'size': size}
+        if path is None:  # not wanted
+            os.remove(partial_path)
+            self.update_manifest(url, None)
+            return {'filename': filename, 'status': 'discarded', 'size': size}
+
+        replaced = os.path.exists(path)
+        previous = self.manifest.get(url, {})
+        if replaced and sha256 == (previous.get('sha256') if previous.get('path') == path else self.checksum(path)):
+            os.remove(partial_path)
+            self.update_manifest(url, entry)
+            return {'filename': filename, 'path': path, 'status': 'unchanged', 'size': size}
+
+        self.ensure_path(path)
+        os.replace(partial_path, path)  # atomic - the file is either the old or the new one, never partly written
+        self.update_manifest(url, entry)
+        return {'filename': filename, 'path': path, 'status': 'downloaded', 'replaced': replaced, 'size': size}
+
+    def get_filename(self, url, headers):
+        """ Filename from the Content-Disposition header, or the last part of the URL path """
+        search = re.search(r"filename\*?=(?:UTF-8'')?\"?([^\";]+)\"?", headers.get('Content-Disposition', ''), re.IGNORECASE)
+        if search:
+            return os.path.basename(unquote(search.group(1).strip()))
+        return os.path.basename(unquote(urlparse(url).path)) or None
+
+    def checksum(self, path):
+        """ SHA-256 of a file """
+        checksum = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(self.chunk_size), b''):
+                checksum.update(chunk)
+        return checksum.hexdigest()
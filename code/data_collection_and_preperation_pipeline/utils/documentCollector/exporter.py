@@ -1,5 +1,6 @@
 from utils.generalPurpose.generalPurpose import *
 from utils.database.database import MySQLDatabase
+from utils.documentCollector.downloader import Downloader
 from dateutil.parser import parse
 import json
 import requests
@@ -10,8 +11,12 @@ import re
 import wget
 from zipfile import ZipFile
 from csv import reader
+from multiprocessing import Pool, cpu_count
+import io
 import math
+import itertools
 import numpy as np
+import pandas as pd
 import shutil
 import os, ssl
 
@@ -30,12 +35,159 @@ exporter_primary_keys =  { 'abstracts'    : ['application_id', 'version'],
                            'afilliations' : ['pmid','author_name']}
 
 
+def csv_to_jsonl(file, json_path, year=None):
+    """
+    Convert the ExPORTER CSV in the given open text file to JSON lines, written one at a time to <json_path>.
+    Each line also gets the <year> of the file.
+    The output is written to a temporary file first and then moved into place, so <json_path> is never partially written.
+    Returns the number of lines written, and the number of lines skipped because they had the wrong number of columns.
+    """
+    temp = f"{json_path}.{os.getpid()}.tmp"
+    lines, errors = 0, 0
+    try:
+        with open(temp, 'w') as outfile:
+            rows = reader(file)  # iterate through each line using a CSV reader
+            headers = next(rows, [])  # the first line is a header
+            for line in rows:
+                if len(headers) != len(line):  # Check for errors
+                    errors += 1
+                    continue
+                json_line = {'year': year}
+                json_line.update(zip(headers, line))
+                outfile.write(json.dumps(json_line) + '\n')
+                lines += 1
+        os.replace(temp, json_path)
+    finally:
+        if os.path.exists(temp): os.remove(temp)  # failed before the move
+    return lines, errors
+
+
+def unpack_zip(paths):
+    """
+    Convert the CSV in a downloaded ExPORTER zip file to JSON lines, reading it straight from the zip without extracting it.
+    Runs in a worker process of Exporter.unpack_data().
+    <paths> tuple of the zip file path and the JSON lines path to write.
+    Returns the zip path, the number of lines written and skipped, the seconds taken, and the error if it failed.
+    """
+    zip_path, json_path = paths
+    t0 = time.time()
+    try:
+        with ZipFile(zip_path, 'r') as zipObj:
+            name = zipObj.namelist()[0]
+            year = findMatches("[0-9]{4}", name)  # Get the year from the file name
+            with zipObj.open(name) as member:
+                file = io.TextIOWrapper(member, errors='replace')
+                lines, errors = csv_to_jsonl(file, json_path, year[0] if year else None)
+        return zip_path, lines, errors, time.time() - t0, None
+    except Exception as e:
+        return zip_path, 0, 0, time.time() - t0, f"{e.__class__.__name__}: {e}"
+
+
+# Patterns of the values characterizeData() counts as each type, checked in this order. They accept the same strings as
+# int() and float(), and the date formats found in ExPORTER files (2019-01-31, 2019-01-31T00:00:00, 01/31/2019 12:00:00 AM,
+# Jan 31, 2019, 31 January 2019, January 2019).
+INT_PATTERN = r'\s*[+-]?\d(?:_?\d)*\s*'
+FLOAT_PATTERN = (r'\s*[+-]?(?:(?:(?:\d(?:_?\d)*)?\.\d(?:_?\d)*|\d(?:_?\d)*\.?)(?:e[+-]?\d(?:_?\d)*)?'
+                 r'|inf(?:inity)?|nan)\s*')
+MONTH_PATTERN = r'(?:jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec)[a-z]*\.?'
+TIME_PATTERN = r'(?:[ t]\d{1,2}:\d{2}(?::\d{2}(?:\.\d+)?)?(?:\s*[ap]\.?m\.?)?(?:z|[+-]\d{2}:?\d{2})?)?'
+DATE_PATTERN = (r'\s*(?:\d{4}[-/.]\d{1,2}[-/.]\d{1,2}' + TIME_PATTERN +
+                r'|\d{1,2}[-/.]\d{1,2}[-/.](?:\d{4}|\d{2})' + TIME_PATTERN +
+                r'|' + MONTH_PATTERN + r'\s+\d{1,2}(?:st|nd|rd|th)?,?\s+\d{4}' + TIME_PATTERN +
+                r'|\d{1,2}(?:st|nd|rd|th)?[\s-]+' + MONTH_PATTERN + r'[\s,-]+\d{4}' + TIME_PATTERN +
+                r'|' + MONTH_PATTERN + r',?\s+\d{4})\s*')
+
+
+def column_stats(stats, key):
+    """ The stats of the column <key> in a characterizeData() stats dictionary, added if it's new """
+    if key not in stats:
+        stats[key] = {'max_value_size': 0,
+                      'data_type': {'INT': 0, 'VARCHAR': 0, 'FLOAT': 0, 'DATE': 0},
+                      'column_name': key}
+    return stats[key]
+
+
+def read_columns(lines):
+    """ DataFrame of the values of JSON lines as they were written (no type conversion), and the column name of each key """
+    df = pd.DataFrame([json.loads(line) for line in lines], dtype=object)
+    return df, [key.lower().replace(' ', '_').replace('.', '_') for key in df.columns]
+
+
+def count_types(stats, lines, weight=1):
+    """
+    Add the number of values of each type in the given JSON lines to <stats>, each value counting as <weight> values.
+    Values are classified a column at a time with the patterns above: INT, else FLOAT, else DATE, else VARCHAR.
+    """
+    df, keys = read_columns(lines)
+    for real_key, key in zip(df.columns, keys):
+        values = df[real_key]
+        values = values[values.notna()].astype(str)
+        counts = column_stats(stats, key)['data_type']
+
+        is_int = values.str.fullmatch(INT_PATTERN)
+        values = values[~is_int]
+        is_float = values.str.fullmatch(FLOAT_PATTERN, flags=re.IGNORECASE)
+        values = values[~is_float]
+        is_date = values.str.fullmatch(DATE_PATTERN, flags=re.IGNORECASE)
+
+        counts['INT'] += weight * int(is_int.sum())
+        counts['FLOAT'] += weight * int(is_float.sum())
+        counts['DATE'] += weight * int(is_date.sum())
+        counts['VARCHAR'] += weight * int((~is_date).sum())
+
+
+def profile_jsonl(task):
+    """
+    Profile the columns of an ExPORTER JSON lines file. Runs in a worker process of Exporter.characterizeData().
+    <task> tuple of the file path, the sample size, the random seed and the number of lines read at a time.
+    The longest value of each column is found from every line. The types are counted from every line, or if a sample
+        size is given, from that many lines picked uniformly at random with a reservoir, scaled up to the size of the file.
+    Returns the path, the column stats (see characterizeData()), the number of lines and of lines sampled, the seconds
+        taken, and the error if it failed.
+    """
+    path, sample, seed, batch_size = task
+    t0 = time.time()
+    stats, rows, reservoir = {}, 0, []
+    rng = np.random.default_rng(seed)
+    try:
+        with open(path) as f:
+            while True:
+                lines = list(itertools.islice(f, batch_size))
+                if not lines: break
+
+                df, keys = read_columns(lines)
+                for real_key, key in zip(df.columns, keys):
+                    values = df[real_key]
+                    size = values[values.notna()].astype(str).str.len().max()
+                    column = column_stats(stats, key)
+                    if size == size and size > column['max_value_size']:  # NaN when the column has no values
+                        column['max_value_size'] = int(size)
+
+                if sample is None:
+                    count_types(stats, lines)
+                else:
+                    # line i replaces a random line of the reservoir with probability sample / (i + 1)
+                    fill = min(max(sample - rows, 0), len(lines))
+                    reservoir += lines[:fill]
+                    slots = rng.integers(0, np.arange(rows + fill, rows + len(lines)) + 1)
+                    for i in np.nonzero(slots < sample)[0]:
+                        reservoir[slots[i]] = lines[fill + i]
+                rows += len(lines)
+
+        if sample is None:
+            return path, stats, rows, rows, time.time() - t0, None
+        if reservoir:
+            count_types(stats, reservoir, weight=rows / len(reservoir))
+        return path, stats, rows, len(reservoir), time.time() - t0, None
+    except Exception as e:
+        return path, stats, rows, 0, time.time() - t0, f"{e.__class__.__name__}: {e}"
+
+
 class Exporter(Base):
     """ Handles collection from the ExPORTER API"""
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.base_url  = "https://reporter.nih.gov/services/exporter"
-        self.temp = "_temp_exporter_file"  # filename to temporarily save downloaded files to
         self.save_directory = f"{self.config.data_directory}/ExPORTER"
         self.document_list  = []
 
@@ -192,136 +344,130 @@ class Exporter(Base):
             self.debug(f"{len(rows)} files already inserted.")
         return sources
 
-    def characterizeData(self, replace_existing, limit_to_tables):
+    def characterizeData(self, replace_existing, limit_to_tables, sample=None, processes=None, confidence=0.95, batch_size=100000):
         """
         ################################################################################################
         # This Function characterizes the ExPORTER Data Download and stores the results in ExPORTER/stats/
+        # Files are profiled in parallel (see profile_jsonl()) and the stats of the files of each table are merged.
         # -----------------------------------------------------------------------------------------------
         # INPUTS
-        # replace_existing    <Bool>   - When True, all previously downloaded files are replaced.
+        # replace_existing    <Bool>   - When True, stats which were previously computed are computed again.
+        # limit_to_tables     <List>   - Tables to characterize. All tables when empty.
+        # sample              <Int>    - Lines of each file sampled to count value types. All lines when None.
+        # processes           <Int>    - Worker processes. Defaults to the number of CPUs.
+        # confidence          <Float>  - Confidence of the error bound on sampled type shares which is logged.
+        # batch_size          <Int>    - Lines read from a file at a time.
         # -----------------------------------------------------------------------------------------------
         # OUTPUTS
         # See ExPORTER/stats/ for a set of files that characterize the downloaded data.
+        # Each has the max_value_size, the number of values of each data_type and the column_name of each column.
+        # When sampling, the data_type numbers are estimated from the sample.
         ################################################################################################
         """
-        folder_path = glob.glob(f"{self.save_directory}/*")
-
         self.log('------------------------------------------------')
         self.log(' Characterizing ExPORTER Data                   ')
         self.log('------------------------------------------------')
 
+        stats_directory = f"{self.save_directory}/stats"
+        os.makedirs(stats_directory, exist_ok=True)
+
         # ----------------------------------------------
-        # For each folder of data...
+        # Find the data files of each folder of data...
         # ----------------------------------------------
-        for folder in folder_path:
-
+        tasks, files = [], {}
+        for folder in sorted(glob.glob(f"{self.save_directory}/*")):
             # Get the folder name
             folder_name = folder.split('/')[-1]
             if '.' in folder_name:
                 folder_name = '.'.join(folder_name.split('.')[:-1])
 
-            if limit_to_tables != []:
-                if folder_name not in limit_to_tables:
-                    continue
-
-            # Get the data path
-            data_path = glob.glob(folder + '/json/*')
-            data_info = {}
-
             # We do not want to do anything with the data statistics
-            if folder_name == 'stats':
+            if folder_name == 'stats' or (limit_to_tables != [] and folder_name not in limit_to_tables):
                 continue
 
             self.log('Processing', folder, '...')
-
-            # Figure out which files we have already computed stats for
-            stats_computed = [folder.split('/')[-1] for folder in
-                              glob.glob(f'{self.save_directory}/stats/*')]
-            this_stat_name = folder_name + '.json'
-            if (this_stat_name in stats_computed) and (replace_existing == False):
+            if os.path.exists(f"{stats_directory}/{folder_name}.json") and not replace_existing:
                 self.log('.... Skipping - stats were previously computed')
                 continue
-            else:
-                self.log('.... Computing stats - this may take a while')
 
-            # ----------------------------------------------
-            # For each data file in the folder...
-            # ----------------------------------------------
-            for data in data_path:
-                data_name = data.split('/')[-1]
-                data_name = '.'.join(data_name.split('.')[:-1])
+            data_paths = sorted(glob.glob(folder + '/json/*.jsonl'))
+            if not data_paths:
+                self.log('.... Skipping - no data files')
+                continue
+            files[folder_name] = len(data_paths)
+            tasks += [(folder_name, (path, sample, len(tasks) + i, batch_size)) for i, path in enumerate(data_paths)]
 
-                # ----------------------------------------------
-                # For each line in the data file...
-                # ----------------------------------------------
-                with open(data) as f:
-                    for line in f:
-
-                        json_line = json.loads(line)
-
-                        # ----------------------------------------------
-                        # Get the line statistics
-                        # ----------------------------------------------
-                        for real_key, val in json_line.items():
-
-                            key = real_key.lower().replace(' ', '_').replace('.', '_')
-
-                            # -----------------------------------------------
-                            # If this is a new key, add it to the dict
-                            # -----------------------------------------------
-                            if data_info.get(key) == None:
-                                data_info[key] = {'max_value_size': 0,
-                                                  'data_type': {'INT': 0,
-                                                                'VARCHAR': 0,
-                                                                'FLOAT': 0,
-                                                                'DATE': 0
-                                                                },
-                                                  'column_name': ''
-                                                  }
-
-                            # ----------------------------------------------
-                            # Generate the column name from he key
-                            # -----------------------------------------------
-                            if data_info[key]['column_name'] == '':
-                                data_info[key]['column_name'] = key.lower().replace(' ', '_').replace('.', '_')
-
-                            # -----------------------------------------------
-                            # Get the max_value_size
-                            # -----------------------------------------------
-                            if val is not None:
-                                if data_info[key]['max_value_size'] < len(val):
-                                    data_info[key]['max_value_size'] = len(val)
-
-                            # -----------------------------------------------
-                            # Get the data_type
-                            # -----------------------------------------------
-                            if val is not None:
-                                if representsInt(val):
-                                    data_info[key]['data_type']['INT'] += 1
-                                elif representsFloat(val):
-                                    data_info[key]['data_type']['FLOAT'] += 1
-                                elif representsDatetime(val, fuzzy=False):
-                                    data_info[key]['data_type']['DATE'] += 1
-                                else:
-                                    data_info[key]['data_type']['VARCHAR'] += 1
-
-            # -----------------------------------------------------
-            # Saving Batch
-            # -----------------------------------------------------
-            if not os.path.isdir('data/ExPORTER/stats'):
-                os.mkdir('data/ExPORTER/stats')
-
-            outfile = open('data/ExPORTER/stats/' + folder_name + '.json', "w")
+        if not tasks:
+            self.log("No data to characterize.")
+            return
+
+        # ----------------------------------------------
+        # Profile the files in parallel, and merge the stats of each table as its files finish
+        # ----------------------------------------------
+        processes = processes or min(cpu_count(), len(tasks))
+        self.log(f"Characterizing {len(tasks)} files with {processes} processes" + (f", sampling {sample:,} lines of each" if sample else ''))
+        self.mark_time('characterize')
+        tables = {table: {'stats': {}, 'remaining': count, 'rows': 0, 'variance': 0, 'failed': False} for table, count in files.items()}
+        table_of = {task[0]: table for table, task in tasks}
+        with Pool(processes) as pool:
+            for i, (path, stats, rows, sampled, seconds, error) in enumerate(pool.imap_unordered(profile_jsonl, [task for _, task in tasks])):
+                table = tables[table_of[path]]
+                table['remaining'] -= 1
+                name = '/'.join(path.split('/')[-3::2])  # table/filename
+                if error:
+                    self.err(f"Failed to characterize {name}: {error}")
+                    table['failed'] = True
+                else:
+                    self.log(f"[{i+1}/{len(tasks)}] {name} done {self.format_seconds(seconds)} Lines: {rows:,}" + (f" Sampled: {sampled:,}" if sample else ''))
+                    for key, column in stats.items():
+                        merged = column_stats(table['stats'], key)
+                        merged['max_value_size'] = max(merged['max_value_size'], column['max_value_size'])
+                        for data_type, count in column['data_type'].items():
+                            merged['data_type'][data_type] += count
+                    table['rows'] += rows
+                    if sampled < rows:
+                        table['variance'] += rows ** 2 / sampled  # each sampled line stands for rows / sampled lines
+
+                if not table['remaining']:
+                    self.save_stats(table_of[path], table, confidence)
+        self.add_time('characterize')
+        self.log(f"Characterization Complete. {self.get_time_total('characterize')}")
+        self.clear_time('characterize')
+
+    def save_stats(self, table_name, table, confidence):
+        """
+        Write the merged stats of a table characterized by characterizeData() to ExPORTER/stats/, unless a file failed.
+        When files were sampled, the Hoeffding bound on the error of the estimated share of each data type is logged:
+            the true shares are within this bound of the estimates with the given <confidence>.
+        """
+        if table['failed']:
+            self.err(f"Stats of {table_name} were not saved because some files failed.")
+            return
+
+        data_info = table['stats']
+        for column in data_info.values():
+            column['data_type'] = {data_type: int(round(count)) for data_type, count in column['data_type'].items()}
+        path = f"{self.save_directory}/stats/{table_name}.json"
+        with open(path + '.tmp', 'w') as outfile:
             json.dump(data_info, outfile)
-            outfile.close()
+        os.replace(path + '.tmp', path)
 
-    def request(self, replace_existing, limit_to_tables):
+        if table['variance'] and table['rows']:
+            bound = math.sqrt(math.log(2 / (1 - confidence)) * table['variance'] / 2) / table['rows']
+            self.log(f"Saved {table_name} stats. Shares of lines of each data type are within {100*bound:.2f}% of their estimates ({100*confidence:g}% confidence)")
+        else:
+            self.log(f"Saved {table_name} stats.")
+
+    def request(self, replace_existing, limit_to_tables, workers=4):
         """
         # This Function collects files pasted on the NIH ExPORTER website
+        # Files are downloaded concurrently, and files which haven't changed are skipped (see Downloader).
+        # Files which changed have their JSON lines and their rows in the table removed, so they are converted and imported again.
         #-----------------------------------------------------------------------------------------------
         # INPUTS
-        # save_directory      <String> - Indicates the directory where we will save the downloaded data.
         # replace_existing    <Bool>   - When True, all previously downloaded files are replaced.
+        # limit_to_tables     <List>   - Tables to download the files of.
+        # workers             <Int>    - Files downloaded at the same time.
         #-----------------------------------------------------------------------------------------------
         # OUTPUTS
         # See the ExPORTER/ directory for information on the files
@@ -339,168 +485,117 @@ class Exporter(Base):
             'clinical_studies': [f"{self.base_url}/DownloadFile?groupName=CLINICALSTUDY"]
         }
 
-        for index, table in enumerate(limit_to_tables):
-            self.log("\nTable:", table)
+        def destination(table, raw_directory):
+            """ Function giving the path to save each downloaded file of the table to, or None to discard it """
+            def path(filename):
+                # TODO: patents download is a raw CSV, not a zip
+                if not filename or not filename.lower().endswith('.zip'):
+                    return None
+                # These appendices are not applicable
+                if table == 'projects' and (('_DUNS_' in filename) or ('_PRJFUNDING_' in filename)):
+                    return None
+                return f"{raw_directory}/{filename}"
+            return path
 
+        files = []
+        for table in limit_to_tables:
             table_directory = f"{self.save_directory}/{table}"  # directory for all files related to this table
             raw_directory = f"{table_directory}/raw"  # where to save the raw zip files
             self.debug(f"Raw directory: {raw_directory}")
-            if not os.path.isdir(raw_directory):
-                self.debug("Raw directory not found - creating it")
-                os.makedirs(raw_directory)
-            else:
-                self.debug("Raw directory already exists")
-
-            # remove existing file if specified (and for some files, we will always want to replace existing)
-            if replace_existing or table in ['patents', 'clinical_studies']:
-                if os.path.isdir(table_directory):
-                    shutil.rmtree(table_directory)  # remove these directories
-
-            # To keep track of new files we've added to the collection
-            newly_downloaded_files = 0
-            previously_downloaded_files = 0
-
-            # For each file URL
-            urls = table_urls[table]  # file urls for this table
-            for url in urls:
-                time.sleep(0.5)  # be nice
-                self.log("Requesting... ", end='')
-                self.mark_time('r')
-
-                # Use curl because for some reason requests.get() takes forever (are they rate limiting somehow??)
-                # -s: silent
-                # -D: output only the received headers, and "-" redirects to stdout (which we read into header_text)
-                # -o: dump body to file
-                header_text = os.popen(f"curl {url} -s -D - -o {self.temp}").read()
-
-                search = re.search('Content-Disposition:.*filename=(.*?\.zip)', header_text, re.IGNORECASE)
-                # TODO: patents download is a raw CSV, not a zip
-                if not search:  # no regex match
-                    self.log(f"Error - filename not found in response. URL: {url}")
-                    continue
-
-                filename = search.group(1)
-
-                self.add_time('r')
-                self.log(f" {filename} ({self.get_time_last('r')})", end='')
-                
-                # The publications are special in that they also contain author affiliation files.
-                if (table == 'publications') and ('_AFFLNK_' in filename):
-                    table = 'affiliations'
-                if (table == 'affiliations') and ('_AFFLNK_' not in filename):
-                    table = 'publications'
-                
-                # These appendices are not applicable
-                if table == 'projects':
-                    if ('_DUNS_' in filename) or ('_PRJFUNDING_' in filename):
-                        self.log(" ...discarded")
-                        continue
-
-                # move file to raw directory if it's a new one
-                file_path = f"{raw_directory}/{filename}"
-                if not replace_existing and os.path.exists(file_path):
-                    previously_downloaded_files += 1
-                    self.log(" ...already downloaded")
-                    continue
-                else:
-                    os.popen(f"mv {self.temp} {file_path}")
-                    self.log(" ...downloaded.")
-                    newly_downloaded_files += 1
-
-            # Display download statistics to the users
-            self.log(f"Done Collecting {self.get_time_total('r')}")
-            self.log(f"Previously downloaded: {previously_downloaded_files}")
-            self.log(f"Newly downloaded: {newly_downloaded_files}")
 
-    def unpack_data(self, replace, tables):
-        """ Unzip and JSONify the downloaded data """
+            # remove existing files if specified
+            if replace_existing and os.path.isdir(table_directory):
+                shutil.rmtree(table_directory)  # remove these directories
+            os.makedirs(raw_directory, exist_ok=True)
+            files += [(url, destination(table, raw_directory)) for url in table_urls[table]]
+
+        downloader = Downloader(self.config, directory=self.save_directory, workers=workers)
+        results = downloader.download(files)
+
+        for result in results:
+            # a changed file replaced the previous one, so its JSON lines need converting again (see unpack_data()),
+            # and its rows need importing again (see import_data(), which skips the sources already in the table)
+            if result['replaced']:
+                raw_directory, filename = os.path.split(result['path'])
+                table = os.path.basename(os.path.dirname(raw_directory))
+                source = '.'.join(filename.split('.')[:-1])
+                json_path = f"{os.path.dirname(raw_directory)}/json/{source}.jsonl"
+                if os.path.exists(json_path):
+                    os.remove(json_path)
+                self.log(f"{filename} changed. Removing its rows from {table} so it is imported again.")
+                if self.db.query(f"DELETE FROM {table} WHERE source = %s", [source]) is None:
+                    self.err(f"Failed to remove the rows of {source} from {table}. Import it again with replace_existing.")
+
+        # Display download statistics to the users
+        statuses = [result['status'] for result in results]
+        self.log(f"Done Collecting {downloader.get_time_total('download')}")
+        self.log(f"Previously downloaded: {statuses.count('unchanged')}")
+        self.log(f"Newly downloaded: {statuses.count('downloaded')}")
+        self.log(f"Discarded: {statuses.count('discarded')}")
+        if statuses.count('failed'):
+            self.err(f"Failed: {statuses.count('failed')}")
+
+    def unpack_data(self, replace, tables, processes=None):
+        """
+        Convert the downloaded zip files to JSON lines (see unpack_zip()), in parallel with a pool of <processes>.
+        Files already converted are skipped unless <replace> is True, in which case they are written again from scratch.
+        """
         self.mark_time('t')
         self.log('\nUnpacking Data....')
-        # For each of the subdirectories in the save_directory
-        paths = glob.glob(f"{self.save_directory}/*")
-        for path in paths:
 
+        # For each of the subdirectories in the save_directory, find the zip files to convert
+        tasks = []
+        for path in glob.glob(f"{self.save_directory}/*"):
             table = path.split('/')[-1]
             if table not in tables:
-                self.log("\nSkipping: ", table)
+                self.log("Skipping: ", table)
                 continue
-            self.log(f"\n{table}:")
-
-            # directory to store unzipped csv file
-            csv_directory = f"{path}/unzipped"
-            os.makedirs(csv_directory, exist_ok=True)
 
             # directory to store parsed JSON files
             json_directory = f"{path}/json"
             os.makedirs(json_directory, exist_ok=True)
 
             # For each of the .zip files in the raw directory
-            raw_file_paths = glob.glob(f"{path}/raw/*.zip")
-            for file in raw_file_paths:
+            for file in sorted(glob.glob(f"{path}/raw/*.zip")):
                 filename = file.split('/')[-1]
                 filename = '.'.join(filename.split('.')[:-1])
-                self.log(f"{filename} ... ", end='')
-                self.mark_time('f')
-
                 json_path = f"{json_directory}/{filename}.jsonl"
+                if not replace and os.path.exists(json_path):  # skip if already converted
+                    self.debug(f"{table}/{filename} already exists")
+                    continue
+                tasks.append((file, json_path))
+
+        if not tasks:
+            self.log("All files already unpacked.")
+            return
+
+        processes = processes or min(cpu_count(), len(tasks))
+        self.log(f"Unpacking {len(tasks)} files with {processes} processes")
+        total_errors = 0
+        with Pool(processes) as pool:
+            for i, (file, lines, errors, seconds, error) in enumerate(pool.imap_unordered(unpack_zip, tasks)):
+                name = '/'.join(file.split('/')[-3::2])  # table/filename
+                if error:
+                    self.err(f"Failed to unpack {name}: {error}")
+                    continue
+                total_errors += errors
+                self.log(f"[{i+1}/{len(tasks)}] {name} done {self.format_seconds(seconds)} Lines: {lines:,} Errors: {errors}")
 
-                # Extract all the contents of zip file to the csv directory
-                with ZipFile(file, 'r') as zipObj:
-                    extracted_file_name = zipObj.namelist()[0]
-                    csv_path = f"{csv_directory}/{extracted_file_name}"  # path to the unzipped csv file
-                    if not replace and os.path.exists(csv_path):  # skip if already unzipped
-                        self.log(" already exists")
-                        continue
-                    zipObj.extractall(path=csv_directory)  # unzip to the csv directory
-
-                # convert to JSON
-                line_errors = self.parse_jsonl(csv_path, json_path)
-                self.add_time('f')
-                self.log(f" done {self.get_time_last('f')} Errors: {line_errors}")
-
-            self.add_time('t')
-            self.log("Table Complete.", self.get_time_last('t'))
-
-        self.log("Unpacking Data Complete.", self.get_time_total('t'))
+        self.add_time('t')
+        self.log(f"Unpacking Data Complete. {self.get_time_total('t')} Errors: {total_errors}")
         self.clear_time('t')
 
     def parse_jsonl(self, csv_path, json_path):
-        """ Given the path to csv file, convert it to JSONL and store it at json_path """
+        """ Given the path to csv file, convert it to JSONL and store it at json_path (replacing it if it exists) """
         # Get the year from the file name
-        year = findMatches("[0-9]{4}", csv_path)
+        year = findMatches("[0-9]{4}", csv_path.split('/')[-1])
         year = None if year == [] else year[0]
 
-        line_import_errors = 0
-
         with open(csv_path, 'r', errors='replace') as f:
-            json_lines, count = [], 0
-            for line in reader(f):  # iterate through each line using a CSV reader
-                count += 1
-                if count == 1:  # If this is the first line, this is a header.
-                    headers = line
-                    continue
-
-                # Check for errors
-                if len(headers) != len(line):
-                    line_import_errors += 1
-                    continue
-
-                # Package the line as JSON
-                json_line = {'year': year}
-                for i, header in enumerate(headers):
-                    json_line[header] = line[i]
-                json_lines.append(json_line)
-
-        # save json to disk
-        # Open the JSON output file in append mode
-        with open(json_path, "a") as outfile:
-            for line in json_lines:
-                json.dump(line, outfile)
-                outfile.write('\n')
-
+            lines, line_import_errors = csv_to_jsonl(f, json_path, year)
         return line_import_errors
 
-    def import_data(self, replace_existing, limit_to_tables, batch_size = 5000):
+    def import_data(self, replace_existing, limit_to_tables, batch_size = 100000):
         """
         ################################################################################################
         # Imports the data from json files into the database
@@ -508,15 +603,17 @@ class Exporter(Base):
         # INPUTS
         # replace_existing    <Bool>   - When True, all previously downloaded files are replaced.
         # exlcude_data        <list>   - the list of tables you want to ignore.
+        # batch_size          <Int>    - Number of lines read, converted and loaded at a time.
         #-----------------------------------------------------------------------------------------------
         # OUTPUTS
         # When this function is complete, the data will have loaded into the database.
         ################################################################################################
+        Each file is read in batches of columns, which are converted to the type of their database column all at once
+            (see convert_batch()). Each batch is written to a temporary file and bulk loaded with LOAD DATA,
+            while the next batch is converted.
         """
-        #skip_until = 'RePORTER_PRJABS_C_FY1991'
-        #skip_flag = True
         self.log(f'Importing Data into Database from: {self.save_directory}')
-         
+
         folder_path = glob.glob(f"{self.save_directory}/*")
         errors = 0
 
@@ -533,17 +630,16 @@ class Exporter(Base):
             self.log(f"\nImporting data into: {table}")
 
             # Get the data path
-            data_path = glob.glob(folder + '/json/*')
-            
+            data_path = glob.glob(folder + '/json/*.jsonl')
+
             # Sort the data_path
             data_list = [d.split('/')[-1].lower() for d in data_path]
             sindex    = list(np.argsort(data_list))
             data_paths = [data_path[sindex[i]] for i in range(len(data_path))]
-            #print(data_path)
-            #data_path.reverse()
 
             # Get the information on the table we want to insert into
             table_info = self.db.getTableInfo(table)
+            stats = self.get_stats(table)
 
             # If this is the patents table, everything must be wiped.
             if table == 'patents':
@@ -557,14 +653,14 @@ class Exporter(Base):
                 # Get the name of the data file.
                 data_name = data.split('/')[-1]
                 data_name = '.'.join(data_name.split('.')[:-1])
-                
+
                 # Get the version number of the data
                 if (data_name.split('_')[-1][0:2] == 'FY' ) or (data_name.split('_')[-1] == 'new') or  (data_name.split('_')[-1].lower() == 'all'):
                     version_number = 0
                 else:
                     version_number = int(data_name.split('_')[-1])
-                        
-                # Let's see if this data exists or not: 
+
+                # Let's see if this data exists or not:
                 if (data_name in files_already_inserted) and not replace_existing:
                     self.log('...Skipping', data_name)
                     continue
@@ -572,83 +668,130 @@ class Exporter(Base):
                     self.log(f'...Importing "{data_name}" ', end='')
 
                 self.mark_time('t')
-                query_result = None  # async query result
-                with open(data) as f:
-                    query_values = ''
-                    parameters    = []
-                    for ii, line in enumerate(f):  # For each line in the data file...
-                        json_line = json.loads(line)
-
-                        #----------------------------------------------
-                        # Get the line statistics
-                        #----------------------------------------------
-                        keys, values  = '', ''
-                        for real_key, value in json_line.items():
-                            # Get the Keys
-                            key = real_key.lower().replace(' ','_').replace('.','_')
-
-                            # Get the data type
-                            if table_info.get(key):
-                                data_type = table_info.get(key)['data_type']
-                            else:
-                                data_type = None
-
-                            # If this is an int/float, cast non-friendly data to None
-                            if data_type == 'int' and not representsInt(value):
-                                value = None
-                            elif data_type is None:
-                                value = None
-
-                            if value == '':
-                                value = None
-
-                            if value is not None: 
-                                value = value.encode("ascii", "ignore")
-
-                            # If this is a date, parse to SQL format
-                            if data_type == 'date':
-                                try:
-                                    value = parse(value, fuzzy=False)
-                                except:
-                                    errors += 1
-                                    value = None
-
-                            parameters.append(value)
-                            values    += '%s' + ',' 
-                            keys      += key  + ','
-                        
-                        # Finish off by noting the source
-                        keys       += 'source' + ','
-                        values     += '%s'     + ','
-                        parameters += [data_name]
-                        
-                        #... and the version number
-                        keys       += 'version'
-                        values     += '%s'
-                        parameters += [version_number]
-                        
-                        query_values += f"""({values}),"""
-                        
-                        # Insert the batch of data
-                        if query_result is not None:
-                            query_result.wait()  # wait for previous query
-                        if ((ii % batch_size) == 0) and (ii != 0):
-                            query = """INSERT IGNORE INTO {table_name} ({keys}) 
-                                       VALUES {query_values}""".format(table_name = table, keys = keys, query_values = query_values[:-1])
-                            query_result = self.db.query(query,parameters, threaded=True)
-                            query_values = ''
-                            parameters   = []
-
-                    # Insert the last batch
-                    if query_result is not None:
-                        query_result.wait()  # wait for previous query
-                    if query_values != '':
-                        query = """INSERT IGNORE INTO {table_name} ({keys}) 
-                                    VALUES {query_values}""".format(table_name = table, keys = keys, query_values = query_values[:-1])
-                        self.db.query(query,parameters)
-
+                lines, file_errors = self.import_file(table, data, table_info, stats, data_name, version_number, batch_size)
+                errors += file_errors
                 self.add_time('t')
-                self.log(f"...done {self.get_time_last('t')}")
+                self.log(f"...done {self.get_time_last('t')} Lines: {lines:,} Errors: {file_errors:,}")
+
+        self.log(f"Data Import Complete. {self.get_time_total('t')} Errors: {errors:,}")
+        self.clear_time('t')
 
-        self.log("Data Import Complete. ", self.get_time_total('t'))
-        self.clear_time('t')
\ No newline at end of file
+    def get_stats(self, table):
+        """ Column statistics of the table's data computed by characterizeData(), or an empty dictionary if they haven't been computed """
+        path = f"{self.save_directory}/stats/{table}.json"
+        if not os.path.exists(path): return {}
+        with open(path) as f:
+            return json.load(f)
+
+    def import_file(self, table, path, table_info, stats, source, version, batch_size):
+        """
+        Load a JSON lines file into the table in batches.
+        Each batch is bulk loaded in the background while the next one is read and converted.
+        If any rows couldn't be inserted, the rows of the file are deleted again, so the file is imported again next time.
+        Returns the number of lines read, and the number of values which couldn't be converted to their column type plus
+            the number of rows which couldn't be inserted.
+        """
+        lines, errors, failed = 0, 0, 0
+        pending = None  # (AsyncResult, batch file, rows) of the load in progress
+        with open(path) as f:
+            batch_number = 0
+            while True:
+                records = [json.loads(line) for line in itertools.islice(f, batch_size)]
+                if not records: break
+
+                df = pd.DataFrame.from_records(records)
+                df.columns = [key.lower().replace(' ','_').replace('.','_') for key in df.columns]
+                df = df.loc[:, ~df.columns.duplicated()]
+                df, batch_errors = self.convert_batch(df, table_info, stats)
+                df['source'] = source  # Finish off by noting the source
+                df['version'] = version  # ... and the version number
+                errors += batch_errors
+                lines += len(df)
+
+                batch_path = f"{path}.{batch_number}.load"
+                self.write_load_file(df, batch_path)
+                if pending: failed += self.finish_load(table, *pending)
+                pending = (self.db.load_data(table, list(df.columns), batch_path, threaded=True), batch_path, df)
+                batch_number += 1
+
+        if pending: failed += self.finish_load(table, *pending)
+        if failed:
+            self.err(f"{failed:,} rows of {source} could not be inserted. Removing its rows so it is imported again next time.")
+            if self.db.query(f"DELETE FROM {table} WHERE source = %s", [source]) is None:
+                self.err(f"Failed to remove the rows of {source}. Import it again with replace_existing.")
+        return lines, errors + failed
+
+    def finish_load(self, table, result, batch_path, df):
+        """
+        Wait for a batch to be loaded and remove its file.
+        If LOAD DATA failed (e.g. local_infile is disabled), the batch is inserted with multi-row INSERT statements instead.
+        Returns the number of rows which couldn't be inserted either way.
+        """
+        loaded = result.get()
+        os.remove(batch_path)
+        if loaded is not None:
+            return 0
+
+        self.debug(f"LOAD DATA failed for {batch_path}. Inserting rows instead.")
+        failed = 0
+        rows = df.astype(object).where(df.notna(), None).values.tolist()
+        for batch in self.batch_list(rows, 5000):
+            if self.db.insert_row(table, list(df.columns), batch) is None:  # MySQLDatabase.query() returns None on failure
+                failed += len(batch)
+        return failed
+
+    def convert_batch(self, df, table_info, stats):
+        """
+        Convert each column of a batch of string values to the type of its database column, a whole column at a time.
+            int: whole numbers only, otherwise NULL
+            float/double/decimal: any number, otherwise NULL
+            date/datetime: any date format, otherwise NULL
+            other types: strings with non-ASCII characters removed
+        Empty strings become NULL, and columns which aren't in the table are dropped.
+        If characterizeData() found that every value of an int column was a whole number, the values are converted
+            without checking each one first.
+        Returns the converted DataFrame and the number of values which couldn't be converted.
+        """
+        errors = 0
+        df = df[[col for col in df.columns if col in table_info]].copy()
+        df = df.where(df != '')  # empty strings are NULL
+        for col in df.columns:
+            data_type = table_info[col]['data_type']
+            values = df[col].astype(object)
+            present = values.notna()
+
+            if data_type in ('int', 'bigint', 'smallint', 'tinyint', 'mediumint'):
+                types = stats.get(col, {}).get('data_type', {})
+                if not (types.get('INT') and not any(types.get(t) for t in ('FLOAT', 'DATE', 'VARCHAR'))):
+                    values = values.where(values.astype(str).str.fullmatch(r'\s*[+-]?\d+\s*'))  # only whole numbers
+                values = pd.to_numeric(values.str.strip(), errors='coerce')
+                values = values.where(values % 1 == 0).astype('Int64')
+                errors += int((present & values.isna()).sum())
+            elif data_type in ('float', 'double', 'decimal'):
+                values = pd.to_numeric(values.str.strip(), errors='coerce')
+                errors += int((present & values.isna()).sum())
+            elif data_type in ('date', 'datetime', 'timestamp'):
+                values = pd.to_datetime(values, errors='coerce')
+                errors += int((present & values.isna()).sum())
+                values = values.dt.strftime('%Y-%m-%d' if data_type == 'date' else '%Y-%m-%d %H:%M:%S')
+            else:
+                values = values.astype(str).str.encode('ascii', 'ignore').str.decode('ascii').where(present)
+            df[col] = values
+        return df, errors
+
+    def write_load_file(self, df, path):
+        """ Write a converted batch to a file in the default LOAD DATA format (see MySQLDatabase.load_data()) """
+        columns = []
+        for col in df.columns:
+            present = df[col].notna()
+            values = df[col].astype(object).where(present, '').astype(str)
+            if df[col].dtype == object:  # escape text
+                values = values.str.replace('\\', '\\\\', regex=False).str.replace('\t', '\\t', regex=False)
+                values = values.str.replace('\n', '\\n', regex=False).str.replace('\r', '\\r', regex=False)
+            columns.append(values.where(present, '\\N').tolist())  # \N is NULL
+
+        temp = f"{path}.tmp"
+        with open(temp, 'w', encoding='utf-8') as f:
+            for row in zip(*columns):
+                f.write('\t'.join(row) + '\n')
+        os.replace(temp, path)
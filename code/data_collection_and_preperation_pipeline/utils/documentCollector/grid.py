@@ -1,6 +1,6 @@
 from utils.generalPurpose.generalPurpose import *
-from utils.database.database import database
-from configuration.config import config
+from utils.database.database import MySQLDatabase
+from utils.base import Base
 from dateutil.parser import parse
 import json
 import requests
@@ -11,6 +11,7 @@ import datetime
 import time
 import glob
 import re
+import io
 import wget
 from zipfile import ZipFile
 from csv import reader
@@ -25,10 +26,25 @@ import itertools
 if (not os.environ.get('PYTHONHTTPSVERIFY', '') and getattr(ssl, '_create_unverified_context', None)):
     ssl._create_default_https_context = ssl._create_unverified_context
 
-class grid:
+class grid(Base):
     
-    def __init__(self):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
         self.base_url = 'https://grid.ac/downloads'
+        self.db = MySQLDatabase()
+
+        # Columns of each GRID table, in the order of the fields in its CSV file, and the type of the non-text columns
+        self.tables = {'labels'        : {'columns' : ['grid_id','iso639','label']},
+                       'types'         : {'columns' : ['grid_id', 'type']},
+                       'relationships' : {'columns' : ['grid_id','relationship_type','related_grid_id']},
+                       'links'         : {'columns' : ['grid_id', 'link']},
+                       'institutes'    : {'columns' : ['grid_id','name','wikipedia_url','established']},
+                       'aliases'       : {'columns' : ['grid_id','alias']},
+                       'external_ids'  : {'columns' : ['grid_id','external_id_type','external_id']},
+                       'acronyms'      : {'columns' : ['grid_id','acronym']},
+                       'addresses'     : {'columns' : ['grid_id','lat','lng','postcode','is_primary','city','state','state_code','country','country_code','geonames_city_id'],
+                                          'types'   : {'lat': float, 'lng': float, 'geonames_city_id': int}}
+                      }
                      
     def updateGRID(self):
         self.collect()
@@ -37,7 +53,7 @@ class grid:
     
     
     def collect(self, replace_existing = False, limit_to_tables = []):
-        save_directory  = config['data_directory'] + 'GRID/'
+        save_directory  = self.config.data_directory + '/GRID/'
         requires_update = []
 
         # For each of the Exporter tabs
@@ -69,84 +85,121 @@ class grid:
             zipObj.extractall(path = save_directory + '/unzipped/')
 
             
-    def ingestData(self):
+    def ingestData(self, chunk_size=100000):
+        """
+        Import the unzipped GRID tables. Each CSV file is read <chunk_size> rows at a time, and each chunk is converted
+            to the column types and bulk loaded into a copy of the table (see load_table()).
+        """
+        self.log('------------------------------------------------')
+        self.log('Importing Latest GRID Data ')
+        self.log('------------------------------------------------')
 
-        # For each of the Exporter tabs
-        print('------------------------------------------------')
-        print('Importing Latest GRID Data ')
-        print('------------------------------------------------')
-        
-        def byrow_imper(lod, keylist):
-            # imperative/procedural approach
-            lol = []
-            for row in lod:
-                row2 = []
-                for key in keylist:
-                    row2.append(row[key])
-                lol.append(row2)
-            return lol
+        self.mark_time('grid')
+        total = 0
+        for table, info in self.tables.items():
+            total += self.load_table(table, info, chunk_size)
+        self.log(f"GRID import complete: {total:,} rows in {self.get_time_total('grid')}")
+
+    def load_table(self, table, info, chunk_size):
+        """
+        Load a GRID table from its CSV file. Rows are loaded into a new copy of the table, which replaces the table
+            in one RENAME only once every row is loaded, so a failed import leaves the previous table as it was.
+        Returns the number of rows read.
+        """
+        path = f"{self.config.data_directory}/GRID/unzipped/full_tables/{table}.csv"
+        load_table = f"{table}_load"
+        columns = info['columns']
+        types = info.get('types', {})
+        load_file = f"{path}.load"
 
+        self.db.query(f"DROP TABLE IF EXISTS grid.`{load_table}`")
+        if self.db.query(f"CREATE TABLE grid.`{load_table}` LIKE grid.`{table}`") is None:
+            raise Exception(f"Failed to create grid.{load_table}. Were the GRID tables generated?")
 
-        db = database(); db.database = 'grid'
+        self.log(f".... importing {table}")
+        self.mark_time(table)
+        size = max(os.path.getsize(path), 1)
+        rows, errors = 0, 0
+        try:
+            with open(path, 'rb') as raw:
+                reader = csv.DictReader(io.TextIOWrapper(raw, encoding='utf-8', newline=''), skipinitialspace=True)
+                while True:
+                    chunk = list(itertools.islice(reader, chunk_size))
+                    if not chunk: break
+                    parameters, chunk_errors = self.convert_rows(chunk, columns, types)
+                    errors += chunk_errors
 
+                    self.write_load_file(parameters, load_file)
+                    if self.db.load_data(f"grid.{load_table}", columns, load_file) is None:  # e.g. local_infile disabled - insert instead
+                        for batch in self.batch_list(parameters, 10000):  # keep each statement well under max_allowed_packet
+                            if self.db.insert_row(f"grid.{load_table}", columns, batch) is None:
+                                raise Exception(f"Failed to insert into grid.{load_table}")
+                    rows += len(chunk)
 
-        res = {'labels'        : {'columns' : ['grid_id','iso639','label']},
-               'types'         : {'columns' : ['grid_id', 'type']},
-               'relationships' : {'columns' : ['grid_id','relationship_type','related_grid_id']},
-               'links'         : {'columns' : ['grid_id', 'link']},
-               'institutes'    : {'columns' : ['grid_id','name','wikipedia_url','established']},
-               'aliases'       : {'columns' : ['grid_id','alias']},
-               'external_ids'  : {'columns' : ['grid_id','external_id_type','external_id']},
-               'acronyms'      : {'columns' : ['grid_id','acronym']},
-               'addresses'     : {'columns' : ['grid_id','lat','lng','postcode','is_primary','city','state','state_code','country','country_code','geonames_city_id']}
-              }; 
+                    progress = f"{min(100, round(100 * raw.tell() / size, 1))}%"  # share of the file read
+                    rate = rows / max(time.time() - self.times[table]['start'], 1e-9)
+                    self.log(f"{progress:>8} | {self.get_time_total(table):<10} | {rows:,} rows | {rate:,.0f} rows/s")
+        except Exception:
+            self.db.query(f"DROP TABLE IF EXISTS grid.`{load_table}`")
+            raise
+        finally:
+            if os.path.exists(load_file): os.remove(load_file)
 
+        # swap the loaded copy in
+        self.db.query(f"DROP TABLE IF EXISTS grid.`{table}_old`")
+        if self.db.query(f"RENAME TABLE grid.`{table}` TO grid.`{table}_old`, grid.`{load_table}` TO grid.`{table}`") is None:
+            raise Exception(f"Failed to replace grid.{table} with the imported rows")
+        self.db.query(f"DROP TABLE grid.`{table}_old`")
 
-        for key,val in res.items():
-            table    = key
-            
-            print('.... importing', table)
-            
-            location = f"""{config['data_directory']}/GRID/unzipped/full_tables/{key}.csv"""
-            with open(location) as f:
-                a = []
-                for row in csv.DictReader(f, skipinitialspace=True):
-                    rval = {k : None for k in res[key]['columns'] }
-                    for k,v in row.items():
-                        if v != '':
-                            rval[k] = v
-                    a.append(rval) 
-                columns    = res[key]['columns']
-                parameters = byrow_imper(a,res[key]['columns'])
+        self.log(f".... {table}: {rows:,} rows in {self.get_time_total(table)}{f' ({errors:,} values could not be converted)' if errors else ''}")
+        self.clear_time(table)
+        return rows
 
+    def convert_rows(self, chunk, columns, types):
+        """
+        Convert CSV rows (dicts) to lists of column values. Empty values become None, and values of typed columns are
+            converted to their type (None if they can't be). Returns the rows and the number of values that couldn't be converted.
+        """
+        parameters, errors = [], 0
+        for row in chunk:
+            values = []
+            for column in columns:
+                value = row.get(column)
+                if value == '' or value is None:
+                    value = None
+                elif column in types:
+                    try:
+                        value = types[column](value)
+                    except ValueError:
+                        value, errors = None, errors + 1
+                values.append(value)
+            parameters.append(values)
+        return parameters, errors
 
-            # Construct the query we will execute to insert the row(s)
-            keys       = ','.join(columns)
-            values     = ','.join(['%s' for x in columns])
-            query = f"""INSERT IGNORE INTO {table} ({keys}) VALUES """
+    def write_load_file(self, parameters, path):
+        """ Write rows to a file in the default LOAD DATA format (see MySQLDatabase.load_data()) """
+        def escape(value):
+            if value is None: return '\\N'
+            value = str(value)
+            return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
 
-            for p in parameters:
-                query += f"""({values}),"""
-            query     = query[:-1] 
-            parameters = list(itertools.chain(*parameters))
+        with open(path, 'w', encoding='utf-8') as f:
+            for values in parameters:
+                f.write('\t'.join(escape(value) for value in values) + '\n')
 
-            # Indicates if we should skip the insert - this is useful for testing things. 
-            db.query(query,parameters)        
-        
-        
         
     def generateTables(self):
         
-        db = database(); db.database = 'grid'
+        db = self.db
         db.query("""CREATE DATABASE IF NOT EXISTS grid""")
          
         print('------------------------------------------------')
         print(' Creating GRID Tables                           ')
         print('------------------------------------------------') 
         
-        db.query("""DROP TABLE IF EXISTS `labels`;""")
+        db.query("""DROP TABLE IF EXISTS grid.`labels`;""")
         query = """
-        CREATE TABLE IF NOT EXISTS `labels` (
+        CREATE TABLE IF NOT EXISTS grid.`labels` (
                               `grid_id`              varchar(14)   COMMENT 'The unique identifier for the institution.',
                               `iso639`               varchar(3)    DEFAULT NULL  COMMENT 'The country code of the institution.',
                               `label`                varchar(200)  DEFAULT NULL  COMMENT 'The name of the institution',  
@@ -156,9 +209,9 @@ class grid:
         db.query(query)
         print('.... `labels` table created')
         
-        db.query("""DROP TABLE IF EXISTS `types`;""")
+        db.query("""DROP TABLE IF EXISTS grid.`types`;""")
         query = """
-        CREATE TABLE IF NOT EXISTS `types` (
+        CREATE TABLE IF NOT EXISTS grid.`types` (
                               `grid_id`  varchar(14)  COMMENT 'The unique identifier for the institution.',
                               `type`     varchar(12)  DEFAULT NULL  COMMENT 'The type of the institution: Company, Education, Nonprofit, etc.',
                                KEY (`grid_id`)
@@ -167,9 +220,9 @@ class grid:
         db.query(query)
         print('.... `types` table created')
         
-        db.query("""DROP TABLE IF EXISTS `relationships`;""")
+        db.query("""DROP TABLE IF EXISTS grid.`relationships`;""")
         query = """
-        CREATE TABLE IF NOT EXISTS `relationships` (
+        CREATE TABLE IF NOT EXISTS grid.`relationships` (
                               `grid_id`            varchar(14)  COMMENT 'The unique identifier for the institution.',
                               `relationship_type`  varchar(10)  DEFAULT NULL  COMMENT 'The nature of the relationship between the grid_id pair in this row',
                               `related_grid_id`    varchar(14)  DEFAULT NULL  COMMENT 'The unique identifier for the realted institution.',
@@ -181,9 +234,9 @@ class grid:
         
         
         
-        db.query("""DROP TABLE IF EXISTS `links`;""")
+        db.query("""DROP TABLE IF EXISTS grid.`links`;""")
         query = """
-        CREATE TABLE IF NOT EXISTS `links` (
+        CREATE TABLE IF NOT EXISTS grid.`links` (
                               `grid_id`            varchar(14)   COMMENT 'The unique identifier for the institution.',
                               `link`               varchar(200)  DEFAULT NULL  COMMENT 'the website of the institution,',
                                KEY (`grid_id`)
@@ -193,9 +246,9 @@ class grid:
         print('.... `links` table created')
         
         
-        db.query("""DROP TABLE IF EXISTS `institutes`;""")
+        db.query("""DROP TABLE IF EXISTS grid.`institutes`;""")
         query = """
-        CREATE TABLE IF NOT EXISTS `institutes` (
+        CREATE TABLE IF NOT EXISTS grid.`institutes` (
                               `grid_id`              varchar(14)   COMMENT 'The unique identifier for the institution.',
                               `name`                 varchar(200)  DEFAULT NULL COMMENT 'The name of the institution.',
                               `wikipedia_url`        varchar(500)  DEFAULT NULL  COMMENT 'The wikipedia URL of the institution.', 
@@ -206,9 +259,9 @@ class grid:
         db.query(query)
         print('.... `institutes` table created')
         
-        db.query("""DROP TABLE IF EXISTS `aliases`;""")
+        db.query("""DROP TABLE IF EXISTS grid.`aliases`;""")
         query = """
-        CREATE TABLE IF NOT EXISTS `aliases` (
+        CREATE TABLE IF NOT EXISTS grid.`aliases` (
                               `grid_id`              varchar(14)   COMMENT 'The unique identifier for the institution.',
                               `alias`                varchar(200)  DEFAULT NULL  COMMENT 'The alias of the institution',  
                                KEY (`grid_id`)
@@ -219,9 +272,9 @@ class grid:
         
         
         
-        db.query("""DROP TABLE IF EXISTS `external_ids`;""")
+        db.query("""DROP TABLE IF EXISTS grid.`external_ids`;""")
         query = """
-        CREATE TABLE IF NOT EXISTS `external_ids` (
+        CREATE TABLE IF NOT EXISTS grid.`external_ids` (
                               `grid_id`              varchar(14)    COMMENT 'The unique identifier for the institution.',
                               `external_id_type`     varchar(14)    DEFAULT NULL COMMENT 'The type of the external id',
                               `external_id`          varchar(50)    DEFAULT NULL  COMMENT 'The external id',  
@@ -233,9 +286,9 @@ class grid:
         
         
         
-        db.query("""DROP TABLE IF EXISTS `addresses`""")
+        db.query("""DROP TABLE IF EXISTS grid.`addresses`""")
         query = """
-        CREATE TABLE IF NOT EXISTS `addresses` (
+        CREATE TABLE IF NOT EXISTS grid.`addresses` (
         `grid_id` 			varchar(14)   COMMENT 'The unique identifier for the institution.',
         `lat`     			float         DEFAULT NULL	COMMENT 'The latitude of the institution.',				
         `lng`	  			float		  DEFAULT NULL	COMMENT 'The longitude of the institution',
@@ -254,9 +307,9 @@ class grid:
         print('.... `addresses` table created')
         
         # -----------------------------------------------
-        db.query("""DROP TABLE IF EXISTS `acronyms`""")
+        db.query("""DROP TABLE IF EXISTS grid.`acronyms`""")
         query = """
-        CREATE TABLE IF NOT EXISTS `acronyms` (
+        CREATE TABLE IF NOT EXISTS grid.`acronyms` (
                               `grid_id`              varchar(14)  COMMENT 'The unique identifier for the institution.',
                               `acronym`              varchar(50)  DEFAULT NULL  COMMENT 'The acronym of the institution',  
                                KEY (`grid_id`)
@@ -0,0 +1,213 @@
+from utils.database.database import MySQLDatabase
+from utils.affiliationParser.matcher import GridMatcher
+from utils.affiliationParser.utils import download_grid_data
+from utils.base import Base
+from multiprocessing import Pool, cpu_count
+from queue import Queue
+import json
+import time
+import os
+
+
+# GridMatcher of each worker process, loaded once by init_worker()
+worker_matcher = None
+
+
+def init_worker(csv_path, min_score):
+    """ Load the GRID matcher of a worker process """
+    global worker_matcher
+    worker_matcher = (GridMatcher(csv_path), min_score)
+
+
+def match_tuples(rows):
+    """ Match a chunk of grid_links rows in a worker process. Returns a list of (tuple_id, grid_id, score) """
+    matcher, min_score = worker_matcher
+    matches = matcher.match(rows, min_score=min_score)
+    return [(row['tuple_id'], match[0]['grid_id'] if match else None, match[0]['score'] if match else None)
+            for row, match in zip(rows, matches)]
+
+
+class GridLinker(Base):
+    """
+    Back-fills affiliations.grid_id for affiliations already in the database, in three resumable stages:
+        1. stage: the distinct (institution, location, country) tuples of unlinked affiliations are copied to the
+            grid_links table, in ranges of affiliation_num. Each tuple is stored once, keyed by a hash of its values.
+        2. match: tuples not yet matched are matched to GRID institutions in chunks, in parallel processes which each
+            load a GridMatcher once. The best match (if any scores at least <min_score>) is saved in grid_links.
+        3. update: affiliations are joined to their tuple's match by the hash, in ranges of affiliation_num.
+    Tuples are far fewer than affiliations, so each is only matched once. Matching resumes from the unmatched tuples,
+        and staging and updating from the last affiliation_num range saved in the checkpoint file.
+    """
+    def __init__(self, *args, csv_path=None, min_score=0.8, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.db = MySQLDatabase()
+        self.csv_path = csv_path  # GRID CSV, downloaded by default (see GridMatcher)
+        self.min_score = min_score  # lowest GridMatcher score accepted as a link
+        self.checkpoint_file = os.path.join(self.config.data_directory, 'grid', 'link_checkpoint.json')
+
+        # hash of an affiliation's (institution, location, country), in SQL
+        self.tuple_hash = "UNHEX(SHA1(CONCAT_WS(0x1F, IFNULL({0}institution, ''), IFNULL({0}location, ''), IFNULL({0}country, ''))))"
+
+    def generateTables(self):
+        query = """
+        CREATE TABLE IF NOT EXISTS `grid_links` (
+                  `tuple_id`     int unsigned  NOT NULL AUTO_INCREMENT,
+                  `tuple_hash`   binary(20)    NOT NULL                  COMMENT 'SHA-1 of the institution, location and country.',
+                  `institution`  TEXT          DEFAULT NULL              COMMENT 'The parsed institution of the affiliations.',
+                  `location`     TEXT          DEFAULT NULL              COMMENT 'The parsed location of the affiliations.',
+                  `country`      varchar(100)  DEFAULT NULL              COMMENT 'The parsed country of the affiliations.',
+                  `matched`      tinyint(1)    NOT NULL DEFAULT 0        COMMENT 'Whether the tuple was matched to GRID (1), even when no institution was found.',
+                  `grid_id`      varchar(14)   DEFAULT NULL              COMMENT 'The best matching GRID institution, if any.',
+                  `score`        float         DEFAULT NULL              COMMENT 'The GridMatcher score of the match.',
+                  PRIMARY KEY (`tuple_id`),
+                  UNIQUE KEY `grid_links_hash_index` (`tuple_hash`),
+                  KEY `grid_links_matched_index` (`matched`, `tuple_id`)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COMMENT "Distinct parsed affiliations and their GRID institution.";
+        """
+        self.db.query(query)
+
+    def load_checkpoint(self):
+        """ affiliation_num up to which affiliations have been staged and updated """
+        if not os.path.exists(self.checkpoint_file):
+            return {'staged': 0, 'updated': 0}
+        with open(self.checkpoint_file) as file:
+            return json.load(file)
+
+    def save_checkpoint(self, checkpoint):
+        self.ensure_path(self.checkpoint_file, file=True)
+        with open(self.checkpoint_file + '.tmp', 'w') as file:
+            json.dump(checkpoint, file)
+        os.replace(self.checkpoint_file + '.tmp', self.checkpoint_file)
+
+    def run(self, chunk_size=1000, range_size=1000000, processes=None, restart=False):
+        """
+        Link all unlinked affiliations to GRID institutions.
+        <chunk_size> tuples matched by a worker process at a time.
+        <range_size> affiliation_num range staged or updated by each query.
+        <processes> worker processes matching tuples. Defaults to the number of CPUs.
+        <restart> ignore the checkpoint, and stage and update all affiliations again. Matched tuples are kept.
+        """
+        self.log('------------------------------')
+        self.log('Linking affiliations to GRID institutions')
+        self.generateTables()
+        checkpoint = {'staged': 0, 'updated': 0} if restart else self.load_checkpoint()
+        last = self.db.query("SELECT MAX(affiliation_num) as last FROM affiliations")
+        last = (last[0]['last'] or 0) if last else 0
+
+        self.stage(checkpoint, last, range_size)
+        csv_path = self.csv_path or download_grid_data()  # once, before the worker processes each load it
+        self.match(chunk_size, processes or cpu_count(), csv_path)
+        self.update(checkpoint, last, range_size)
+        self.log(f"GRID linking complete ({self.get_time_total('link')})")
+
+    def stage(self, checkpoint, last, range_size):
+        """ Copy the distinct tuples of unlinked affiliations after the checkpoint to grid_links """
+        self.log(f"Staging affiliations {checkpoint['staged']+1:,} to {last:,}...")
+        self.mark_time('link')
+        start, total, t0 = checkpoint['staged'], max(last - checkpoint['staged'], 1), time.time()
+        while checkpoint['staged'] < last:
+            end = min(checkpoint['staged'] + range_size, last)
+            result = self.db.query(f"""
+                INSERT IGNORE INTO grid_links (tuple_hash, institution, location, country)
+                SELECT DISTINCT {self.tuple_hash.format('')}, institution, location, country
+                FROM affiliations
+                WHERE affiliation_num > %s AND affiliation_num <= %s
+                AND grid_id IS NULL AND affiliation IS NOT NULL
+            """, [checkpoint['staged'], end])
+            if result is None:
+                raise Exception(f"Failed to stage affiliations {checkpoint['staged']+1:,} to {end:,}")
+            checkpoint['staged'] = end
+            self.save_checkpoint(checkpoint)
+
+            progress = self.progress(end - start - 1, total, every=1)
+            if progress:
+                rate = (end - start) / (time.time() - t0)
+                self.log(f"{progress} | {self.get_time_total('link'):<10} | affiliation {end:,} | {rate:,.0f} affiliations/s")
+        self.add_time('link')
+
+    def match(self, chunk_size, processes, csv_path):
+        """ Match all unmatched tuples in parallel, saving the results as chunks finish. <csv_path> GRID CSV loaded by each process. """
+        total = self.db.query("SELECT COUNT(*) as total FROM grid_links WHERE matched = 0")
+        total = total[0]['total'] if total else 0
+        self.log(f"Matching {total:,} distinct affiliations with {processes} processes...")
+        if not total: return
+
+        def chunks():  # unmatched tuples in order of tuple_id
+            after = 0
+            while True:
+                rows = self.db.query("""
+                    SELECT tuple_id, institution, location, country
+                    FROM grid_links
+                    WHERE matched = 0 AND tuple_id > %s
+                    ORDER BY tuple_id
+                    LIMIT %s
+                """, [after, chunk_size * processes])
+                if not rows: return
+                after = rows[-1]['tuple_id']
+                for chunk in self.batch_list(rows, chunk_size):
+                    yield chunk
+
+        def finish(insert):  # wait for an upsert of matches. Failed tuples stay unmatched, so stop before update() runs.
+            if insert.get() is None:  # MySQLDatabase.query() returns None on failure
+                raise Exception("Failed to save matched tuples to grid_links. Run again to match the tuples left.")
+
+        self.mark_time('link')
+        matched, linked, inserts, t0 = 0, 0, [], time.time()
+        finished = Queue()  # results of the chunks matched, or the exception of a chunk which failed
+        with Pool(processes, initializer=init_worker, initargs=(csv_path, self.min_score)) as pool:
+            feed, pending, i = chunks(), 0, 0
+            while True:
+                for chunk in feed:  # keep two chunks per process in flight. The next page is only read as chunks finish.
+                    pool.apply_async(match_tuples, [chunk], callback=finished.put, error_callback=finished.put)
+                    pending += 1
+                    if pending >= 2 * processes: break
+                if not pending: break
+                results = finished.get()
+                pending -= 1
+                if isinstance(results, Exception): raise results
+
+                for insert in inserts[:-1]:  # keep at most two inserts in flight
+                    finish(insert)
+                inserts = inserts[-1:]
+                insert = self.db.insert_row('grid_links', ['tuple_id', 'matched', 'grid_id', 'score'],
+                                            [[tuple_id, 1, grid_id, score] for tuple_id, grid_id, score in results],
+                                            threaded=True, update=True)
+                if insert is not None: inserts.append(insert)
+
+                i += 1
+                matched += len(results)
+                linked += sum(grid_id is not None for _, grid_id, _ in results)
+                if i % processes and matched < total: continue  # show progress once per round of chunks
+                progress = self.progress(matched - 1, total, every=1)
+                if progress:
+                    rate = matched / (time.time() - t0)
+                    self.log(f"{progress} | {self.get_time_total('link'):<10} | {matched:,} matched | {linked:,} linked | {rate:,.0f} affiliations/s")
+        for insert in inserts:
+            finish(insert)
+        self.add_time('link')
+        self.log(f"Matched {matched:,} distinct affiliations, {linked:,} to a GRID institution ({self.format_seconds(time.time() - t0)})")
+
+    def update(self, checkpoint, last, range_size):
+        """ Set the grid_id of affiliations after the checkpoint to their tuple's match """
+        self.log(f"Updating affiliations {checkpoint['updated']+1:,} to {last:,}...")
+        self.mark_time('link')
+        start, total, t0 = checkpoint['updated'], max(last - checkpoint['updated'], 1), time.time()
+        while checkpoint['updated'] < last:
+            end = min(checkpoint['updated'] + range_size, last)
+            result = self.db.query(f"""
+                UPDATE affiliations a
+                JOIN grid_links g ON g.tuple_hash = {self.tuple_hash.format('a.')}
+                SET a.grid_id = g.grid_id
+                WHERE a.affiliation_num > %s AND a.affiliation_num <= %s
+                AND a.grid_id IS NULL AND g.grid_id IS NOT NULL
+            """, [checkpoint['updated'], end])
+            if result is None:
+                raise Exception(f"Failed to update affiliations {checkpoint['updated']+1:,} to {end:,}")
+            checkpoint['updated'] = end
+            self.save_checkpoint(checkpoint)
+
+            progress = self.progress(end - start - 1, total, every=1)
+            if progress:
+                rate = (end - start) / (time.time() - t0)
+                self.log(f"{progress} | {self.get_time_total('link'):<10} | affiliation {end:,} | {rate:,.0f} affiliations/s")
+        self.add_time('link')
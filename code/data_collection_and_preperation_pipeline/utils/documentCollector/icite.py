@@ -1,6 +1,13 @@
 from utils.database.database import MySQLDatabase
 from utils.base import Base, ThreadQueue
+from requests.adapters import HTTPAdapter
+from threading import local
+from datetime import datetime, date, timedelta
 import requests
+import random
+import json
+import time
+import os
 
 
 class iCite(Base):
@@ -14,8 +21,23 @@ class iCite(Base):
         super().__init__(*args, **kwargs)
         self.url = "https://icite.od.nih.gov/api"
 
-        # AsyncResult to wait on for database inserts
-        self.database_insert = None
+        # request retries
+        self.max_request_tries = 5  # attempts per batch before it is recorded as failed
+        self.backoff = 2  # seconds to wait after the first failed attempt, doubled after each following one
+        self.max_backoff = 60
+        self.timeout = 60  # request timeout in seconds
+
+        self.sessions = local()  # HTTP session of each request thread, so connections are kept alive between requests
+
+        # Ledger of PMID batches which failed every attempt. They are requested again on the next run.
+        self.failed_file = os.path.join(self.config.data_directory, 'icite', 'failed_batches.jsonl')
+
+        self.max_inserts = 2  # database inserts in flight at once
+
+        # Incremental refresh (see get_refresh_pmids())
+        self.refresh_file = os.path.join(self.config.data_directory, 'icite', 'refresh.json')  # date and rotation slice of the last refresh
+        self.recent_days = 730  # papers published within this many days are always refreshed
+        self.rotation = 12  # older papers are refreshed once every this many refreshes
 
         # All database columns. These also correspond to the iCite API response data keys
         self.columns = ['pmid', 'relative_citation_ratio', 'nih_percentile', 'apt', 'citation_count', 'citations_per_year', 'field_citation_rate']
@@ -23,26 +45,38 @@ class iCite(Base):
 
         self.db = MySQLDatabase()
 
-    def run(self, replace=True, test=False):
-        """ Add the table and populate it """
+    def run(self, replace=False, test=False, refresh=False):
+        """
+        Add the table and populate it.
+        <replace> request every PMID in the documents table again, instead of only those not yet in the table.
+        <refresh> also request the PMIDs whose stats are likely to have changed since the last refresh (see get_refresh_pmids()).
+        Existing rows are updated in place, so the table is never empty while it is repopulated.
+        """
         self.log("-----------------------------")
         self.log("Beginning iCite collection...")
         self.log(f"Replacement: {replace}")
+        self.log(f"Refresh: {refresh}")
 
-        if replace:
-            self.log("Dropping citation stats tables...")
-            self.db.query(f"DROP TABLE IF EXISTS `{self.table_name}`")
         self.create_table()
 
-        pmids = self.get_pmids_in_database(replace, test)
+        pmids = [str(pmid) for pmid in self.get_pmids_in_database(replace, test)]
+        if refresh and not replace:
+            state = self.get_refresh_state()
+            pmids = list(dict.fromkeys(pmids + self.get_refresh_pmids(state, test)))  # without duplicates
+        failed = self.get_failed_pmids()  # batches that failed in the last run
+        if failed and not test:
+            self.log(f"Retrying {len(failed):,} papers from the failed batch ledger")
+            pmids = list(dict.fromkeys(pmids + failed))
         if not len(pmids):
             self.log(f"iCite cannot populate database. No PMIDs found in documents table that weren't already in the {self.table_name} table")
             return
 
-        self.collect(pmids)
+        self.collect(pmids, update=replace or refresh)
+        if refresh and not replace and not test:
+            self.save_refresh_state(state)
 
     def create_table(self):
-        """ Destroyes and re-creates the citation data table """
+        """ Creates the citation data table if it doesn't exist """
         self.log("Creating Citation Stats table if not exists...")
         query = f"""
         CREATE TABLE IF NOT EXISTS `{self.table_name}` (
@@ -61,27 +95,6 @@ class iCite(Base):
         """
         self.db.query(query)
 
-    def insert(self, rows):
-        """
-        Insert rows into the database.
-        <rows> should be a list of lists of items for their respective column.
-        """
-        if not len(rows): return  # nothing to insert
-        assert len(rows[0]) == len(self.columns), "Length of rows to insert do not match length of columns."
-        # construct values in this row for the INSERT statement
-        row_values = []
-        for row in rows:
-            row = [str(x) if x is not None else "NULL" for x in row]
-            row_values.append(f"({', '.join(row)})")
-
-        query = f"""
-        INSERT IGNORE `citation_stats` ({', '.join(self.columns)})
-        VALUES {', '.join(row_values)}
-        """
-        if self.database_insert is not None:
-            self.database_insert.wait()  # wait for last insert to finish
-        self.database_insert = self.db.query(query, threaded=True)
-
     def get_pmids_in_database(self, replace=True, test=False):
         """ Retrieves a list of all PMIDs collected in the database. Optionally run in test mode, which limits to 50 papers """
         limit = '' if not test else "LIMIT 50"
@@ -106,52 +119,175 @@ class iCite(Base):
         self.clear_time('query')
         return [row['pmid'] for row in rows]
 
+    def get_refresh_state(self):
+        """ The date of the last refresh, and the rotation slice of older papers to refresh next """
+        if not os.path.exists(self.refresh_file):
+            return {'date': None, 'slice': 0}
+        with open(self.refresh_file) as file:
+            return json.load(file)
+
+    def save_refresh_state(self, state):
+        """ Record a completed refresh, and move on to the next rotation slice """
+        self.ensure_path(self.refresh_file, file=True)
+        with open(self.refresh_file + '.tmp', 'w') as file:
+            json.dump({'date': date.today().isoformat(), 'slice': (state['slice'] + 1) % self.rotation}, file)
+        os.replace(self.refresh_file + '.tmp', self.refresh_file)
+
+    def get_refresh_pmids(self, state, test=False):
+        """
+        PMIDs already in the citation stats table whose stats are likely to have changed, in order of priority:
+            Papers cited by a paper in the citations table dated within a month before the last refresh or later.
+            Papers published within the last <recent_days> days.
+            Older papers whose PMID is in the rotation slice of this refresh (PMID mod <rotation>), so each is refreshed
+                once every <rotation> refreshes.
+        """
+        limit = '' if not test else "LIMIT 50"
+        queries = []
+        if state['date']:  # papers collected last time were published up to about a month before it
+            since = date.fromisoformat(state['date']) - timedelta(days=31)
+            queries.append(("newly cited", f"""
+                SELECT DISTINCT c.pmid FROM citations c
+                JOIN {self.table_name} s ON c.pmid = s.pmid
+                WHERE c.citation_date >= %s {limit}
+            """, [since]))
+        queries.append(("recent", f"""
+            SELECT p.pmid FROM publications p
+            JOIN {self.table_name} s ON p.pmid = s.pmid
+            WHERE p.pub_date >= %s {limit}
+        """, [date.today() - timedelta(days=self.recent_days)]))
+        queries.append((f"rotation {state['slice'] + 1}/{self.rotation}", f"""
+            SELECT pmid FROM {self.table_name}
+            WHERE MOD(pmid, %s) = %s {limit}
+        """, [self.rotation, state['slice']]))
+
+        pmids = []
+        for name, query, params in queries:
+            self.mark_time('query')
+            rows = self.db.query(query, params) or []
+            self.add_time('query')
+            self.log(f"Refresh: {len(rows):,} {name} papers ({self.get_time_last('query')})")
+            pmids += [str(row['pmid']) for row in rows]
+        self.clear_time('query')
+        return pmids
+
+    @property
+    def session(self):
+        """ requests.Session of the current thread """
+        if not hasattr(self.sessions, 'session'):
+            session = requests.Session()
+            session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=1))
+            self.sessions.session = session
+        return self.sessions.session
+
     def request(self, pmids):
-        """ Request the given pmids from iCite """
-        response = requests.get(f"{self.url}/pubs?pmids={','.join(pmids)}")
-        if response.status_code != 200:
-            self.debug(f"Got bad response from iCite API. Status Code: {response.status_code} - {response.reason}")
-            data = {}
-        else:
-            data = response.json()  # JSON response data
-
-        papers = data.get('data', [])  # list of papers and their data
-        return papers
-
-    def collect(self, pmids, batch_size=1000, insert=True, show_progress=True, threads=10):
+        """
+        Request the given pmids from iCite.
+        Failed requests (connection errors, timeouts, rate limiting and server errors) are retried with exponential backoff.
+        Returns the list of papers, or None if every attempt failed.
+        """
+        for tries in range(1, self.max_request_tries + 1):
+            retry_after = None
+            try:
+                response = self.session.get(f"{self.url}/pubs", params={'pmids': ','.join(pmids)}, timeout=self.timeout)
+                if response.status_code == 200:
+                    papers = response.json().get('data', [])  # list of papers and their data
+                    if tries > 1: self.debug(f"iCite request succeeded after {tries} tries")
+                    return papers
+                error = f"Status Code: {response.status_code} - {response.reason}"
+                if response.status_code != 429 and response.status_code < 500:  # the request itself is bad - don't retry
+                    self.log(f"Got bad response from iCite API. {error}")
+                    return None
+                retry_after = response.headers.get('Retry-After')
+            except (requests.RequestException, ValueError) as e:  # ValueError: invalid JSON
+                error = self.exc(e)
+
+            if tries == self.max_request_tries: break
+            wait = min(self.backoff * 2 ** (tries - 1), self.max_backoff) * random.uniform(0.5, 1)  # jitter so threads don't retry together
+            if retry_after and retry_after.isdigit(): wait = max(wait, int(retry_after))
+            self.debug(f"iCite request failed ({error}). Retrying in {wait:.1f}s ({tries}/{self.max_request_tries})")
+            time.sleep(wait)
+
+        self.log(f"iCite request failed {self.max_request_tries} times in a row ({error}).")
+        return None
+
+    def get_failed_batches(self):
+        """ List of the batches in the failed batch ledger. Each is a dictionary with the "date" it failed and its "pmids". """
+        if not os.path.exists(self.failed_file): return []
+        with open(self.failed_file) as file:
+            return [json.loads(line) for line in file if line.strip()]
+
+    def get_failed_pmids(self):
+        """ PMIDs of all batches in the failed batch ledger """
+        return [pmid for batch in self.get_failed_batches() for pmid in batch['pmids']]
+
+    def record_failed(self, pmids):
+        """ Add a failed batch of PMIDs to the ledger """
+        self.ensure_path(self.failed_file, file=True)
+        with open(self.failed_file, 'a') as file:
+            file.write(json.dumps({'date': datetime.now().isoformat(timespec='seconds'), 'pmids': pmids}) + '\n')
+
+    def save_failed(self, batches):
+        """ Replace the ledger with the given list of failed batches (see get_failed_batches()) """
+        self.ensure_path(self.failed_file, file=True)
+        with open(self.failed_file + '.tmp', 'w') as file:
+            for batch in batches:
+                file.write(json.dumps(batch) + '\n')
+        os.replace(self.failed_file + '.tmp', self.failed_file)
+
+    def collect(self, pmids, batch_size=1000, insert=True, show_progress=True, threads=10, update=False):
         """
         Request data from the iCite API in batches and insert the result into the database.
         Threads requests to iCite, which seems to be able to handle ~10 requests of 1,000 papers at a time.
+        Batches are submitted as results are retrieved, so at most 2x<threads> batches are in flight at once.
+        Rows are inserted in the database thread pool while the next batches are requested.
+        <update> if True, stats of papers already in the table are updated instead of ignored.
+        Batches that fail every attempt, or fail to insert, are added to the failed batch ledger as they fail.
+            At the end, earlier ledger entries for any of the PMIDs requested in this run are removed.
         """
         assert 1 <= batch_size <= 1000, "iCite API batch size must be from 1 to 1000"
         num = len(pmids)
 
         self.log(f"{num:,} papers with batch size {batch_size:,}")
         pmids = [str(pmid) for pmid in pmids]  # make sure they are all strings
+        previous_failed = self.get_failed_batches()
         pmid_batches = self.batch_list(pmids, size=batch_size)
 
         self.debug(f"Threading requests to iCite using {threads} threads).")
+        window = 2 * threads  # batches submitted but not yet retrieved
         queue = ThreadQueue(threads)
 
         if show_progress:
             self.log("Progress | Total Time | Batch Time || Request | Insert")
 
-        # submit all pmid batches to thread queue
-        for batch in pmid_batches:
-            queue.submit(self.request, [batch])
-
         total_batches = len(pmid_batches)
         total_papers = 0  # total papers whose stats were retrieved from icite
-        for i, batch in enumerate(pmid_batches):
-            self.mark_time('batch')
+        failed = []  # batches which failed every attempt
+        inserts = []  # PMID batch and AsyncResult of each database insert in flight
+
+        def finish_insert(pmids, result):  # wait for an insert. A batch which failed to insert is failed like a request.
+            if result.get() is None:  # MySQLDatabase.query() returns None on failure
+                self.err(f"Failed to insert the stats of a batch of {len(pmids):,} papers")
+                failed.append({'date': datetime.now().isoformat(timespec='seconds'), 'pmids': pmids})
+                self.record_failed(pmids)
+        submitted = 0
+        for i in range(total_batches):
+            while submitted < total_batches and len(queue) < window:  # keep the window of requests full
+                queue.submit(self.request, [pmid_batches[submitted]], key=pmid_batches[submitted])
+                submitted += 1
 
+            self.mark_time('batch')
             self.mark_time("request")
-            papers = queue.next()
-            total_papers += len(papers)
-            if papers is None:
-                break  # queue empty
+            task = queue.next_task()
+            if task is None: break  # queue empty
+            papers = task.result()
             self.add_time('request')
 
+            if papers is None:  # failed every attempt
+                failed.append({'date': datetime.now().isoformat(timespec='seconds'), 'pmids': task.key})
+                self.record_failed(task.key)  # recorded right away in case this run is interrupted
+                papers = []
+            total_papers += len(papers)
+
             rows = []
             for paper in papers:
                 row = []
@@ -159,10 +295,12 @@ class iCite(Base):
                     row.append(paper.get(col))
                 rows.append(row)
 
-            if insert:
-                self.mark_time('insert')
-                self.insert(rows)
-                self.add_time('insert')
+            self.mark_time('insert')
+            if insert and rows:
+                while len(inserts) >= self.max_inserts:  # wait for the oldest insert to finish
+                    finish_insert(*inserts.pop(0))
+                inserts.append((task.key, self.db.insert_row(self.table_name, self.columns, rows, threaded=True, update=update)))
+            self.add_time('insert')
 
             self.add_time('batch')
             progress = self.progress(i, total_batches, every=1)
@@ -173,10 +311,15 @@ class iCite(Base):
                 insert_time = self.get_time_last("insert")
                 self.log(f"{progress:8} | {total_time:10} | {batch_time:10} || {request_time:7} | {insert_time:6}")
 
-        # wait for last insert to finish, if it hasn't already
-        if self.database_insert is not None:
-            self.database_insert.wait()
+        # wait for the last inserts to finish, if they haven't already
+        for pmids, result in inserts:
+            finish_insert(pmids, result)
+        queue.close()
+        requested = set(pmids)
+        self.save_failed([batch for batch in previous_failed if not requested.intersection(batch['pmids'])] + failed)
 
         self.log("Citation Stats Collection Complete.")
         self.log(f"Avg Batch Time: {self.get_time_avg('batch')}")
-        self.log(f"Total papers received: {total_papers}")
\ No newline at end of file
+        self.log(f"Total papers received: {total_papers}")
+        if failed:
+            self.log(f"Failed batches: {len(failed):,} ({sum(len(batch['pmids']) for batch in failed):,} papers). They will be requested again on the next run. Ledger: {self.failed_file}")
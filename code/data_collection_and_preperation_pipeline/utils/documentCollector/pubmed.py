@@ -5,7 +5,9 @@ import datetime
 from dateutil.parser import parse
 import traceback
 import math
+import random
 import collections
+from multiprocessing import Pool, cpu_count
 
 import re
 import os, sys
@@ -14,10 +16,49 @@ from pathlib import Path
 
 from utils.database.database import MySQLDatabase
 from utils.generalPurpose.generalPurpose import *
-from utils.affiliationParser import parse_affil, match_affil
+from utils.affiliationParser import parse_affil, match_affil, ParseCache, GridMatcher
 from utils.base import Base, StoredDict, StoredList
 
 
+def field_paths(data, path=''):
+    """
+    Yield the path of every value in a paper's JSON, the same as the keys of flatten() with list indexes removed
+        (as in re.sub(r'_\d+_', '', key)). Fields inside lists are yielded once for each list item.
+    """
+    if isinstance(data, dict):
+        for key, value in data.items():
+            child = f"{path}.{key}" if path else key
+            if isinstance(value, (dict, list)):
+                yield from field_paths(value, child)
+            else:
+                yield child
+    elif isinstance(data, list):
+        for value in data:
+            if isinstance(value, (dict, list)):
+                yield from field_paths(value, path)
+            else:
+                yield path
+
+
+def count_fields(filenames):
+    """
+    Count the papers which have each field path (see field_paths()) in the given stored paper files.
+    Returns (Counter of field paths, papers read, files that couldn't be read).
+    """
+    counts = collections.Counter()
+    read, failed = 0, 0
+    for filename in filenames:
+        try:
+            with open(filename) as f:
+                paper = json.load(f)
+        except Exception:
+            failed += 1
+            continue
+        counts.update(set(field_paths(paper)))  # each field once per paper
+        read += 1
+    return counts, read, failed
+
+
 class PubmedCollector(Base):
     """ Manages pulling and storing data from the PubMed Enrtrez API """
     def __init__(self, *args, **kwargs):
@@ -32,6 +73,11 @@ class PubmedCollector(Base):
         self.stored_files = StoredList("stored_files", self.data_directory, self.get_stored_files)
         self.stored_pmids = None
 
+        # parsed affiliation strings, shared by every run and process
+        self.affiliation_cache = ParseCache(os.path.join(self.data_directory, 'affiliation_cache.sqlite'))
+        self.grid_matcher = None  # GridMatcher, when affiliations are linked to GRID institutions while inserting papers
+        self.grid_min_score = 0.8  # lowest GridMatcher score accepted as a GRID link
+
         # rate limiting
         self.requests_per_second = self.config.NCBI_rate_limit
         self.num_requests = 0
@@ -309,49 +355,46 @@ class PubmedCollector(Base):
             return []
         return set(str(r['pmid']) for r in rows)
 
-    def get_document_field_stats(self, show_progress=True):
-        """ Generates a json file detailing the stats of all JSON fields given by pubmed"""
+    def get_document_field_stats(self, show_progress=True, sample=None, processes=None, shard_size=1000):
+        """
+        Generates a json file detailing the stats of all JSON fields given by pubmed:
+            the percentage of papers which have each field, with list indexes left out of the field paths.
+        Shards of <shard_size> stored files are counted in parallel by <processes> processes (defaults to the number of CPUs),
+            and their counts are merged.
+        <sample> number of stored files picked at random to estimate the stats from, instead of reading every file.
+        """
         file_path = f"{self.data_directory}/field-statistics.stats"
         self.log('Generating field statistics from data:', file_path)
-        total_files = len(self.stored_files)
-        field_stats = collections.Counter([])
-
-        # Initialize the field stats Counter.
-        self.log(f'Ingesting {total_files:<,} papers... (this may take some time)')
+        filenames = list(self.stored_files)
+        if sample and sample < len(filenames):
+            filenames = random.sample(filenames, sample)
+            self.log(f'Estimating from a random sample of {sample:,} of {len(self.stored_files):,} papers')
+        total_files = len(filenames)
+        processes = processes or cpu_count()
+
+        self.log(f'Ingesting {total_files:<,} papers with {processes} processes... (this may take some time)')
         if show_progress:
-            self.log(f"Progress |   Time   |  Read  |  Parse  | Total Papers")
-
-        total_papers = len(self.stored_files)
-        for i, filename in enumerate(self.stored_files):  # for each paper file
-            self.mark_time('read')
-            paper = self.get_paper(filename)
-            if not paper: return
-            self.add_time('read')
-
-            self.mark_time('parse')
-            # Flatten the paper
-            x = flatten(paper, last_keys='', key_list=[], value_list=[])
-
-            # Get the unique keys (so we do not double count author lists, for insntance.)
-            keys = list(set([re.sub(r'_\d+_', '', a) for a in list(x.keys())]))
-
-            # Add the field counts
-            field_stats += collections.Counter(keys)
-            self.add_time('parse')
-
-            progress = self.progress(i, total_papers)
-            if show_progress and progress:
-                total = self.get_time_total('read', 0)
-                read = self.get_time_sum('read', 1)
-                parse = self.get_time_sum('parse', 1)
-                self.log(f"{progress:<8} | {total:<8} | {read:<6} | {parse:<7} | {i+1:<,}")
-
-        self.log("Converting to dict...")
-        field_stats = dict(field_stats)
+            self.log(f"Progress |   Time   |  Papers/s  | Total Papers")
+
+        field_stats = collections.Counter()
+        papers, failed = 0, 0
+        shards = self.batch_list(filenames, shard_size)
+        self.mark_time('stats')
+        with Pool(processes) as pool:
+            for i, (counts, read, failures) in enumerate(pool.imap_unordered(count_fields, shards)):
+                field_stats.update(counts)  # merge the shard's counts
+                papers += read
+                failed += failures
+
+                progress = self.progress(i, len(shards))
+                if show_progress and progress:
+                    rate = (papers + failed) / max(time.time() - self.times['stats']['start'], 1e-9)
+                    self.log(f"{progress:<8} | {self.get_time_total('stats', 0):<8} | {rate:<10,.0f} | {papers + failed:<,}")
+        if failed:
+            self.log(f"Failed to read {failed:,} paper files")
 
         self.log('Normalizing field counts...')
-        for key, val in field_stats.items():
-            field_stats[key] = round(100 * (val / total_files))
+        field_stats = {key: round(100 * (val / papers)) for key, val in field_stats.items()}  # of the papers read
 
         self.log(f'Saving field statistics... ({file_path})')
         with open(file_path, "w") as f:
@@ -477,9 +520,28 @@ class PubmedCollector(Base):
                 else:
                     data[table] = {'columns': columns, 'values': values}
 
+        if self.grid_matcher is not None and data.get('affiliations'):
+            self.link_grid(data['affiliations']['columns'], data['affiliations']['values'])
+
         #self.log("DONE CONCATENATING", len(data), successes, fails)
         return data, successes, fails
 
+    def link_grid(self, columns, values):
+        """ Set the grid_id of the given affiliation rows to their best GRID match. Each distinct affiliation is matched once. """
+        i = {column: columns.index(column) for column in ('affiliation', 'institution', 'location', 'country', 'grid_id')}
+        rows = collections.defaultdict(list)  # (institution, location, country) -> rows
+        for row in values:
+            if row[i['affiliation']] is not None:
+                rows[(row[i['institution']] or row[i['affiliation']], row[i['location']], row[i['country']])].append(row)
+        if not rows: return
+
+        parsed = [{'institution': institution, 'location': location, 'country': country} for institution, location, country in rows]
+        matches = self.grid_matcher.match(parsed, min_score=self.grid_min_score)
+        for same_rows, match in zip(rows.values(), matches):
+            if not match: continue
+            for row in same_rows:
+                row[i['grid_id']] = match[0]['grid_id']
+
     # Pulling from the Entrez API
     def search_pmids_by_date(self, date):
         """
@@ -685,13 +747,20 @@ class PubmedCollector(Base):
         self.log(f"Bulk Collection Complete. Searched {total_searched:,} and Fetched {total_fetched:,} in {self.get_time_total('day')}")
         self.display_memory()  # display memory usage in debug mode
 
-    def insert_papers(self, replace=False, reverse=True, show_progress=True, batch_size=10000, limit=None):
+    def insert_papers(self, replace=False, reverse=True, show_progress=True, batch_size=10000, limit=None, match_grid=False):
         """
         Process basic information from all papers on disk to store in database
         <limit> is a temporary way to limit the number of papers inserted for testing purposes.
+        <match_grid> link each affiliation to a GRID institution (affiliations.grid_id)
         """
         self.log('------------------------------')
         self.log('Starting Paper Parsing')
+        if match_grid and self.grid_matcher is None:
+            self.log("Loading GRID institutions...", end='')
+            self.mark_time('grid')
+            self.grid_matcher = GridMatcher()
+            self.log(f" Done ({self.get_time_total('grid')})")
+            self.clear_time('grid')
         papers = self.stored_files  # list of all stored filenames
         self.log(f"Found {len(papers):,} stored files.")
 
@@ -722,8 +791,8 @@ class PubmedCollector(Base):
         if show_progress:
             self.log()
             self.log(f"New papers to process: {total_papers:,} (with batch size {batch_size:,})")
-            self.log(f"Batch | Progress |   Time   | Batch Time | Read Time | Parse Time | Insert Time | Batch Time/Paper | Memory")
-            self.log(f"-----------------------------------------------------------------------------------------------------------")
+            self.log(f"Batch | Progress |   Time   | Batch Time | Read Time | Parse Time | Insert Time | Batch Time/Paper | Affil Hits | Memory")
+            self.log(f"------------------------------------------------------------------------------------------------------------------------")
 
         batches = self.batch_list(papers, batch_size)
         total_batches = len(batches)
@@ -734,6 +803,7 @@ class PubmedCollector(Base):
             self.mark_time('parse')
             data, successes, fails = self.parse_papers(batch, threaded=False)
             self.add_time('parse')
+            self.affiliation_cache.flush()  # write newly parsed affiliations for other runs
             total_successes += successes
             total_fails += fails
 
@@ -762,7 +832,8 @@ class PubmedCollector(Base):
                 insert_time = self.get_time_last('insert', 1)  # last batch insert time
                 self.clear_time('read')
                 self.clear_time('parse')
-                self.log(f"{i+1:5} | {progress:8} | {total_time:8} | {batch_time:10} | {read_time:9} | {parse_time:10} | {insert_time:11} | {avg_paper:16} | {self.memory()}")
+                affil_hits = f"{self.affiliation_cache.stats(reset=True)['hit_rate']}%"  # batch affiliations already parsed
+                self.log(f"{i+1:5} | {progress:8} | {total_time:8} | {batch_time:10} | {read_time:9} | {parse_time:10} | {insert_time:11} | {avg_paper:16} | {affil_hits:10} | {self.memory()}")
 
         self.log(f"Processing Complete. Succeeded: {total_successes:,} | Failed: {total_fails:,}")
         self.log(f"Total Time: {self.get_time_total('batch')}")
@@ -974,9 +1045,8 @@ class PubmedCollector(Base):
                     _orcid_id    = match.group(0) if match is not None else None
 
 
-                    _parsed_affil   = parse_affil(_affiliation)
-                    #_grid_id       = match_affil(_affiliation)[0]['grid_id']
-                    _grid_id        = None
+                    _parsed_affil   = self.affiliation_cache.parse(_affiliation)
+                    _grid_id        = None  # matched for the whole batch of papers in link_grid()
 
                     if _parsed_affil['institution'] is not None and _parsed_affil['department'] is not None:
                         _parsed_affil['institution'] = _parsed_affil['institution'].replace(_parsed_affil['department'],'')
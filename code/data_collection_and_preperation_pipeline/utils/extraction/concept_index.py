@@ -0,0 +1,94 @@
+import os
+import json
+from datetime import datetime
+
+import numpy as np
+import hnswlib
+
+from utils.base import Base
+
+
+class ConceptIndex(Base):
+    """
+    Approximate nearest neighbour index (HNSW, CPU only) over the embeddings of all concepts in concept_map.
+    Each concept (AUI) is embedded by an EmbeddingModel in full dimensions, unless <dim> is given to reduce the
+        vectors with the model's PCA projection to save memory.
+
+    The index is saved in <directory> as three files, named by the model:
+        <name>.hnsw: the hnswlib index, where the label of each concept is its row in the labels file.
+        <name>_labels.npz: "cui" and "aui" arrays of each label, and "cui_order": the labels in order of CUI,
+            so all AUIs of a CUI can be found with a binary search.
+        <name>.json: information about the index (model, weights checksum, dimensions, number of concepts, ...)
+    The web application loads these files to answer "similar concepts" queries.
+    """
+    def __init__(self, model, *args, directory=None, dim=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.model = model  # EmbeddingModel
+        self.dim = dim if model.projection(dim) is not None else model.dim  # dimensions of the indexed vectors
+        self.directory = directory or os.path.join(self.config.data_directory, 'embedding')
+        self.name = f"{model.model_name.replace('/', '_')}_concepts"
+
+        # HNSW parameters
+        self.M = 16  # number of links per node
+        self.ef_construction = 200  # size of the candidate list while building
+
+    def path(self, suffix):
+        return os.path.join(self.directory, f"{self.name}{suffix}")
+
+    def build(self, batch_size=10000):
+        """ Embed every concept in concept_map in batches, add them to a new index, and save it """
+        total = self.model.db.query("SELECT COUNT(DISTINCT AUI) as total FROM concept_map")
+        if not total:  # MySQLDatabase.query() returns None on failure
+            self.throw("Failed to count the concepts in concept_map. The concept index was not built.")
+        total = total[0]['total']
+        self.log(f"Building concept index of {total:,} concepts ({self.dim} dimensions)...")
+
+        index = hnswlib.Index(space='cosine', dim=self.dim)
+        index.init_index(max_elements=max(total, 1), ef_construction=self.ef_construction, M=self.M)
+        cuis, auis = [], []
+
+        batches = int(np.ceil(total / batch_size))
+        self.mark_time('index')
+        for b, rows in enumerate(self.model.iter_concepts(batch_size)):
+            vectors, found = self.model.pool([row['STR'] for row in rows])
+            vectors = self.model.project(vectors[found], self.dim).numpy()
+            rows = [row for row, f in zip(rows, found.tolist()) if f]  # only concepts with any tokens
+            if not rows: continue
+
+            if len(auis) + len(rows) > index.get_max_elements():  # concepts were added since counting
+                index.resize_index(len(auis) + len(rows))
+            index.add_items(vectors, np.arange(len(auis), len(auis) + len(rows)))  # labels are rows in the labels file
+            cuis += [row['CUI'] for row in rows]
+            auis += [row['AUI'] for row in rows]
+
+            progress = self.progress(b, batches, every=1)
+            if progress:
+                self.log(f"{progress} | {self.get_time_total('index'):<10} | {len(auis):,} concepts")
+
+        self.save(index, cuis, auis)
+        self.log(f"Concept index complete ({self.get_time_total('index')}): {len(auis):,} concepts")
+
+    def save(self, index, cuis, auis):
+        """ Save the index files. Each is written to a temporary file first, then moved into place. """
+        self.ensure_path(self.path('.hnsw'), file=True)
+        cuis = np.array(cuis)
+        auis = np.array(auis)
+
+        index.save_index(self.path('.hnsw.tmp'))
+        with open(self.path('_labels.npz.tmp'), 'wb') as file:
+            np.savez(file, cui=cuis, aui=auis, cui_order=np.argsort(cuis, kind='stable'))
+        with open(self.path('.json.tmp'), 'w') as file:
+            json.dump({
+                'model': self.model.model_name,
+                'checksum': self.model.checksum,  # checksum of the model weights
+                'dim': self.dim,
+                'count': len(auis),
+                'space': 'cosine',
+                'M': self.M,
+                'ef_construction': self.ef_construction,
+                'date': datetime.now().isoformat(timespec='seconds'),
+            }, file, indent=4)
+
+        for suffix in ('.hnsw', '_labels.npz', '.json'):
+            os.replace(self.path(suffix + '.tmp'), self.path(suffix))
+        self.log(f"Saved concept index to {self.path('.hnsw')}")
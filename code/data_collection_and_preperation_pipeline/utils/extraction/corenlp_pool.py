@@ -0,0 +1,207 @@
+import os
+import time
+from threading import Thread, Condition
+from urllib.parse import urlparse
+
+import psutil
+import stanza
+from stanza.server import CoreNLPClient
+
+from utils.base import Base
+
+
+class CoreNLPServer:
+    """ A CoreNLP client in a CoreNLPPool, along with its dispatch state """
+    ACTIVE = 'active'  # accepting requests
+    DRAINING = 'draining'  # excluded from dispatch until its in-flight requests are done, then restarted
+    RESTARTING = 'restarting'  # excluded from dispatch while the server restarts
+    FAILED = 'failed'  # excluded from dispatch for good, after it couldn't be restarted
+
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+        self.state = self.ACTIVE
+        self.in_flight = 0  # requests currently being handled
+        self.requests = 0  # total requests dispatched
+        self.restarts = 0
+
+    def rss(self):
+        """ Resident memory in bytes of the server process and its children, or None if it wasn't started by this client """
+        server = getattr(self.client, 'server', None)  # subprocess of the JVM, if the client started one
+        if server is None: return None
+        try:
+            process = psutil.Process(server.pid)
+            return process.memory_info().rss + sum(p.memory_info().rss for p in process.children(recursive=True))
+        except psutil.Error:
+            return None
+
+
+class CoreNLPPool(Base):
+    """
+    Pool of CoreNLP servers on this node, each running in its own JVM with its own heap.
+    Requests are dispatched to the active server with the fewest requests in flight.
+
+    When a server's own RSS grows past <recycle_memory> times its heap, it is drained and restarted.
+    Only one server is drained or restarted at a time, so the other servers keep annotating while it recycles,
+        and requests in flight on it are never cut off.
+
+    <servers> number of servers to run. Defaults to config.CoreNLP_servers.
+    <threads> total annotation threads, split between the servers. Defaults to the number of CPUs.
+    <clients> list of already constructed clients to dispatch to, instead of starting servers from the config.
+    """
+    def __init__(self, *args, servers=None, threads=None, clients=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.threads = threads or os.cpu_count()
+        self.memory_threshold = 90  # node memory percent above which the largest server is recycled
+        self.recycle_memory = getattr(self.config, 'CoreNLP_recycle_memory', 1.5)  # server RSS limit, as a multiple of its heap
+        self.check_interval = 5  # seconds between memory checks
+        self.restart_attempts = 3  # attempts to restart a recycled server before it is left out of dispatch
+
+        self.condition = Condition()  # guards the server states and in-flight counts
+        self.last_check = 0
+        if clients is not None:
+            self.servers = [CoreNLPServer(client, f"client {i}") for i, client in enumerate(clients)]
+        else:
+            self.servers = self.create_servers(servers or getattr(self.config, 'CoreNLP_servers', 1))
+
+    def create_servers(self, num):
+        """ Create a client for each of <num> servers, on consecutive ports starting at the configured endpoint """
+        endpoint = urlparse(self.config.CoreNLP_endpoint)
+        threads = max(1, self.threads // num)  # threads per server
+        servers = []
+        for i in range(num):
+            url = f"{endpoint.scheme}://{endpoint.hostname}:{endpoint.port + i}"
+            client = CoreNLPClient(
+                timeout=60000,
+                be_quiet=True,
+                threads=threads,
+                start_server=stanza.server.StartServer.TRY_START,  # start new server or connect to a pre-existing one if it already exists (allows multiple threads)
+                properties=self.config.CoreNLP_properties,
+                memory=self.config.CoreNLP_memory,
+                endpoint=url,
+            )
+            servers.append(CoreNLPServer(client, url))
+        return servers
+
+    def start(self):
+        """ Start all servers """
+        self.log(f"Starting {len(self.servers)} CoreNLP server(s)...")
+        for server in self.servers:
+            server.client.start()
+
+    def stop(self):
+        """ Stop all servers """
+        for server in self.servers:
+            server.client.stop()
+
+    def annotate(self, *args, **kwargs):
+        """ Annotate with the least loaded server (see CoreNLPClient.annotate()) """
+        return self.dispatch('annotate', *args, **kwargs)
+
+    def tregex(self, *args, **kwargs):
+        """ Tregex query with the least loaded server (see CoreNLPClient.tregex()) """
+        return self.dispatch('tregex', *args, **kwargs)
+
+    def dispatch(self, method, *args, **kwargs):
+        """ Call the given client method on the active server with the fewest requests in flight """
+        with self.condition:
+            active = [server for server in self.servers if server.state == CoreNLPServer.ACTIVE]
+            while not active:  # every server is recycling
+                if all(server.state == CoreNLPServer.FAILED for server in self.servers):
+                    self.throw("No CoreNLP server is running. Every server failed to restart.")
+                self.condition.wait()
+                active = [server for server in self.servers if server.state == CoreNLPServer.ACTIVE]
+            server = min(active, key=lambda s: (s.in_flight, s.requests))
+            server.in_flight += 1
+            server.requests += 1
+
+        try:
+            return getattr(server.client, method)(*args, **kwargs)
+        finally:
+            with self.condition:
+                server.in_flight -= 1
+                if server.state == CoreNLPServer.DRAINING and not server.in_flight:
+                    self.restart(server)
+
+    def check(self):
+        """
+        Check the memory of each server, at most once every <check_interval> seconds.
+        Drains the largest server whose RSS is over its limit. If none are, but the node memory is over the threshold,
+            drains the server with the largest RSS instead.
+        Does nothing while another server is already recycling.
+        """
+        now = time.time()
+        with self.condition:
+            if now - self.last_check < self.check_interval: return
+            self.last_check = now
+            if any(server.state in (CoreNLPServer.DRAINING, CoreNLPServer.RESTARTING) for server in self.servers): return
+
+        limit = self.recycle_memory * self.parse_bytes(self.config.CoreNLP_memory)
+        usage = [(server.rss(), server) for server in self.servers]
+        usage = [(rss, server) for rss, server in usage if rss is not None]  # servers this pool can restart
+        if not usage: return
+
+        over = [(rss, server) for rss, server in usage if rss > limit]
+        if over:
+            rss, server = max(over, key=lambda u: u[0])
+            reason = f"RSS {self.format_bytes(rss)} > {self.format_bytes(limit)}"
+        elif self.memory(num=True) > self.memory_threshold:
+            rss, server = max(usage, key=lambda u: u[0])
+            reason = f"node memory > {self.memory_threshold}%, largest server RSS {self.format_bytes(rss)}"
+        else:
+            return
+
+        with self.condition:
+            if server.state != CoreNLPServer.ACTIVE: return
+            self.log(f"Recycling CoreNLP server {server.name} ({reason})")
+            server.state = CoreNLPServer.DRAINING
+            if not server.in_flight:
+                self.restart(server)
+
+    def restart(self, server):
+        """
+        Restart a drained server in the background, and put it back into dispatch once it is alive. Call with the condition held.
+        A failed restart is retried with backoff up to <restart_attempts> times. If it never comes back, the server is
+            marked FAILED and left out of dispatch.
+        """
+        server.state = CoreNLPServer.RESTARTING
+
+        def _restart():
+            self.mark_time(f"restart {server.name}")
+            for attempt in range(self.restart_attempts):
+                try:
+                    server.client.stop()
+                    server.client.start()
+                    server.client.ensure_alive()  # wait until it accepts requests
+                    break
+                except Exception as e:
+                    self.err(f"Failed to restart CoreNLP server {server.name} (attempt {attempt+1}/{self.restart_attempts}): {self.exc(e)}")
+                    if attempt + 1 < self.restart_attempts:
+                        time.sleep(5 * 2 ** attempt)
+            else:
+                self.add_time(f"restart {server.name}")
+                with self.condition:
+                    server.state = CoreNLPServer.FAILED
+                    self.condition.notify_all()  # wake dispatchers waiting on this server, in case no server is left
+                self.err(f"CoreNLP server {server.name} is left out of dispatch")
+                return
+
+            self.add_time(f"restart {server.name}")
+            with self.condition:
+                server.state = CoreNLPServer.ACTIVE
+                server.restarts += 1
+                self.condition.notify_all()
+            self.log(f"CoreNLP server {server.name} restarted ({self.get_time_last(f'restart {server.name}', 1)})")
+
+        Thread(target=_restart, daemon=True).start()
+
+    def parse_bytes(self, size):
+        """ Number of bytes in a JVM memory size string like "8G" or "512m" """
+        size = str(size).strip().upper()
+        units = {'K': 2**10, 'M': 2**20, 'G': 2**30, 'T': 2**40}
+        if size[-1] in units:
+            return float(size[:-1]) * units[size[-1]]
+        return float(size)
+
+    def __len__(self):
+        return len(self.servers)
@@ -1,15 +1,18 @@
 from transformers import AutoTokenizer, AutoModel
 import torch
 import math
+import os
+import json
+import hashlib
 
 from utils.base import Base
-from utils import MySQLDatabase
-db = MySQLDatabase()
+from utils.database.database import MySQLDatabase
 
 
 class EmbeddingModel(Base):
-    def __init__(self, model):
+    def __init__(self, model, db=None):
         super().__init__()
+        self.db = db or MySQLDatabase()  # a given database object is used instead of connecting to MySQL
         self.model_name = model
         self.tokenizer = AutoTokenizer.from_pretrained(model)
         self.model = AutoModel.from_pretrained(model, output_hidden_states=True)
@@ -18,12 +21,16 @@ class EmbeddingModel(Base):
 
         # global embedding matrix
         self.embedding = self.model.get_input_embeddings()
+        self.dim = self.embedding.embedding_dim
 
-        # map dimension size to an embedding of that dimension
-        self.embeddings = {
-            2: self.reduce(2),
-            self.embedding.embedding_dim: self.embedding
-        }
+        # map dimension size to the PCA projection matrix to that dimension.
+        # Projections are computed when first needed and cached on disk, keyed by a checksum of the embedding matrix.
+        self.projection_file = os.path.join(self.config.data_directory, 'embedding', f"{model.replace('/', '_')}_pca.pt")
+        self.checksum = self.weights_checksum()
+        self.projections = self.load_projections()
+
+        # AUI up to which populate_database() has inserted all concepts, so an interrupted run can continue from it
+        self.checkpoint_file = os.path.join(self.config.data_directory, 'embedding', f"{model.replace('/', '_')}_populate.json")
 
         # if you change this, check the populate_database() function too
         self.columns = ['CUI', 'AUI', '2a', '2b', '3a', '3b', '3c', '5a', '5b', '5c', '5d', '5e']
@@ -31,74 +38,159 @@ class EmbeddingModel(Base):
         self.table_name = "concept_embeddings"
 
     def reduce(self, n):
-        """ Reduce the embedding matrix to n dimensions """
+        """
+        Returns the PCA projection matrix which reduces the embedding matrix to n dimensions.
+        Multiplying a full dimension vector by it gives the n dimensional vector.
+        """
         self.mark_time("reduce")
 
         state = self.embedding.weight  # get the actual embedding matrix
-        _, _, V = torch.pca_lowrank(state, q=n)  # returns U, S, V
-        reduced = torch.matmul(state, V)
-        # create new Torch Module of the same class type
-        module = self.embedding.__class__(num_embeddings=self.embedding.num_embeddings, embedding_dim=n)
-        module.load_state_dict({'weight': reduced})  # load the new reduced embedding matrix
+        with torch.no_grad(), torch.random.fork_rng():
+            torch.manual_seed(0)  # pca_lowrank is randomized - seed it so every process gets the same projection
+            _, _, V = torch.pca_lowrank(state, q=n)  # returns U, S, V
 
         self.add_time("reduce")
         self.debug("PCA Time: ", self.get_time_total("reduce"))
-        return module
+        return V
+
+    def projection(self, n):
+        """ The projection matrix to n dimensions, or None if n is not less than the full embedding dimensions """
+        if n is None or n < 0 or n >= self.dim: return None
+        if n not in self.projections:  # this dimension doesn't exist
+            self.projections[n] = self.reduce(n)  # make it
+            self.save_projections()
+        return self.projections[n]
+
+    def weights_checksum(self):
+        """ SHA-256 checksum of the embedding matrix, which the cached projections must match """
+        with torch.no_grad():
+            weights = self.embedding.weight.detach().cpu().contiguous()
+        return hashlib.sha256(weights.numpy().tobytes()).hexdigest()
+
+    def load_projections(self):
+        """ Load cached projection matrices from disk, if they were computed from the same embedding matrix """
+        if not os.path.exists(self.projection_file):
+            return {}
+        try:
+            cache = torch.load(self.projection_file)
+        except Exception as e:
+            self.log(f"Failed to load cached PCA projections ({self.exc(e)}). Recomputing.")
+            return {}
+        if cache.get('checksum') != self.checksum:
+            self.log("Cached PCA projections are for different model weights. Recomputing.")
+            return {}
+        self.debug(f"Loaded cached PCA projections for dimensions: {sorted(cache['projections'])}")
+        return cache['projections']
+
+    def save_projections(self):
+        """ Save the projection matrices to disk, replacing the file in one step so other processes never read a partial file """
+        self.ensure_path(self.projection_file, file=True)
+        projections = self.load_projections()  # keep any dimensions another process has saved since
+        projections.update(self.projections)
+        temp = f"{self.projection_file}.{os.getpid()}.tmp"
+        torch.save({'model': self.model_name, 'checksum': self.checksum, 'projections': projections}, temp)
+        os.replace(temp, self.projection_file)
+
+    def pool(self, words: list):
+        """
+        Returns the average full dimension token embedding of each word, as a tensor with a row for each word.
+        Also returns a boolean tensor of which words had any tokens (the rest have rows of zeros).
 
-    def get_vectors(self, words: list, n: int = None):
+        All words are tokenized in one pass, and all token vectors are looked up at once.
+        Token vectors are then summed into their word with a segment-sum over the token -> word indexes.
         """
-        Return the n-dimensional embedding of each token
-        If n is less than 0 or greater than the current embedding dimensions, return max dimensions
+        pooled = torch.zeros(len(words), self.dim)
+        if not len(words): return pooled, torch.zeros(0, dtype=torch.bool)
+
+        encoded = self.tokenizer(words, is_split_into_words=True, return_tensors="pt", add_special_tokens=False)  # returns a Tensor of token ids
+        word_ids = torch.tensor([-1 if w is None else w for w in encoded.word_ids()], dtype=torch.long)  # word index of each token
+        tokens = word_ids >= 0
+        token_ids = encoded.input_ids[0][tokens]
+        word_ids = word_ids[tokens]
+
+        with torch.no_grad():
+            vectors = self.embedding(token_ids)  # vector of each token
+            pooled.index_add_(0, word_ids, vectors)  # sum the token vectors of each word
+            counts = torch.bincount(word_ids, minlength=len(words))
+            pooled /= counts.clamp(min=1).unsqueeze(1)  # average
+        return pooled, counts > 0
+
+    def project(self, pooled, n=None):
+        """ Reduce the rows of the given full dimension tensor to n dimensions. If n is None or too large, returns them as is. """
+        V = self.projection(n)
+        if V is None: return pooled
+        with torch.no_grad():
+            return torch.matmul(pooled, V)
+
+    def embed(self, words: list, dims: list):
         """
-        if 0 <= n >= self.embedding.embedding_dim: n = self.embedding.embedding_dim
-
-        embedding = self.embeddings.get(n)
-        if not embedding:  # this embedding dimension doesn't exist
-            self.embeddings[n] = self.reduce(n)  # make it
-            embedding = self.embeddings.get(n)
-
-        vectors = []  # list of tuples (word, [vector])
-
-        # split the word list into batches
-        for i in range(0, len(words), self.max):
-            batch = words[i:i+self.max]  # slice input to get batch
-            encoded = self.tokenizer(batch, is_split_into_words=True, return_tensors="pt", add_special_tokens=False)  # returns a Tensor of token ids
-            output = embedding(encoded.input_ids)
-            output = output.squeeze(0)  # don't want the 0th dimension
-            vectors += self.map_words_to_vectors(encoded, output)  # add to list of tuples
-
-        return vectors
+        Returns a tensor with a row for each word, which is the concatenation of its embedding in each of the given dimensions.
+        Also returns a boolean tensor of which words had any tokens.
+        Words are only tokenized and pooled once, then reduced with one matrix multiplication for each dimension.
+        """
+        pooled, found = self.pool(words)
+        return torch.cat([self.project(pooled, n) for n in dims], dim=1), found
 
-    def map_words_to_vectors(self, encoded, matrix):
+    def get_vectors(self, words: list, n: int = None):
         """
-        Given a tokenizer output (encoded),
-        and a corresponding <matrix> (from a model output),
-        return a map of tuples that map words to their corresponding vector (as a list).
+        Return the n-dimensional embedding of each word, as a list of tuples (word, [vector]).
+        If n is less than 0 or greater than the current embedding dimensions, return max dimensions.
+        Words without any tokens are left out.
         """
-        words = []  # map words to a list of their token vector indexes
-        last_word_id = None
-        for word_id in encoded.word_ids():  # indexes of words in the original sentence
-            if word_id is None: continue
-            if last_word_id == word_id: continue  # skip if it's the same word
-            last_word_id = word_id
-
-            start, end = encoded.word_to_tokens(word_id)  # start and end index of token IDs
-            ids = list(encoded['input_ids'][0][start:end])  # list of token IDs for this work
-            word = self.tokenizer.decode(ids)  # original word associated with these tokens
-            words.append((word, [i for i in range(start, end)]))
-
-        vectors = []  # map words to their vector
-        for word, indexes in words:
-            tensor = torch.stack([matrix[i] for i in indexes]).mean(dim=0)  # average all token vectors
-            if tensor.size():  # has a length
-                vectors.append((word, tensor.tolist()))
-            else:  # it's a single scalar
-                vectors.append((word, [tensor.tolist()]))  # need to put it in a list because .tolist() doesn't do it's job https://github.com/pytorch/pytorch/issues/52262
-        return vectors
+        pooled, found = self.pool(words)
+        vectors = self.project(pooled, n).tolist()
+        return [(word, vector) for word, vector, f in zip(words, vectors, found.tolist()) if f]
 
     # Database stuff
-    def populate_database(self, replace=False, batch_size=10000):
-        """ Populate the database table with coordinates """
+    def iter_concepts(self, batch_size=10000, after=''):
+        """
+        Yield batches of distinct concept rows (CUI, AUI, STR) from concept_map, in order of AUI.
+        Uses keyset pagination on AUI, so each query only reads a single batch and nothing else is held in memory.
+        The query for the next batch runs in the background while the current batch is being used.
+        <after> AUI to continue after.
+        Raises an exception if a query fails, rather than ending early as if there were no concepts left.
+        """
+        query = """
+            SELECT DISTINCT CUI, AUI, STR
+            FROM concept_map
+            WHERE AUI > %s
+            ORDER BY AUI
+            LIMIT %s
+        """
+        rows = self.db.query(query, [after, batch_size])
+        while rows:
+            after = rows[-1]['AUI']
+            next_rows = self.db.query(query, [after, batch_size], threaded=True) if len(rows) == batch_size else None
+            yield rows
+            rows = next_rows.get() if next_rows else []
+        if rows is None:  # MySQLDatabase.query() returns None on failure
+            self.throw(f"Failed to query the concepts after AUI {after}. Resume to retry from the last checkpoint.")
+
+    def load_checkpoint(self, replace):
+        """ AUI after which an interrupted populate_database() run with the same options and model weights should continue, or '' """
+        if not os.path.exists(self.checkpoint_file): return ''
+        with open(self.checkpoint_file) as file:
+            checkpoint = json.load(file)
+        if checkpoint.get('checksum') != self.checksum or checkpoint.get('replace') != replace:
+            return ''
+        return checkpoint['after']
+
+    def save_checkpoint(self, after, replace):
+        """ Save the AUI up to which all concepts have been inserted """
+        self.ensure_path(self.checkpoint_file, file=True)
+        with open(self.checkpoint_file + '.tmp', 'w') as file:
+            json.dump({'model': self.model_name, 'checksum': self.checksum, 'replace': replace, 'after': after}, file)
+        os.replace(self.checkpoint_file + '.tmp', self.checkpoint_file)
+
+    def populate_database(self, replace=False, batch_size=10000, resume=True):
+        """
+        Populate the database table with coordinates.
+        Concepts are streamed from concept_map in batches in order of AUI (see iter_concepts()), and each batch is inserted
+            in the background while the next is embedded, so only a couple of batches are held in memory at once.
+        After each batch is inserted, its last AUI is saved as a checkpoint. An interrupted run continues after it
+            if <resume> is True. The checkpoint is removed once all concepts are done.
+        <replace> embed all concepts, instead of only those not already in the embedding table.
+        """
         query = f"""CREATE TABLE IF NOT EXISTS `{self.table_name}` (
                   `{self.columns[0]}`   char(8)             NOT NULL     COMMENT 'The CUI of this concept',
                   `{self.columns[1]}`   varchar(9)          NOT NULL     COMMENT 'The AUI of this concept',
@@ -115,83 +207,84 @@ class EmbeddingModel(Base):
                   PRIMARY KEY (`AUI`),
                   KEY          `CUI_index`         (`CUI`)
                 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4"""
-        db.query(query)
+        self.db.query(query)
+
+        after = self.load_checkpoint(replace) if resume else ''
+        if after: self.log(f"Continuing from checkpoint after AUI {after}")
 
-        # get all CUIs
-        self.log("Retrieving concepts from database...")
+        # count the concepts left, for progress
         self.mark_time("query")
-        if replace:  # get all concepts
-            query = """SELECT DISTINCT CUI, AUI, STR FROM concept_map"""
-        else:  # get all concepts not already in the embedding table
-            query = f"""SELECT DISTINCT CUI, AUI, STR FROM concept_map WHERE (CUI, AUI) NOT IN (SELECT CUI, AUI FROM {self.table_name})"""
-        rows = db.query(query)
+        total = self.db.query("SELECT COUNT(DISTINCT AUI) as total FROM concept_map WHERE AUI > %s", [after])
+        total = total[0]['total'] if total else None
         self.add_time("query")
-        self.log(f"Total Query Time: {self.get_time_total('query')}")
-
-        words = []
-        cuis = []
-        auis = []
-        for row in rows:
-            cuis.append(row['CUI'])
-            auis.append(row['AUI'])
-            words.append(row['STR'])
-
-        self.log(f"Total words: {len(words):,}")
+        if total is None:
+            self.log("Failed to count the concepts left. Progress will not be shown.")
+        else:
+            self.log(f"Total concepts: {total:,} ({self.get_time_total('query')})")
         self.log(f"Batch size: {batch_size:,}")
-        batches = int(math.ceil(len(words) / batch_size))
+        batches = int(math.ceil(total / batch_size)) if total else 0
         self.log(f"Total batches: {batches:,}")
-        b = 0
-        for i in range(0, len(words), batch_size):
-            batch_words = words[i:i+batch_size]  # slice words to get the current batch
-            batch_cuis = cuis[i:i+batch_size]
-            batch_auis = auis[i:i+batch_size]
 
-            self.mark_time('vec')  # time it
-
-            v2d = self.get_vectors(batch_words, 2)
-            v3d = self.get_vectors(batch_words, 3)
-            v5d = self.get_vectors(batch_words, 5)
+        pending = None  # insert in progress, and the last AUI of its batch
+        skipped = 0  # concepts already in the embedding table
+        for b, batch in enumerate(self.iter_concepts(batch_size, after)):
+            last = batch[-1]['AUI']
+            if not replace:  # skip concepts already embedded, with a primary key range lookup over this batch
+                existing = self.db.query(f"SELECT AUI FROM {self.table_name} WHERE AUI BETWEEN %s AND %s", [batch[0]['AUI'], last])
+                existing = set(row['AUI'] for row in existing or [])
+                skipped += len(existing)
+                batch = [row for row in batch if row['AUI'] not in existing]
 
+            self.mark_time('vec')  # time it
+            vectors, found = self.embed([row['STR'] for row in batch], [2, 3, 5])  # each row is the 2D, 3D, and 5D coordinates
             self.add_time('vec')  # stop timing
 
             # construct rows to insert
             self.mark_time('parse')
             rows = []
-            for j in range(len(batch_words)):  # for each word
-                cui = batch_cuis[j]
-                aui = batch_auis[j]
-
-                # each element in the list of vectors is a tuple (word, [v1, v2, v3, ...])
-                rows.append([
-                    cui, aui,
-                    v2d[j][1][0], v2d[j][1][1],
-                    v3d[j][1][0], v3d[j][1][1], v3d[j][1][2],
-                    v5d[j][1][0], v5d[j][1][1], v5d[j][1][2], v5d[j][1][3], v5d[j][1][4]
-                ])
+            for row, coordinates, f in zip(batch, vectors.tolist(), found.tolist()):
+                if not f: continue  # no tokens to embed
+                rows.append([row['CUI'], row['AUI']] + coordinates)
             self.add_time('parse')
 
+            # wait for the previous batch to be inserted, then insert this one in the background
             self.mark_time("insert")
-            self.insert(rows)
+            if pending: self.finish_insert(*pending, replace)
+            pending = (self.insert(rows, threaded=True) if rows else None, last)
             self.add_time("insert")
 
-            progress = self.progress(b, batches, every=1)
+            progress = self.progress(b, batches, every=1) if b < batches else None
             if progress:
                 total = self.get_time_total('vec',0)
                 vec = self.get_time_last('vec')
                 parse = self.get_time_last('parse')
                 insert = self.get_time_last('insert')
                 self.log(f"{progress} | {total:<10} | {vec:<8} | {parse:<8} | {insert:<8}")
-            b += 1
 
+        if pending: self.finish_insert(*pending, replace)
+        if os.path.exists(self.checkpoint_file):
+            os.remove(self.checkpoint_file)  # all done
+
+        if skipped: self.log(f"Skipped {skipped:,} concepts already embedded")
         self.log(f"Batch size: {batch_size}")
         self.log(f"Avg. Vector Time: {self.get_time_avg('vec')} | Total Vector Time: {self.get_time_sum('vec')}")
         self.log(f"Avg. Parse Time: {self.get_time_avg('parse')} | Total Parse Time: {self.get_time_sum('parse')}")
-        self.log(f"Avg. Insert Time: {self.get_time_avg('insert')} | Total Insert Time: {self.get_time_sum('insert')}")
+        self.log(f"Avg. Insert Time (waiting): {self.get_time_avg('insert')} | Total Insert Time (waiting): {self.get_time_sum('insert')}")
+
+    def finish_insert(self, result, last, replace):
+        """
+        Wait for a batch insert (AsyncResult, or None if the batch had nothing to insert), then checkpoint its last AUI.
+        If the insert failed, the checkpoint is not moved past the batch, so a resumed run embeds it again.
+        """
+        if result and result.get() is None:  # MySQLDatabase.query() returns None on failure
+            self.throw(f"Failed to insert the batch of embeddings ending at AUI {last}. Resume to retry from the last checkpoint.")
+        self.save_checkpoint(last, replace)
 
-    def insert(self, rows):
+    def insert(self, rows, threaded=False):
         """
         Insert rows into the database.
         <rows> should be a list of lists of items for their respective column.
+        <threaded> if True, runs in the database thread pool and returns an AsyncResult.
         """
         assert len(rows[0]) == len(self.columns), "Length of rows to insert do not match length of columns."
         # construct values in this row for the INSERT statement
@@ -212,11 +305,12 @@ class EmbeddingModel(Base):
         INSERT IGNORE `{self.table_name}` ({', '.join(self.columns)})
         VALUES {', '.join(row_values)}
         """
-        db.query(query)
+        return self.db.query(query, threaded=threaded)
 
 
 def get_stats(models):
     """ Get vocab statistics from the database """
+    db = MySQLDatabase()
     query = """SELECT DISTINCT STR FROM concept_map"""
     print("Compiling umls words...")
     umls_words = db.query(query)
@@ -233,7 +327,7 @@ def get_stats(models):
     print(f"Total Extracted: ", extracted_total)
 
     for name in models:
-        model = EmbeddingModel(name)
+        model = EmbeddingModel(name, db=db)
         vocab = model.tokenizer.get_vocab()  # get vocab dictionary
         print()
         print("Model: ", name)
@@ -4,6 +4,7 @@ import re
 import os, ssl
 import math
 import pickle
+import itertools
 
 if (not os.environ.get('PYTHONHTTPSVERIFY', '') and getattr(ssl, '_create_unverified_context', None)):
     ssl._create_default_https_context = ssl._create_unverified_context
@@ -17,22 +18,22 @@ import spacy
 import spacy_transformers
 from   scispacy.abbreviation import AbbreviationDetector
 from   scispacy.linking import EntityLinker
-from   stanza.server import CoreNLPClient
 import logging
 
 from utils.database.database import MySQLDatabase
 from utils.base import Base, ThreadQueue
+from utils.extraction.corenlp_pool import CoreNLPPool
 
 
 class NLPExtractor(Base):
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, db=None, **kwargs):
         super().__init__(*args, **kwargs)
         logging.getLogger('allennlp.common.params').disabled = True 
         logging.getLogger('allennlp.nn.initializers').disabled = True 
         logging.getLogger('allennlp.modules.token_embedders.embedding').setLevel(logging.INFO) 
         logging.getLogger('urllib3.connectionpool').disabled = True
 
-        self.db = MySQLDatabase()
+        self.db = db or MySQLDatabase()  # a given database object is used instead of connecting to MySQL
 
         # the number of nodes deployed
         self.nodes = int(os.popen("sinfo --Node | wc -l").read()) - 1
@@ -45,9 +46,9 @@ class NLPExtractor(Base):
         self.spacy_models = {}
         self.abbr_model = None
         
-        # The CoreNLP Java client
+        # Pool of CoreNLP Java servers
         self.client = None
-        self.memory_threshold = 90  # client restart memory percent threshold
+        self.max_chars = getattr(self.config, 'CoreNLP_max_chars', 4000)  # longer documents are annotated in parts
         self.threads = os.cpu_count()  # threads equal to number of CPUs
 
         # Column names to insert into tables
@@ -190,26 +191,16 @@ ex.extract_information(parallel_index=ID, db_insert=True, batch_size=1000, show_
 
     def check_client(self, restart=True):
         """
-        Initializes the client if it isn't already.
-        Checks the memory usage of the CoreNLP client.
-        When memory usage gets too high, the client is restarted.
+        Initializes the pool of CoreNLP servers if it isn't already.
+        Checks the memory usage of each server. A server using too much memory is drained and restarted on its own,
+            while the rest of the pool keeps annotating (see CoreNLPPool.check()).
         """
         if not self.client:
             self.log('Initializing CoreNLP Client... ')
-            self.client = CoreNLPClient(
-                timeout=60000,
-                be_quiet=True,
-                #preload=True,  # doesn't seem to work :(
-                threads=self.threads,
-                start_server=stanza.server.StartServer.TRY_START,  # start new server or connect to a pre-existing one if it already exists (allows multiple threads)
-                properties=self.config.CoreNLP_properties,
-                memory=self.config.CoreNLP_memory,
-                endpoint=self.config.CoreNLP_endpoint,
-            )
-        elif restart and self.memory(num=True) > self.memory_threshold:  # if memory over threshold
-            self.log(f"Restarting CoreNLP Server (memory > {self.memory_threshold}%)")
-            self.client.stop()
+            self.client = CoreNLPPool(self.config, threads=self.threads)
             self.client.start()
+        elif restart:
+            self.client.check()
 
     def initialize_entity_resources(self):
         """ Download Spacy models and make sure they are in the memory before continuing """
@@ -326,6 +317,8 @@ ex.extract_information(parallel_index=ID, db_insert=True, batch_size=1000, show_
 
         <pmids> list of PMIDs
         <parallel_index> must be a unique index from 0 to (total jobs)-1 for each parallel job running this function.
+
+        Returns a dictionary of totals for the run, including the summed seconds spent in each stage.
         """
         assert pmids is not None or parallel_index is not None, "Either a list of pmids or a parallel index must be given"
 
@@ -351,9 +344,12 @@ ex.extract_information(parallel_index=ID, db_insert=True, batch_size=1000, show_
         self.initialize_entity_resources()  # download entity resources if not already (slow but happens once)
         self.check_client()  # start CoreNLP client
 
+        window = self.threads  # number of annotation requests kept in flight to the CoreNLP server
+
         # logging
         self.log("Beginning Extraction...")
         self.log(f"Annotation Threads: {self.threads}")
+        self.log(f"Annotation Window: {window}")
         if show_progress:
             self.log(f"\nPapers to extract: {total_papers:,} (with batch size {batch_size:,})")
             self.log("Complete | Total Time || Success | Batch Time || Query |  NER   | Stanza | Triples | Insert || Memory Usage")
@@ -366,144 +362,150 @@ ex.extract_information(parallel_index=ID, db_insert=True, batch_size=1000, show_
         total_errors = 0  # has any kind of error
         total_no_triples = 0  # no triples were found
         total_no_content = 0  # no content associated with the paper (and thus no triples)
+        total_split = 0  # too long to annotate at once, so annotated in parts
         total_triples = 0  # total triples found
         total_entities = 0  # total entities found
+        annotate_time = 0  # summed CoreNLP annotation time since the last batch was inserted
+        stage_times = {'query': 0, 'ner': 0, 'annotate': 0, 'triples': 0, 'insert': 0}  # summed seconds spent in each stage
 
         insert_threads = []  # async results for threaded inserts
-        queue = ThreadQueue(self.threads)  # create new thread queue for the CoreNLP annotations
+
+        # Papers stream through a fixed window of in-flight annotations, which is refilled as soon as any one completes.
+        # Batches are only used to query papers and insert rows, so the CoreNLP server never waits on a batch boundary.
+        batch_sizes = {}  # batch index -> number of papers in that batch (set once the whole batch has been submitted)
+        batch_processed = {}  # batch index -> number of papers from that batch taken off the annotation stream
+        flushed = 0  # index of the next batch to be inserted
+        papers = self.iter_papers(pmid_batches, batch_sizes)
+        stream = self.annotate_stream(papers, window)
 
         self.mark_time('total')  # total time passed
-        for b, pmids in enumerate(pmid_batches):  # for each PMID batch
-            self.mark_time('batch')
+        self.mark_time('batch')
+        for b, paper in itertools.chain(stream, [(None, None)]):  # the trailing None flushes the last batches
+            # Batch finished! Insert every batch whose papers have all been processed, in order
+            while flushed in batch_sizes and batch_processed.get(flushed, 0) >= batch_sizes[flushed]:
+                self.mark_time('insert')
+                for result in insert_threads:  # wait for previous batch inserts to finish if they haven't already
+                    result.wait()
+                # Insert batch into Triples and Concepts tables
+                r1 = self.db.insert_row('triples', self.triple_cols, triple_params, db_insert=db_insert, threaded=True)
+                r2 = self.db.insert_row('concepts', self.concept_cols, concept_params, db_insert=db_insert, threaded=True)
+                self.add_time('insert')
+
+                triple_params, concept_params, insert_threads = [], [], []  # reset insert values for next batch
+                if r1: insert_threads.append(r1)  # threads to wait on before next insert
+                if r2: insert_threads.append(r2)
+
+                self.add_time('batch')
+
+                # show progress after batch
+                progress = self.progress(flushed, total_batches, every=1)
+                if show_progress and progress:
+                    total = self.get_time_total('total', 0)  # total time passed
+                    batch = self.get_time_last('batch', 2)  # last batch time
+                    query = self.get_time_sum('query', 2)  # paper query time spent waiting for the batch
+                    insert = self.get_time_last('insert', 2)  # insert time for the batch
+
+                    ner = self.get_time_sum('ner', 2)  # summed ner time
+                    triples = self.get_time_sum('triples', 2)  # summed triples time
+
+                    # Server utilization: summed annotation time over the time available to the whole window
+                    available = window * self.times['batch']['diff']
+                    _stanza = f"{round(100 * annotate_time / available, 1)}%" if available else self.time_na
+
+                    self.log(f"{progress:8} | {total:10} || {batch_success:7,} | {batch:10} || {query:5} | {ner:7} | {_stanza:6} | {triples:9} | {insert:6} || {self.memory()}")
+
+                for stage in ('query', 'ner', 'triples'):
+                    stage_times[stage] += self.times.get(stage, {}).get('sum', 0)
+                stage_times['annotate'] += annotate_time
+                stage_times['insert'] += self.times['insert']['diff']
+
+                self.clear_time('query', 'ner', 'triples')
+                batch_success = 0  # reset number of successful papers in the batch
+                annotate_time = 0  # reset summed annotation time
+                flushed += 1
 
-            self.mark_time("query")
-            papers = self.get_papers_from_pmids(pmids)  # list of dicts with keys "pmid", "pub_date", and "content"
-            self.add_time('query')
+            if paper is None:  # annotation stream finished
+                break
+            batch_processed[b] = batch_processed.get(b, 0) + 1
 
-            # submit each paper to the queue for annotation
-            self.debug("Submitting batch to annotation queue")
-            for paper in papers:
-                pmid = paper['pmid']
-                pub_date = paper['pub_date']
-                content = paper['content']  # abstract
+            self.mark_time('paper')
 
-                # skip papers with no content
-                if not content:
-                    total_no_content += 1
-                    continue
+            pmid = paper['pmid']
+            pub_date = paper['pub_date']
+            content = paper['content']
+            document = paper['document']  # Stanza document object
 
-                # submit paper to thread queue
-                queue.submit(self.annotate, [pmid, pub_date, content])
+            # skip papers with no content
+            if not content:
+                total_no_content += 1
+                continue
 
-            # go through each document from the annotation queue
-            for _ in range(len(papers)):
-                self.mark_time('paper')
+            annotate_time += paper['time']
+            if paper.get('parts'):
+                total_split += 1
+            if not document:
+                total_errors += 1
+                self.debug(f"CoreNLP failed to annotate content.")
+                continue
 
-                self.mark_time("stanza")
-                paper = queue.next()  # get next available document
-                self.add_time('stanza')
+            self.mark_time('ner')
+            entities = self.get_entities(content)  # Extract the entities, indexed by start_char
+            if not len(entities):
+                self.err(f"No entities found for PMID: {pmid}")
+            else:
+                total_entities += len(entities)
+            self.add_time('ner')
 
-                if paper is None:  # queue empty - batch finished
-                    break
+            self.mark_time('triples')
+            try:
+                triples = []
+                triples = self.get_triples(document, entities)  # match triples to entities and filter
+                total_triples += len(triples)
+            except Exception as e:
+                total_errors += 1
+                self.err(f"Failed to get triples from annotated document from PMID: {pmid}. {self.trace()}")
+                continue
 
-                pmid = paper['pmid']
-                pub_date = paper['pub_date']
-                content = paper['content']
-                document = paper['document']  # Stanza document object
+            self.debug(f"Triples: {len(triples)} | Entities: {len(entities)}")
 
-                if not document:
-                    total_errors += 1
-                    self.debug(f"CoreNLP failed to annotate content.")
-                    continue
+            if not triples:
+                total_no_triples += 1
+                self.err(f"No triples extracted for PMID: {pmid}")
+                continue
 
-                self.mark_time('ner')
-                entities = self.get_entities(content)  # Extract the entities, indexed by start_char
-                if not len(entities):
-                    self.err(f"No entities found for PMID: {pmid}")
-                else:
-                    total_entities += len(entities)
-                self.add_time('ner')
-
-                self.mark_time('triples')
-                try:
-                    triples = []
-                    triples = self.get_triples(document, entities)  # match triples to entities and filter
-                    total_triples += len(triples)
-                except Exception as e:
-                    total_errors += 1
-                    self.err(f"Failed to get triples from annotated document from PMID: {pmid}. {self.trace()}")
-                    continue
+            try:  # construct database inserts
+                paper_triple_params, paper_concept_params = [], []
+                paper_triple_params, paper_concept_params = self.construct_rows(triples, pmid, pub_date)
+            except Exception as e:
+                total_errors += 1
+                self.err(f"Failed to construct rows for PMID: {pmid}. {self.trace()}")
+                continue
+            self.add_time('triples')
 
-                self.debug(f"Triples: {len(triples)} | Entities: {len(entities)}")
+            # success!
+            triple_params += paper_triple_params
+            concept_params += paper_concept_params
+            total_success += 1
+            batch_success += 1
 
-                if not triples:
-                    total_no_triples += 1
-                    self.err(f"No triples extracted for PMID: {pmid}")
-                    continue
+            self.add_time('paper')
 
-                try:  # construct database inserts
-                    paper_triple_params, paper_concept_params = [], []
-                    paper_triple_params, paper_concept_params = self.construct_rows(triples, pmid, pub_date)
-                except Exception as e:
-                    total_errors += 1
-                    self.err(f"Failed to construct rows for PMID: {pmid}. {self.trace()}")
-                    continue
-                self.add_time('triples')
-
-                # success!
-                triple_params += paper_triple_params
-                concept_params += paper_concept_params
-                total_success += 1
-                batch_success += 1
-
-                self.add_time('paper')
-
-                # debug logging
-                if self.config.debug:  # print for each paper in debug mode
-                    last_paper = self.get_time_last('paper', 2)  # last paper time
-                    last_ner = self.get_time_last('ner', 3)  # last ner time
-                    last_stanza = self.get_time_last('stanza', 3)  # last stanza time
-                    last_triples = self.get_time_last('triples', 4)  # last triples time
-                    self.debug(f"{pmid:8} | {len(content):6} | {last_paper:4} | {last_ner:5} | {last_stanza:6} | {last_triples:8} | {self.memory()}\n")
-
-            # Batch finished!
-
-            self.mark_time('insert')
-            for result in insert_threads:  # wait for previous batch inserts to finish if they haven't already
-                result.wait()
-            # Insert batch into Triples and Concepts tables
-            r1 = self.db.insert_row('triples', self.triple_cols, triple_params, db_insert=db_insert, threaded=True)
-            r2 = self.db.insert_row('concepts', self.concept_cols, concept_params, db_insert=db_insert, threaded=True)
-            self.add_time('insert')
-
-            triple_params, concept_params, insert_threads = [], [], []  # reset insert values for next batch
-            if r1: insert_threads.append(r1)  # threads to wait on before next insert
-            if r2: insert_threads.append(r2)
-
-            self.add_time('batch')
-
-            # show progress after batch
-            progress = self.progress(b, total_batches, every=1)
-            if show_progress and progress:
-                total = self.get_time_total('total', 0)  # total time passed
-                batch = self.get_time_last('batch', 2)  # last batch time
-                query = self.get_time_last('query', 2)  # paper query time for the batch
-                insert = self.get_time_last('insert', 2)  # insert time for the batch
-
-                ner = self.get_time_sum('ner', 2)  # summed ner time
-                _stanza = self.get_time_sum('stanza', 2)  # summed stanza time
-                triples = self.get_time_sum('triples', 2)  # summed triples time
-
-                self.log(f"{progress:8} | {total:10} || {batch_success:7,} | {batch:10} || {query:5} | {ner:7} | {_stanza:6} | {triples:9} | {insert:6} || {self.memory()}")
-
-                self.clear_time('ner', 'stanza', 'triples')
-                batch_success = 0  # reset number of successful papers in the batch
+            # debug logging
+            if self.config.debug:  # print for each paper in debug mode
+                last_paper = self.get_time_last('paper', 2)  # last paper time
+                last_ner = self.get_time_last('ner', 3)  # last ner time
+                last_stanza = self.format_seconds(paper['time'], 3)  # annotation time of this paper
+                last_triples = self.get_time_last('triples', 4)  # last triples time
+                self.debug(f"{pmid:8} | {len(content):6} | {last_paper:4} | {last_ner:5} | {last_stanza:6} | {last_triples:8} | {self.memory()}\n")
 
         # All batches finished!
 
         # wait for the final insert
+        self.mark_time('insert')
         for result in insert_threads:
             result.wait()
+        self.add_time('insert')
+        stage_times['insert'] += self.times['insert']['diff']
 
         # show some stats
         success_percent = round(100*total_success/total_papers,3) if total_papers else 0
@@ -518,10 +520,24 @@ ex.extract_information(parallel_index=ID, db_insert=True, batch_size=1000, show_
         self.log(f"Errors: {total_errors:,} ({error_percent}%)")
         self.log(f"No Triples: {total_no_triples:,} ({no_triples_percent}%)")
         self.log(f"No Content: {total_no_content:,} ({no_content_percent}%)")
+        self.log(f"Split: {total_split:,} (longer than {self.max_chars:,} characters)")
         self.log()
         self.log(f"Total Triples: {total_triples:,}  (Avg/paper: {avg_triples})")
         self.log(f"Total Entities: {total_entities:,}   (Avg/paper: {avg_entities}")
 
+        return {
+            'papers': total_papers,
+            'success': total_success,
+            'errors': total_errors,
+            'no_triples': total_no_triples,
+            'no_content': total_no_content,
+            'split': total_split,
+            'triples': total_triples,
+            'entities': total_entities,
+            'seconds': time.time() - self.times['total']['start'],
+            'stage_seconds': stage_times,  # annotation runs in parallel, so its sum can exceed the total seconds
+        }
+
     def get_papers_from_pmids(self, pmids):
         """
         Retrieve a list of rows for papers in the database in the given list of PMIDs.
@@ -540,6 +556,128 @@ ex.extract_information(parallel_index=ID, db_insert=True, batch_size=1000, show_
             return []
         return result
 
+    def iter_papers(self, pmid_batches, batch_sizes):
+        """
+        Yield (batch index, paper) for every paper found in the given PMID batches (see self.get_papers_from_pmids()).
+        The query for the next batch runs in the background while the current batch is being consumed.
+        Once every paper of a batch has been yielded, its size is recorded in the <batch_sizes> dict.
+        """
+        if not pmid_batches: return
+        result = self.db.thread_pool.apply_async(self.get_papers_from_pmids, [pmid_batches[0]])
+        for b in range(len(pmid_batches)):
+            self.mark_time('query')
+            papers = result.get()  # wait for this batch to be queried
+            self.add_time('query')
+
+            if b + 1 < len(pmid_batches):  # start querying the next batch
+                result = self.db.thread_pool.apply_async(self.get_papers_from_pmids, [pmid_batches[b+1]])
+
+            # longest first, so long papers don't hold up the end of the stream
+            papers = sorted(papers, key=lambda paper: len(paper['content'] or ''), reverse=True)
+            for paper in papers:
+                yield b, paper
+            batch_sizes[b] = len(papers)
+
+    def annotate_stream(self, papers, window):
+        """
+        Annotate papers with a fixed window of in-flight requests to the CoreNLP server.
+        <papers> iterable of (key, paper) where each paper has the keys "pmid", "pub_date", and "content".
+        <window> maximum number of annotation requests in flight at once.
+
+        Yields (key, annotated paper) in order of completion (see self.annotate()).
+        The window is refilled as soon as a request completes, so nothing waits on the slowest paper of a batch.
+        Papers longer than self.max_chars are split into groups of sentences which are annotated in parallel,
+            then merged back together once all parts are done (see self.split_content() and self.merge_documents()).
+        Papers with no content are passed through without being annotated.
+        """
+        queue = ThreadQueue(window, max_pending=window)
+        parts = {}  # PMID -> list of (offset, annotated part) for papers split into several requests
+        with queue:
+            for key, paper in papers:
+                if not paper['content']:  # nothing to annotate
+                    yield key, dict(paper, document=None, time=0)
+                    continue
+
+                split = self.split_content(paper['content'], self.max_chars)
+                for offset, text in split:
+                    while len(queue) >= window:  # window is full - hand back completed annotations until a slot frees up
+                        annotated = self.collect_part(queue.next_task(), parts)
+                        if annotated: yield annotated
+                    queue.submit(self.annotate, [paper['pmid'], paper['pub_date'], text], key=(key, paper, offset, len(split)))
+
+            for task in queue.as_completed():  # no more papers - drain the window
+                annotated = self.collect_part(task, parts)
+                if annotated: yield annotated
+
+    def collect_part(self, task, parts):
+        """
+        Collect a completed annotation task from self.annotate_stream().
+        Returns (key, annotated paper) once every part of that paper is annotated, otherwise None.
+        <parts> dictionary of the parts completed so far for each split paper.
+        """
+        key, paper, offset, total = task.key
+        data = task.result()
+        if total == 1:  # not split
+            return key, data
+
+        completed = parts.setdefault(paper['pmid'], [])
+        completed.append((offset, data))
+        if len(completed) < total: return None
+        del parts[paper['pmid']]
+
+        completed.sort(key=lambda part: part[0])
+        return key, dict(paper,
+            document=self.merge_documents(paper['content'], [(offset, part['document']) for offset, part in completed]),
+            time=sum(part['time'] for offset, part in completed),
+            parts=total,
+        )
+
+    def split_content(self, text, max_chars):
+        """
+        Split text longer than <max_chars> into groups of whole sentences, each at most <max_chars> long where possible.
+        A single sentence longer than <max_chars> is kept whole in its own group.
+        Returns a list of (offset, text) where offset is the start of that group in the given text.
+        """
+        if not max_chars or len(text) <= max_chars:
+            return [(0, text)]
+
+        # start of each sentence, after the whitespace following the end of the previous sentence (and the end of the text)
+        starts = [0] + [match.end() for match in re.finditer(r'(?<=[.!?])\s+(?=[A-Z0-9(\[])', text)] + [len(text)]
+        groups = []
+        start = 0  # start of the current group
+        for i in range(1, len(starts)):
+            if starts[i] - start > max_chars and starts[i-1] > start:  # the next sentence doesn't fit in this group
+                groups.append((start, text[start:starts[i-1]].rstrip()))
+                start = starts[i-1]
+        groups.append((start, text[start:].rstrip()))
+        return groups
+
+    def merge_documents(self, text, parts):
+        """
+        Merge the annotated parts of a split document into a single document.
+        <text> the full text of the document
+        <parts> list of (offset, document) ordered by offset, where offset is the start of that part in the full text.
+        Character offsets of the sentences and tokens are shifted to be relative to the full text.
+        Parts that failed to annotate are left out, so the rest of the document is still used.
+        Returns None if no parts were annotated.
+        """
+        merged = None
+        for offset, document in parts:
+            if document is None: continue
+            if merged is None:
+                merged = type(document)()  # new Stanza document object
+                merged.text = text
+            for sentence in document.sentence:
+                s = merged.sentence.add()
+                s.CopyFrom(sentence)
+                s.sentenceIndex = len(merged.sentence) - 1
+                s.characterOffsetBegin += offset
+                s.characterOffsetEnd += offset
+                for token in s.token:
+                    token.beginChar += offset
+                    token.endChar += offset
+        return merged
+
     def lemmatize(self, text):
         """ Unused """
         nlp = stanza.Pipeline(lang='en', processors="tokenize, lemma", verbose=False)
@@ -580,8 +718,10 @@ ex.extract_information(parallel_index=ID, db_insert=True, batch_size=1000, show_
             'pub_date': pub_date,
             'content': text,
             'document': None,  # Stanza document object
+            'time': 0,  # seconds spent waiting on the CoreNLP server
         }
 
+        t0 = time.time()
         try:  # Run the Information Extraction Client.
             data['document'] = self.client.annotate(text)
         except stanza.server.client.TimeoutException:
@@ -589,6 +729,7 @@ ex.extract_information(parallel_index=ID, db_insert=True, batch_size=1000, show_
         except stanza.server.client.AnnotationException as e:
             self.log(f"Stanza CoreNLP server error on PMID: {pmid}")
             self.log(f"{e.__class__.__name__} {e}")
+        data['time'] = time.time() - t0
 
         return data
 
@@ -635,6 +776,8 @@ ex.extract_information(parallel_index=ID, db_insert=True, batch_size=1000, show_
         # get OpenIE triples
         triples = []
         for i, sentence in enumerate(document.sentence):
+            if not len(sentence.openieTriple): continue
+            sentence_tokens = self.index_sentence_tokens(sentence, entities)  # built once, shared by all triples in the sentence
             for triple in sentence.openieTriple:
                 triples.append({
                     'subject': triple.subject,
@@ -644,9 +787,10 @@ ex.extract_information(parallel_index=ID, db_insert=True, batch_size=1000, show_
                     'sentence_number': i,
                     'start_char': sentence.characterOffsetBegin,
                     'end_char': sentence.characterOffsetEnd,
-                    'subject_entities': self.tokens_to_entities(triple.subjectTokens, sentence, entities),
-                    'relation_entities': self.tokens_to_entities(triple.relationTokens, sentence, entities),
-                    'object_entities': self.tokens_to_entities(triple.objectTokens, sentence, entities),
+                    'tokens': sentence_tokens,
+                    'subject_entities': self.tokens_to_entities(triple.subjectTokens, sentence_tokens),
+                    'relation_entities': self.tokens_to_entities(triple.relationTokens, sentence_tokens),
+                    'object_entities': self.tokens_to_entities(triple.objectTokens, sentence_tokens),
                 })
 
         #triples += self.get_tree_triples(text)
@@ -671,40 +815,62 @@ ex.extract_information(parallel_index=ID, db_insert=True, batch_size=1000, show_
 
         triples = sorted(triples, key=sort_by)
 
+        # Entity ID sets are coded as integer bitsets, with a bit for each distinct entity in the sentence.
+        # A is a subset of B when (A | B) == B.
         sentence_num = -1
         keep_triples = []
-        completed = []
         for triple in triples:
             # The goal here is to trim down things that occur within a given sentence.
             if sentence_num != triple['sentence_number']:
                 sentence_num = triple['sentence_number']
-                completed = []
-                # self.debug()
-                # self.debug(sentence_num)
-
-            subjects = set([e['entity']['id'] for e in triple['subject_entities']])
-            objects = set([e['entity']['id'] for e in triple['object_entities']])
-
-            keep = True
-            for pair in completed:
-                # if both subject and object entities are a subset of any previous subject and object entities
-                if subjects.issubset(pair['subjects']) and objects.issubset(pair['objects']):
-                    keep = False
-                    break
-                # if the subject + object entities are completely contained within either the subject or object of another triple
-                all = subjects.union(objects)
-                if all.issubset(pair['subjects']) or all.issubset(pair['objects']):
-                    keep = False
-                    break
+                bits = {}  # entity ID -> bit position for this sentence
+                completed = []  # (subjects, objects) bitsets of each kept triple
+                completed_pairs = set()  # same as completed, for exact duplicates
+                all_subjects = 0  # union of the subjects of all kept triples
+                all_objects = 0  # union of the objects of all kept triples
+
+            subjects = self.entity_bitset(triple['subject_entities'], bits)
+            objects = self.entity_bitset(triple['object_entities'], bits)
+            both = subjects | objects
+
+            if (subjects, objects) in completed_pairs:  # the exact same entities were already kept
+                keep = False
+            elif ((subjects | all_subjects != all_subjects or objects | all_objects != all_objects)
+                  and both | all_subjects != all_subjects and both | all_objects != all_objects):
+                keep = True  # contains an entity no kept triple has in the same place, so it can't be a subset of one
+            else:
+                keep = True
+                for pair_subjects, pair_objects in completed:
+                    # if both subject and object entities are a subset of any previous subject and object entities
+                    if subjects | pair_subjects == pair_subjects and objects | pair_objects == pair_objects:
+                        keep = False
+                        break
+                    # if the subject + object entities are completely contained within either the subject or object of another triple
+                    if both | pair_subjects == pair_subjects or both | pair_objects == pair_objects:
+                        keep = False
+                        break
 
             # self.debug(f"{'X' if keep else ' '} | {'T' if triple.get('confidence') is None else ' '} | {triple['subject']} | {triple['relation']} | {triple['object']} < {len(triple['subject_entities'])} | {len(triple['relation_entities'])} | {len(triple['object_entities'])}")
 
             if keep:
-                completed.append({'subjects': subjects, 'objects': objects})
+                completed.append((subjects, objects))
+                completed_pairs.add((subjects, objects))
+                all_subjects |= subjects
+                all_objects |= objects
                 keep_triples.append(triple)
 
         return keep_triples
 
+    def entity_bitset(self, tokens, bits):
+        """
+        Returns an integer with a bit set for each entity associated with the given triple fragment tokens.
+        <bits> maps entity IDs to bit positions, and is extended when a new entity ID is seen.
+        """
+        bitset = 0
+        for index, frag_start_char, entity in tokens:
+            bitset |= 1 << bits.setdefault(entity['id'], len(bits))
+        return bitset
+
     def get_entities(self, text):
         """
         Construct a dictionary of entities found in the text.
@@ -748,18 +914,31 @@ ex.extract_information(parallel_index=ID, db_insert=True, batch_size=1000, show_
 
         return entities
 
-    def tokens_to_entities(self, triple_tokens, sentence, entities):
+    def index_sentence_tokens(self, sentence, entities):
         """
-        Returns entity positional information about a given triple fragment.
-        <triple_tokens> A list of tokens found in that triple
-        <sentence> The sentence Object containing this triple.
+        Returns a list with an item for each token in the given sentence, so triple fragments can look tokens up by index.
+        <sentence> The sentence Object
         <entities> A dictionary of entities, where keys are the starting character of that entity
 
-        Returns list of token dictionaries
+        Each item is a tuple of:
             start_char and end_char: position relative to start of the sentence
-            frag_start_char and frag_end_char: positions relative to the start of the triple fragment
-            text: original text of the token
-            entity: Named entity associated with this token (or empty)
+            length: length of the original text of the token
+            entity: Named entity associated with this token (or None)
+        """
+        offset = sentence.characterOffsetBegin
+        return [(t.beginChar - offset, t.endChar - offset, len(t.originalText), entities.get(t.beginChar)) for t in sentence.token]
+
+    def tokens_to_entities(self, triple_tokens, sentence_tokens):
+        """
+        Returns entity positional information about a given triple fragment.
+        <triple_tokens> A list of tokens found in that triple
+        <sentence_tokens> The token index of the sentence containing this triple, given by index_sentence_tokens()
+
+        Returns list of (token index, frag_start_char, entity) tuples for the tokens associated with an entity.
+            token index: index of the token in the sentence
+            frag_start_char: position relative to the start of the triple fragment
+            entity: Named entity associated with this token
+        The full token dictionaries are only built when needed by fragment_tokens().
 
         Note that the position of each token relative to the SENTENCE is different than the positions relative to the FRAGMENT.
         The sentence is the original text from the document, while the triple fragment can be lemmatized and have the tokens in a different order.
@@ -767,23 +946,31 @@ ex.extract_information(parallel_index=ID, db_insert=True, batch_size=1000, show_
         tokens = []
         pos = 0  # keep track of current position in fragment
         for token in triple_tokens:  # for each token in this triple fragment
+            # triple token index gives us the token from the full sentence, which has the information we want
+            index = token.tokenIndex
+            start_char, end_char, length, entity = sentence_tokens[index]
+            if entity:  # if there are entities associated
+                tokens.append((index, pos, entity))
+            pos += length + 1  # increment position by token size +1 for whitespace
+        return tokens
 
-            # triple token index gives us the token object from the full sentence, which has the information we want
-            t = sentence.token[token.tokenIndex]
-
-            if entities.get(t.beginChar):  # if there are entities associated
-                tokens.append({
-                    'start_char': t.beginChar - sentence.characterOffsetBegin,  # relative to start of sentence
-                    'end_char': t.endChar - sentence.characterOffsetBegin,  # relative to start of sentence
-                    'frag_start_char': pos,
-                    'frag_end_char': pos + len(t.originalText),
-                    'text': t.originalText,
-                    'word': t.word,
-                    'value': t.value,
-                    'entity': entities.get(t.beginChar, '')  # get the Spacy entity that occurred at this location
-                })
-
-            pos += len(t.originalText) + 1  # increment position by token size +1 for whitespace
+    def fragment_tokens(self, triple, fragment):
+        """
+        Returns list of token dictionaries for the given fragment of a triple ('subject', 'relation', or 'object')
+            start_char and end_char: position relative to start of the sentence
+            frag_start_char and frag_end_char: positions relative to the start of the triple fragment
+            entity: Named entity associated with this token
+        """
+        tokens = []
+        for index, frag_start_char, entity in triple[f'{fragment}_entities']:
+            start_char, end_char, length, _ = triple['tokens'][index]
+            tokens.append({
+                'start_char': start_char,
+                'end_char': end_char,
+                'frag_start_char': frag_start_char,
+                'frag_end_char': frag_start_char + length,
+                'entity': entity,
+            })
         return tokens
 
     def construct_rows(self, triples, pmid, pub_date):
@@ -810,23 +997,13 @@ ex.extract_information(parallel_index=ID, db_insert=True, batch_size=1000, show_
                  triple['sentence_number'], triple['start_char'], triple['end_char']])
 
             # Store the concepts
-            for token in triple['object_entities']:
-                e = token['entity']
-                concept_params.append(
-                    [pmid, triple_ID, 'object', e['id'], e['name'], len(triple['object_entities']), token['start_char'],
-                     token['end_char'], token['frag_start_char'], token['frag_end_char']])
-
-            for token in triple['subject_entities']:
-                e = token['entity']
-                concept_params.append([pmid, triple_ID, 'subject', e['id'], e['name'], len(triple['subject_entities']),
-                                       token['start_char'], token['end_char'], token['frag_start_char'],
-                                       token['frag_end_char']])
-
-            for token in triple['relation_entities']:
-                e = token['entity']
-                concept_params.append(
-                    [pmid, triple_ID, 'relation', e['id'], e['name'], len(triple['relation_entities']),
-                     token['start_char'], token['end_char'], token['frag_start_char'], token['frag_end_char']])
+            for fragment in ('object', 'subject', 'relation'):
+                tokens = self.fragment_tokens(triple, fragment)
+                for token in tokens:
+                    e = token['entity']
+                    concept_params.append(
+                        [pmid, triple_ID, fragment, e['id'], e['name'], len(tokens), token['start_char'],
+                         token['end_char'], token['frag_start_char'], token['frag_end_char']])
 
             triple_ID += 1
         return triple_params, concept_params
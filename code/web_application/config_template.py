@@ -66,6 +66,10 @@ class Config:
     BRAINWORKS_DB_PORT = 3306
     BRAINWORKS_DB_PASSWORD = ""
 
+    # Path of the concept embedding index built by the pipeline ("brain concept-index"), without the file extension.
+    # e.g. "/data/embedding/allenai_scibert_scivocab_uncased_concepts". Used for similar concept queries.
+    CONCEPT_INDEX_PATH = ""
+
 
 # ProdConfig and DevConfig contain values specific to production and development respectively.
 # Both of these classes extend a base class Config which contains values intended to be shared by both.
@@ -103,6 +103,8 @@ def visualizer_editor():
             graph_json_data, zip_data = get_graph.get_topic_co_occurrences(query)
         elif rep == "concept_embedding":
             graph_json_data, zip_data = get_graph.concept_embedding(query)
+        elif rep == "similar_concepts":  # concepts nearest to a single concept
+            graph_json_data, zip_data = get_graph.similar_concepts(query)
         else:  # default to knowledge map
             graph_json_data, zip_data = get_graph.get_triples_data(query)
         return jsonify(
@@ -156,6 +158,9 @@ def graph_commands(command):
         result = get_graph.get_extra_topic_co_occurrences(
             args["topic"], int(args["start"]), int(args["num"]), session
         )
+    elif command == "similar_concepts":  # expand a concept with its most similar concepts
+        concept, similar = get_graph.get_similar_concepts(args["cui"], int(args.get("num", 25)))
+        result = {"concept": concept, "similar": similar}
     else:
         return
 
@@ -0,0 +1,85 @@
+from flask import current_app as app
+from threading import Lock
+import json
+import os
+
+import numpy as np
+import hnswlib
+
+
+class ConceptIndex:
+    """
+    Reads the nearest neighbour index over concept embeddings built by the pipeline ("brain concept-index").
+    <path> is the path of the index files without their extension, e.g. ".../allenai_scibert_scivocab_uncased_concepts",
+        which has the files <path>.hnsw, <path>_labels.npz and <path>.json
+    The files are loaded on the first query, and shared between requests.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()  # hnswlib queries are thread safe, but loading and setting ef are not
+        self.index = None
+        self.meta = None
+
+    def load(self):
+        """Load the index files if they haven't been loaded yet"""
+        with self.lock:
+            if self.index is not None:
+                return
+            if not self.path or not os.path.exists(f"{self.path}.hnsw"):
+                raise Exception("The concept index is not available.")
+
+            with open(f"{self.path}.json") as f:
+                meta = json.load(f)
+            labels = np.load(f"{self.path}_labels.npz")
+            self.cuis = labels["cui"]  # CUI of each label
+            self.auis = labels["aui"]  # AUI of each label
+            self.cui_order = labels["cui_order"]  # labels in order of CUI
+            self.sorted_cuis = self.cuis[self.cui_order]
+
+            index = hnswlib.Index(space=meta["space"], dim=meta["dim"])
+            index.load_index(f"{self.path}.hnsw", max_elements=meta["count"])
+            index.set_ef(64)
+            self.meta = meta
+            self.index = index
+
+    def labels(self, cui):
+        """Labels of all atoms (AUIs) of the given CUI"""
+        start = np.searchsorted(self.sorted_cuis, cui, side="left")
+        end = np.searchsorted(self.sorted_cuis, cui, side="right")
+        return self.cui_order[start:end]
+
+    def similar(self, cui, k=25):
+        """
+        The <k> concepts nearest to the given CUI, as a list of dicts with "cui", "aui" and "similarity" (cosine similarity), most similar first.
+        The CUI is represented by the mean vector of all its atoms, and each similar concept by its nearest atom.
+        Returns None if the CUI isn't in the index.
+        """
+        self.load()
+        labels = self.labels(cui)
+        if not len(labels):
+            return None
+        vector = np.mean(self.index.get_items(labels), axis=0, keepdims=True)
+
+        n = min(k + len(labels), self.meta["count"])  # neighbours to fetch, including the atoms of the CUI itself
+        while True:
+            with self.lock:
+                self.index.set_ef(max(64, n))  # ef must be at least the number of neighbours
+                neighbours, distances = self.index.knn_query(vector, k=n)
+
+            results, seen = [], {cui}
+            for label, distance in zip(neighbours[0], distances[0]):
+                neighbour = self.cuis[label]
+                if neighbour in seen:  # atoms of the query CUI, or a CUI already nearer by another atom
+                    continue
+                seen.add(neighbour)
+                results.append({"cui": str(neighbour), "aui": str(self.auis[label]), "similarity": round(1 - float(distance), 4)})
+                if len(results) == k:
+                    return results
+
+            if n >= self.meta["count"]:  # all concepts fetched
+                return results
+            n = min(n * 2, self.meta["count"])  # many atoms of the same CUIs, so fetch more
+
+
+concept_index = ConceptIndex(app.config.get("CONCEPT_INDEX_PATH", ""))
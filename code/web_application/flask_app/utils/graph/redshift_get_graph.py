@@ -12,6 +12,10 @@ import zipfile
 from base64 import b64encode
 
 import redshift_connector
+
+from .concept_index import concept_index
+
+
 class RedShiftDatabase():
     def __init__(self):
         self.connection_keywords = {
@@ -892,6 +896,77 @@ def concept_embedding(params):
     return json_data, zip_data
 
 
+# Similar concepts
+def get_similar_concepts(cui, num=25):
+    """
+    The <num> concepts most similar to the given CUI, from the concept embedding index.
+    Returns the concept itself ("cui", "aui", "name") and a list of similar concepts, each with "cui", "aui", "name" and "similarity".
+    """
+    num = max(1, min(int(num), 200))
+    similar = concept_index.similar(cui, num)
+    if similar is None:
+        raise Exception(f"No concept embedding found for {cui}")
+
+    # names of the query concept and each nearest atom
+    concept = execute("SELECT CUI, AUI, STR FROM concept_map WHERE CUI = %s LIMIT 1", [cui])[0]
+    names = {}
+    if similar:
+        query = f"SELECT AUI, STR FROM concept_map WHERE AUI IN ({','.join(['%s' for _ in similar])})"
+        names = {row["AUI"]: row["STR"] for row in execute(query, [s["aui"] for s in similar], raise_no_results=False)}
+
+    for s in similar:
+        s["name"] = names.get(s["aui"], s["cui"])
+    concept = {"cui": concept["CUI"], "aui": concept["AUI"], "name": concept["STR"]}
+    return concept, similar
+
+
+def similar_concepts(params):
+    """Graph of the concepts most similar to the CUI in <params>, with an edge from it to each similar concept"""
+    cui = params.get("cui", "").strip()
+    concept, similar = get_similar_concepts(cui, params.get("limit", 25))
+
+    df = pd.DataFrame(similar, columns=["cui", "aui", "name", "similarity"])
+    zip_data = create_zip(df)  # create base-64 encoded zip file
+
+    nodes = [
+        {
+            "key": concept["cui"],
+            "attributes": {"label": concept["name"], "data": {"cui": concept["cui"], "similarity": 1}},
+        }
+    ]
+    edges = []
+    for s in similar:
+        nodes.append(
+            {
+                "key": s["cui"],
+                "attributes": {"label": s["name"], "data": {"cui": s["cui"], "similarity": s["similarity"]}},
+            }
+        )
+        edges.append(
+            {
+                "key": f"{concept['cui']}-{s['cui']}",
+                "source": concept["cui"],
+                "target": s["cui"],
+                "attributes": {"label": f"{s['similarity']:.2f}", "type": "arrow", "data": {"similarity": s["similarity"]}},
+            }
+        )
+
+    # the config dict to pass to the graph API
+    config = {
+        "maps": {
+            "node_size": {"data": "similarity", "min": 10, "max": 30},
+            "edge_size": {"data": "similarity", "min": 2, "max": 10},
+        },
+        "filters": {},  # sliders
+        "settings": {"toolbar": ["menu", "center", "search", "controls"]},
+    }
+
+    graph = {"nodes": nodes, "edges": edges}
+    json_data = {"graph": graph, "config": config}
+
+    return json_data, zip_data
+
+
 # Single paper triples data
 def get_single_paper_triples(params):
     """Construct and execute a SQL query for the knowledge graph from the given parameters"""